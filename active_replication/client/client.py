@@ -10,10 +10,15 @@ from components.abstract_message_listener import MessageListener
 from components.event_handler import EventHandler
 from components.server_message_notifier import ServerMessageNotifier
 from components.server_list_manager import ServerListManager
+from components.reconciler import Reconciler
+from components.file_index import FileIndex
 
 import sys
 sys.path.append('../')
-from resources.message_sending import send_message
+from resources.message_sending import send_message, set_protocol, set_transport, reset_protocol, SUPPORTED_PROTOCOLS, SUPPORTED_TRANSPORTS, JSON_PROTOCOL, DATAGRAM_TRANSPORT, set_compressions, set_max_send_rate, is_sending, get_transport_stats
+from resources.compression import SUPPORTED_COMPRESSIONS, compression_stats
+from resources.metrics import metrics, start_metrics_server
+from resources.profiling import tracer, start_profiling
 
 # Import server configuration
 # Load configuration from the JSON file
@@ -22,9 +27,26 @@ with open('client_config.json', 'r') as config_file:
 
 # Use the loaded configuration
 CLIENT_DIR = config["client_dir"]
+DELTA_SYNC = config["delta_sync"]
+COMPRESSION = config["compression"]
+UPLOAD_CHUNK_SIZE = config["upload_chunk_size"]
+UPLOAD_WINDOW = config["upload_window"]
+SETTLE_WINDOW = config["settle_window"]
+RECONCILE = config["reconcile"]
+MAX_IN_FLIGHT = config["max_in_flight"]
+REPLICATION = config["replication"]
+WRITE_QUORUM = config["write_quorum"]
+METRICS_PORT = config["metrics_port"]
+MAX_SEND_RATE = config["max_send_rate"]
+# Credentials are never stored in the configuration, only given on the command line
+USERNAME = None
+PASSWORD = None
+# Trace file and seconds of stack and memory sampling, only set on the command line
+PROFILE = None
+PROFILE_WINDOW = None
 
 def parse_command_line_args():
-    global SERVERS, CLIENT_DIR
+    global SERVERS, CLIENT_DIR, DELTA_SYNC, COMPRESSION, UPLOAD_CHUNK_SIZE, UPLOAD_WINDOW, SETTLE_WINDOW, RECONCILE, MAX_IN_FLIGHT, REPLICATION, WRITE_QUORUM, METRICS_PORT, MAX_SEND_RATE, USERNAME, PASSWORD, PROFILE, PROFILE_WINDOW
     parser = argparse.ArgumentParser(description="Client replicating Dropbox functionality "
                                                  "by syncing files and folders in the background")
     
@@ -33,6 +55,21 @@ def parse_command_line_args():
     parser.add_argument('--server-ports', nargs='+', type=int, help='Server port numbers')
     parser.add_argument('--debug', action='store_true', help='Decide whether sent messages should be logged for debugging')
     parser.add_argument('--client-dir', help='Client directory path')
+    parser.add_argument('--no-delta-sync', action='store_true', help='Always send whole files instead of block-level deltas on modifications')
+    parser.add_argument('--no-compression', action='store_true', help='Never compress the data sent to the servers')
+    parser.add_argument('--upload-chunk-size', type=int, help='Size in bytes of the chunks larger files are streamed in')
+    parser.add_argument('--upload-window', type=int, help='Maximum number of streamed chunks waiting for acknowledgement')
+    parser.add_argument('--settle-window', type=float, help='Seconds a path has to stay unchanged before its events are sent')
+    parser.add_argument('--max-in-flight', type=int, help='Maximum number of messages waiting for acknowledgement before sending blocks')
+    parser.add_argument('--replication', choices=['active', 'primary'], help='Send updates to all servers (active) or only to the first one, which forwards them to the others (primary)')
+    parser.add_argument('--write-quorum', type=int, help='Number of servers that have to acknowledge an update before it counts as committed')
+    parser.add_argument('--metrics-port', type=int, help='Local port serving counters and latency histograms in the Prometheus text format')
+    parser.add_argument('--max-send-rate', type=int, help='Bytes per second the client may send to all servers together')
+    parser.add_argument('--username', help='Log in as this user without prompting for the credentials')
+    parser.add_argument('--password', help='Password of the user given with --username, empty if omitted')
+    parser.add_argument('--profile', help='Record the time spent in each stage of every message and save it as a Chrome trace to this file on exit')
+    parser.add_argument('--profile-window', type=float, help='Seconds after the start to sample the stacks of all threads and the memory allocations (with --profile)')
+    parser.add_argument('--no-reconcile', action='store_true', help='Only sync live changes instead of comparing the whole folder with the servers after login')
 
     args = parser.parse_args()
 
@@ -41,6 +78,35 @@ def parse_command_line_args():
     else: 
         os.environ["DEBUG"] = "off"
 
+    if args.no_delta_sync:
+        DELTA_SYNC = False
+    if args.no_compression:
+        COMPRESSION = False
+    if args.upload_chunk_size:
+        UPLOAD_CHUNK_SIZE = args.upload_chunk_size
+    if args.upload_window:
+        UPLOAD_WINDOW = args.upload_window
+    if args.settle_window is not None:
+        SETTLE_WINDOW = args.settle_window
+    if args.no_reconcile:
+        RECONCILE = False
+    if args.max_in_flight:
+        MAX_IN_FLIGHT = args.max_in_flight
+    if args.replication:
+        REPLICATION = args.replication
+    if args.write_quorum:
+        WRITE_QUORUM = args.write_quorum
+    if args.metrics_port:
+        METRICS_PORT = args.metrics_port
+    if args.max_send_rate:
+        MAX_SEND_RATE = args.max_send_rate
+    if args.username:
+        USERNAME = args.username
+        PASSWORD = args.password or ""
+    if args.profile:
+        PROFILE = args.profile
+        PROFILE_WINDOW = args.profile_window
+
     # Update the configuration based on the command-line arguments
     if len(args.server_hosts) != 1 and len(args.server_hosts) != len(args.server_ports):
         raise ValueError("Number of server IPs does not match the provided number of ports! In case you want to connect multiple processes running on the same host, enter the single host and all port numbers.")
@@ -62,15 +128,40 @@ def parse_command_line_args():
 
 # Class responsible for the Client instance
 class Client(MessageListener):
-    def __init__(self, client_dir, servers):
+    def __init__(self, client_dir, servers, delta_sync=True, upload_chunk_size=262144, upload_window=16, settle_window=0.5, compression=True, reconcile=True, max_in_flight=1024, replication="active", write_quorum=None, username=None, password=None, max_send_rate=None):
         self.client_dir = client_dir
-        self.server_list_manager = ServerListManager(servers, self)
+        self.delta_sync = delta_sync
+        self.upload_chunk_size = upload_chunk_size
+        self.upload_window = upload_window
+        self.settle_window = settle_window
+        self.compression = compression
+        self.reconcile = reconcile
+        self.replication = replication
+        # Credentials given on the command line, the user is prompted for them otherwise
+        self.username = username
+        self.password = password
+        # Persistent index of the synced files next to the client directory
+        self.file_index = FileIndex(client_dir)
+        self.server_list_manager = ServerListManager(servers, self, max_in_flight, replication == "primary", write_quorum)
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        set_max_send_rate(self.client_socket, max_send_rate)
         self.message_handler = ServerMessageNotifier(self.client_socket)
         self.message_handler.add_listener(self)
         self.event_handler = EventHandler(self)
+        self.reconciler = Reconciler(self)
         self.login_response = False
         self.logged_in = False
+        # Server that took over forwarding the updates and has to be sent the ones the previous one may have lost
+        self.failover_server = None
+
+        # Queue depths, only read when the metrics are scraped
+        metrics.register_gauge("servers_active", lambda: len(self.get_servers()))
+        metrics.register_gauge("messages_in_flight", lambda: len(self.server_list_manager.reply_log))
+        metrics.register_gauge("messages_awaiting_stragglers", lambda: len(self.server_list_manager.stragglers))
+        metrics.register_gauge("events_pending", lambda: len(self.event_handler.coalescer.pending))
+        metrics.register_gauge("push_changes_queued", self.event_handler.push_receiver.changes.qsize)
+        metrics.register_gauge("transport_congestion_window", lambda: get_transport_stats(self.client_socket)[0], "server")
+        metrics.register_gauge("transport_smoothed_rtt_seconds", lambda: get_transport_stats(self.client_socket)[1], "server")
         self.reply_log = {}
         self.observer = Observer()
         self.observer.schedule(self.event_handler, path=self.client_dir, recursive=True)
@@ -79,6 +170,10 @@ class Client(MessageListener):
     def get_servers(self):
         return self.server_list_manager.get_servers()
 
+    # Return the servers updates are sent to
+    def get_targets(self):
+        return self.server_list_manager.get_targets()
+
     # Handle server messages
     def notify_server_message(self, message, server_address):
         if message["action"] == "received":
@@ -86,26 +181,65 @@ class Client(MessageListener):
         elif message["action"] == "shutdown":
             self.server_list_manager.remove_server(server_address)
         elif message["action"] == "login":
+            if message["result"] == "successful":
+                # Switch to the wire protocol chosen by this server (older servers only speak JSON)
+                set_protocol(self.client_socket, message.get("protocol", JSON_PROTOCOL), server_address)
+                set_transport(self.client_socket, message.get("transport", DATAGRAM_TRANSPORT), server_address)
+                set_compressions(self.client_socket, message.get("compressions"), server_address)
+                self.event_handler.uploader.set_server_limits(server_address, message.get("upload"))
+                self.event_handler.batcher.set_server_limit(server_address, message.get("batch_limit"))
+                self.server_list_manager.set_replication(server_address, message.get("replication"))
+                # A server that was removed from the list answered again, or one that took over forwarding
+                if self.server_list_manager.readmit(server_address) or server_address == self.failover_server:
+                    self.failover_server = None
+                    catch_up_thread = threading.Thread(target=self.catch_up, args=(server_address, message.get("last_id")))
+                    catch_up_thread.daemon = True
+                    catch_up_thread.start()
             self.handle_login_message(message)
+        elif message["action"] == "signatures":
+            self.event_handler.receive_signatures(message)
+        elif message["action"] == "tree":
+            self.reconciler.receive_tree(message, server_address)
+        elif message["action"] == "resync":
+            self.event_handler.resync(message["path"])
+        # Changes made on other devices of the user, only the first server is asked to push them
+        elif message["action"] == "push" and server_address == self.get_push_server():
+            self.event_handler.push_receiver.receive(message)
+        # Copies of files fetched while reconciling the folder
+        elif message["action"] == "fetched":
+            self.event_handler.push_receiver.receive(message)
+        elif message["action"] == "push_overflow" and server_address in self.get_targets()[:1]:
+            print("Some changes made on other devices could not be pushed and are missing in this folder.")
 
     # Send a message to the server
     def send_message(self, message):
-        self.server_list_manager.check_server_timeouts()
         send_message(self.client_socket, message, self.get_servers())
 
     # Login logic
     def login(self):
         while not self.logged_in:
-            username = input("Enter username: ")
-            password = maskpass.askpass(prompt="Password: ", mask="*")
+            # Credentials given on the command line are used without prompting (e.g. for benchmark runs)
+            if self.username:
+                username, password = self.username, self.password or ""
+            else:
+                username = input("Enter username: ")
+                password = maskpass.askpass(prompt="Password: ", mask="*")
 
             message = {
                 "action": "login",
                 "username": username,
-                "password": password
+                "password": password,
+                "client_id": self.file_index.get_client_id(),
+                "protocols": SUPPORTED_PROTOCOLS,
+                "compressions": SUPPORTED_COMPRESSIONS if self.compression else [],
+                "transports": SUPPORTED_TRANSPORTS,
+                "replication": self.replication
             }
+            # Kept to log in again at servers that were removed from the list
+            self.login_message = message
 
-            self.send_message(message)
+            for server in self.get_servers():
+                send_message(self.client_socket, self.get_login_message(server), [server])
 
             # Wait for Server to answer for 10 seconds
             timeout = 10
@@ -117,6 +251,56 @@ class Client(MessageListener):
                 print("None of the servers are responding. Servers are potentially down. Please try again later or check your internet connection.")
             elif not self.logged_in:
                 self.login_response = False
+                # Trying the same credentials again would not help
+                if self.username:
+                    self.shutdown("Login failed. Closing client...")
+
+    # Whether the messages to a server are still on their way, held back by congestion control
+    def is_sending_to(self, server):
+        return is_sending(self.client_socket, server)
+
+    # Login message for a server, only the first target is asked to push the changes made on the other devices
+    def get_login_message(self, server):
+        return dict(self.login_message, push=server == self.get_push_server())
+
+    def get_push_server(self):
+        targets = self.get_targets()
+        return targets[0] if targets else None
+
+    # Log in again at the server that took over pushing the changes made on the other devices
+    def follow_pushes(self, server):
+        send_message(self.client_socket, self.get_login_message(server), [server])
+
+    # Log in again at a server that was removed from the list, its reply tells which updates it applied last
+    def probe_server(self, server):
+        reset_protocol(self.client_socket, server)
+        send_message(self.client_socket, self.get_login_message(server), [server])
+
+    # The server updates were sent to is gone. Updates it acknowledged may not have reached the others yet,
+    # the next one is asked which updates it applied and is sent the missing ones.
+    def fail_over(self, targets):
+        if len(targets) != 1:
+            print("No server forwards the updates anymore, they are sent to all servers.")
+            self.follow_pushes(targets[0])
+            return
+        print(f"Server {targets[0]} now forwards the updates to the other servers.")
+        self.failover_server = targets[0]
+        send_message(self.client_socket, self.get_login_message(targets[0]), targets)
+
+    # Send the changes since a message a server missed again, it was committed by the other servers
+    def repair_server(self, server, message_id):
+        repair_thread = threading.Thread(target=self.catch_up, args=(server, message_id - 1))
+        repair_thread.daemon = True
+        repair_thread.start()
+
+    # Send a server that answered again the updates it missed, or compare the whole folder with it
+    # if the updates sent since then are no longer known
+    def catch_up(self, server, last_id):
+        if self.event_handler.replay(last_id, server):
+            print(f"Sending server {server} the updates it missed.")
+        else:
+            print(f"Comparing the folder with server {server}, the updates it missed are unknown.")
+            self.reconciler.run([server])
 
     def handle_login_message(self, message):
         if message["action"] == "login" and not self.logged_in:
@@ -129,6 +313,12 @@ class Client(MessageListener):
 
     # Run client
     def run(self):
+        if METRICS_PORT:
+            try:
+                start_metrics_server(METRICS_PORT)
+            except OSError as e:
+                print(f"Error serving metrics on port {METRICS_PORT}: {e}")
+
         try:
             # Start listening to server messages in a separate thread
             listen_thread = threading.Thread(target=self.message_handler.start_listening)
@@ -140,6 +330,13 @@ class Client(MessageListener):
 
             # After successful login, start tracking changes in specified folder
             self.observer.start()
+
+            # Sync what changed while the client was not running
+            if self.reconcile:
+                reconcile_thread = threading.Thread(target=self.reconciler.run)
+                reconcile_thread.daemon = True
+                reconcile_thread.start()
+
             listen_thread.join()
             self.observer.join()
         except (KeyboardInterrupt, ConnectionResetError):
@@ -149,18 +346,27 @@ class Client(MessageListener):
     def shutdown(self, message):
         print(message)
         self.message_handler.stop_listening()
-        self.event_handler.on_shutdown()
+        # No events may come up once the coalescer is flushed and the index is closed
         try:
             self.observer.stop()
             self.observer.join()
         except:
             pass
+        self.event_handler.on_shutdown()
+        self.file_index.close()
+        if compression_stats.messages:
+            print(compression_stats.summary())
+        if self.server_list_manager.commit_latencies:
+            print(self.server_list_manager.latency_summary())
+        tracer.dump()
         quit()
 
 if __name__ == "__main__":
     # Parse cmd line args
     parse_command_line_args()
+    if PROFILE:
+        start_profiling(PROFILE, "client", PROFILE_WINDOW)
     # Create Client instance
-    client = Client(CLIENT_DIR, SERVERS)
+    client = Client(CLIENT_DIR, SERVERS, DELTA_SYNC, UPLOAD_CHUNK_SIZE, UPLOAD_WINDOW, SETTLE_WINDOW, COMPRESSION, RECONCILE, MAX_IN_FLIGHT, REPLICATION, WRITE_QUORUM, USERNAME, PASSWORD, MAX_SEND_RATE)
     # Start Client instance
     client.run()
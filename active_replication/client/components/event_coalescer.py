@@ -0,0 +1,261 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+# Class sitting between watchdog and the network: file system events are collected per path and only
+# sent once no new event arrived for the path during the settle window. Bursts of events are merged,
+# e.g. created + modified + closed becomes one upload, created + deleted nothing at all and
+# chained moves a single move.
+class EventCoalescer:
+    def __init__(self, event_handler, settle_window):
+        self.event_handler = event_handler
+        self.settle_window = settle_window # in seconds
+        # Files that never stop changing (e.g. logs) are sent at the latest after max_delay
+        self.max_delay = max(5, settle_window * 10) # in seconds
+        # Path -> pending event, in the order the events first occurred
+        self.pending = OrderedDict()
+        self.condition = threading.Condition()
+        # Events are sent by one thread at a time, in order
+        self.send_lock = threading.Lock()
+
+        self.flush_thread = threading.Thread(target=self.run)
+        self.flush_thread.daemon = True
+        self.flush_thread.start()
+
+    def new_event(self, path, kind, is_directory, src_path=None):
+        now = time.time()
+        event = {
+            "kind": kind,
+            "is_directory": is_directory,
+            "src_path": src_path,
+            # Content changed after a move / directory has to be deleted on the server before being created again
+            "modified": False,
+            "replace": False,
+            "replaced_directory": False,
+            # The server asked for the whole file, it does not have the content a delta or hash refers to
+            "resync": False,
+            "first_event": now,
+            "last_event": now
+        }
+        self.pending[path] = event
+        return event
+
+    def touch(self, event):
+        event["last_event"] = time.time()
+        self.condition.notify()
+
+    def on_created(self, path, is_directory):
+        with self.condition:
+            event = self.pending.get(path)
+            if event is None:
+                event = self.new_event(path, "created", is_directory)
+            elif event["kind"] == "deleted":
+                # Deleted and created again: files are simply overwritten, directories are replaced,
+                # as is anything whose type changed
+                event["kind"] = "created"
+                event["replace"] = is_directory or event["is_directory"]
+                event["replaced_directory"] = event["is_directory"]
+                event["is_directory"] = is_directory
+            elif event["kind"] == "moved":
+                event["modified"] = not is_directory
+            self.touch(event)
+
+    def on_modified(self, path):
+        with self.condition:
+            event = self.pending.get(path)
+            if event is None:
+                event = self.new_event(path, "modified", False)
+            elif event["kind"] == "deleted":
+                event["kind"] = "modified"
+            elif event["kind"] == "moved":
+                event["modified"] = True
+            self.touch(event)
+
+    # Send a file as a whole once more, e.g. when the server asks for it again. The upload happens on the
+    # flush thread, never on the thread receiving the replies it waits for.
+    def on_resync(self, path):
+        with self.condition:
+            self.on_modified(path)
+            event = self.pending[path]
+            if event["kind"] != "created":
+                event["resync"] = True
+
+    def on_deleted(self, path, is_directory):
+        with self.condition:
+            if is_directory:
+                self.drop_children(path)
+            event = self.pending.get(path)
+            if event is None:
+                event = self.new_event(path, "deleted", is_directory)
+            elif event["kind"] == "created" and not event["replace"]:
+                # Never reached the server
+                del self.pending[path]
+            elif event["kind"] == "moved":
+                # The server only knows the file under its old path
+                del self.pending[path]
+                event = self.delete_source(event["src_path"], is_directory)
+            else:
+                event["kind"] = "deleted"
+                event["modified"] = False
+                event["replace"] = False
+                event["resync"] = False
+            self.touch(event)
+
+    def on_moved(self, src_path, dest_path, is_directory):
+        with self.condition:
+            event = self.pending.pop(src_path, None)
+            overwritten = self.pending.pop(dest_path, None)
+            if overwritten is not None and overwritten["kind"] == "moved":
+                self.delete_source(overwritten["src_path"], overwritten["is_directory"])
+            children = self.take_children(src_path) if is_directory else []
+
+            if event is None or event["kind"] == "deleted":
+                moved = self.new_event(dest_path, "moved", is_directory, src_path)
+            elif event["kind"] == "created":
+                if event["replace"]:
+                    self.delete_source(src_path, event["replaced_directory"])
+                moved = self.new_event(dest_path, "created", is_directory)
+            elif event["kind"] == "modified":
+                moved = self.new_event(dest_path, "moved", is_directory, src_path)
+                moved["modified"] = True
+                moved["resync"] = event["resync"]
+            elif event["src_path"] == dest_path:
+                # Moved back to where it came from
+                moved = self.new_event(dest_path, "modified", False) if event["modified"] else None
+            else:
+                moved = self.new_event(dest_path, "moved", is_directory, event["src_path"])
+                moved["modified"] = event["modified"]
+                moved["resync"] = event["resync"]
+
+            # Pending events inside a moved directory now happen after the move, under the new path
+            for path, child in children:
+                if child["src_path"] is not None and is_inside(child["src_path"], src_path):
+                    child["src_path"] = dest_path + child["src_path"][len(src_path):]
+                self.pending[dest_path + path[len(src_path):]] = child
+
+            if moved is not None:
+                self.touch(moved)
+            self.condition.notify()
+
+    # The server still has the file under a path that no longer exists locally
+    def delete_source(self, src_path, is_directory):
+        event = self.pending.get(src_path)
+        if event is None:
+            return self.new_event(src_path, "deleted", is_directory)
+        if event["kind"] == "created":
+            event["replace"] = True
+            event["replaced_directory"] = is_directory
+        return event
+
+    def take_children(self, directory):
+        children = [(path, event) for path, event in self.pending.items() if is_inside(path, directory)]
+        for path, _ in children:
+            del self.pending[path]
+        return children
+
+    # Pending events inside a deleted directory are dropped, files moved into it are deleted at their source
+    def drop_children(self, directory):
+        for _, event in self.take_children(directory):
+            if event["kind"] == "moved" and not is_inside(event["src_path"], directory):
+                self.delete_source(event["src_path"], event["is_directory"])
+
+    # Remove the events that are ready to be sent. Events related to a path still changing wait for it,
+    # so that e.g. a file is never sent before the directory it was created in.
+    def take_settled(self, now, force=False):
+        settled = []
+        waiting = []
+        for path, event in self.pending.items():
+            paths = [path] if event["src_path"] is None else [path, event["src_path"]]
+            ready = (force or now - event["last_event"] >= self.settle_window
+                     or now - event["first_event"] >= self.max_delay)
+            if ready and not any(is_related(a, b) for a in paths for b in waiting):
+                settled.append((path, event))
+            else:
+                waiting.extend(paths)
+        for path, _ in settled:
+            del self.pending[path]
+        return settled
+
+    def next_deadline(self):
+        return min(min(event["last_event"] + self.settle_window, event["first_event"] + self.max_delay)
+                   for event in self.pending.values())
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    now = time.time()
+                    settled = self.take_settled(now)
+                    if settled:
+                        break
+                    self.condition.wait(max(0, self.next_deadline() - now) if self.pending else None)
+            self.send(settled)
+
+    # Whether the calling thread is the one sending the settled events, the only one that may be held back
+    # while too many messages wait for replies
+    def is_flush_thread(self):
+        return threading.current_thread() is self.flush_thread
+
+    # Send all pending events right away, e.g. before disconnecting
+    def flush(self):
+        with self.condition:
+            settled = self.take_settled(time.time(), force=True)
+        self.send(settled)
+
+    def send(self, events):
+        with self.send_lock:
+            for path, event in events:
+                # A failing event must not stop the flush thread, the events after it are still sent
+                try:
+                    self.send_event(path, event)
+                except Exception as e:
+                    print(f"Error syncing {path}: {e}")
+            try:
+                self.event_handler.flush_updates()
+            except Exception as e:
+                print(f"Error sending the batched updates: {e}")
+
+    # Whether events of a path or of paths inside it wait to be sent, or of a directory above it that was
+    # deleted or moved. Directories created above it (e.g. by applying pushed changes) do not count.
+    def has_pending(self, path):
+        path = os.path.abspath(path)
+        with self.condition:
+            for pending_path, event in self.pending.items():
+                pending_path = os.path.abspath(pending_path)
+                if pending_path == path or is_inside(pending_path, path):
+                    return True
+                if is_inside(path, pending_path) and event["kind"] in ("deleted", "moved"):
+                    return True
+            return False
+
+    def send_event(self, path, event):
+        # Changes pushed from other devices of the user are not sent back, unless the server asked for them
+        if not event["resync"] and self.event_handler.push_receiver.is_echo(path, event):
+            return
+        is_directory = event["is_directory"]
+        # Created or modified files that are gone again are covered by a later event
+        exists = os.path.isdir(path) if is_directory else os.path.isfile(path)
+
+        if event["kind"] == "created":
+            if event["replace"]:
+                self.event_handler.send_deleted(path, event["replaced_directory"])
+            if exists:
+                self.event_handler.send_created(path, is_directory)
+        elif event["kind"] == "modified":
+            if exists:
+                self.event_handler.send_modification(path, allow_delta=not event["resync"])
+        elif event["kind"] == "deleted":
+            self.event_handler.send_deleted(path, is_directory)
+        elif event["kind"] == "moved":
+            self.event_handler.send_moved(event["src_path"], path, is_directory)
+            if event["modified"] and exists:
+                self.event_handler.send_modification(path, allow_delta=not event["resync"])
+
+
+def is_inside(path, directory):
+    return path.startswith(directory + os.sep)
+
+
+def is_related(path, other_path):
+    return path == other_path or is_inside(path, other_path) or is_inside(other_path, path)
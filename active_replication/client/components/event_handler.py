@@ -1,11 +1,20 @@
 import os
-import base64
+import hashlib
+import threading
+from collections import deque
 from watchdog.events import FileSystemEventHandler
-from datetime import datetime
 
 import sys
 sys.path.append('../')
-from resources.message_sending import send_message
+from resources.message_sending import send_message, decode_data, pack_batch
+from resources.delta_sync import compute_delta
+from resources.metrics import metrics
+from resources.profiling import tracer
+from resources.temp_files import is_temporary
+from components.file_uploader import FileUploader
+from components.event_coalescer import EventCoalescer
+from components.update_batcher import UpdateBatcher
+from components.push_receiver import PushReceiver
 
 # Class responsible for detecting events and sending sync messages to server
 class EventHandler(FileSystemEventHandler):
@@ -14,42 +23,261 @@ class EventHandler(FileSystemEventHandler):
         self.client = client
         self.client_socket = client.client_socket
         self.client_dir = client.client_dir
-        self.message_count = 0
-        # Keep track of recently created/modified files to catch the successive modified event thrown by watchdog
-        self.recently_changed_files = []
+        # Synced files are recorded in the index, message ids continue where the last run stopped
+        self.file_index = client.file_index
+        self.message_count = self.file_index.get_message_count()
+        self.message_count_lock = threading.Lock()
+        # Paths touched by the last sent messages: (first id, last id, [(relative path, is directory)]),
+        # used to bring a server up to date that missed messages
+        self.sent_log = deque(maxlen=65536)
+        # Set while the changes a server missed are sent again, only to that server
+        self.repair_targets = None
+        # Delta sync settings and pending signature requests (path -> waiting request)
+        self.delta_sync = client.delta_sync
+        self.delta_min_size = 65536
+        self.signature_timeout = 5 # in seconds
+        self.pending_signatures = {}
+        # Files from this size on are first announced by their hash only, in case the server already stores the content
+        self.dedup_min_size = 65536
+        # Large files are streamed in chunks instead of being sent in a single message
+        self.uploader = FileUploader(self, client.upload_chunk_size, client.upload_window)
+        # Small updates are sent in batches of up to 128 messages / 256 KB
+        self.batcher = UpdateBatcher(self.send_batch, 128, 262144)
+        # Events are merged per path and only sent once the path settled
+        self.coalescer = EventCoalescer(self, client.settle_window)
+        # Changes made on other devices of the user are pushed by the servers
+        self.push_receiver = PushReceiver(self.client_dir, self.file_index, self.coalescer)
         super().__init__()
 
-    def register_and_send(self, message):
-        self.client.server_list_manager.register_send_event(datetime.now(), self.message_count)
-        message["id"] = self.message_count
-        self.message_count += 1
-        send_message(self.client_socket, message, self.client.get_servers())
+    # Messages are sent by the coalescer. A batch of `count` messages uses the ids id to last_id and is
+    # acknowledged as a whole. The flush thread of the coalescer waits while too many messages are
+    # unacknowledged, other threads (e.g. flushing on shutdown) never do, so that replies are always read.
+    def register_and_send(self, message, count=1, paths=None):
+        with self.message_count_lock:
+            message_id = self.message_count
+            self.message_count += count
+            self.file_index.set_message_count(self.message_count)
+            self.sent_log.append((message_id, message_id + count - 1, paths if paths is not None else get_paths(message)))
+        targets = self.get_targets()
+        self.client.server_list_manager.register_send_event(message_id, self.coalescer.is_flush_thread(), targets)
+        # Spans of this thread so far (e.g. reading the file) belong to this message
+        tracer.assign(message_id)
+        message["id"] = message_id
+        if count > 1:
+            message["last_id"] = message_id + count - 1
+        send_message(self.client_socket, message, targets)
+        return message_id
+
+    # Servers updates are sent to, only the server being repaired while its missed changes are sent again
+    def get_targets(self):
+        return self.repair_targets or self.client.get_targets()
+
+    # Send an update, small ones are collected into batches
+    def send_update(self, message):
+        labels = {"event_type": message["event_type"]}
+        metrics.inc("updates_sent_total", labels)
+        if message.get("data") is not None:
+            metrics.inc("update_bytes_sent_total", labels, len(message["data"]))
+        if not self.batcher.add(message, self.get_targets()):
+            self.batcher.flush()
+            self.register_and_send(message)
+
+    def send_batch(self, messages):
+        if len(messages) == 1:
+            self.register_and_send(messages[0])
+        else:
+            paths = [path for message in messages for path in get_paths(message)]
+            self.register_and_send(pack_batch(messages), len(messages), paths)
+
+    # Called once the coalescer sent all settled events
+    def flush_updates(self):
+        self.batcher.flush()
 
     # MODIFIED logic
     def on_modified(self, event):
-        if event.is_directory:
+        if event.is_directory or is_temporary_path(event.src_path):
+            return
+        self.coalescer.on_modified(event.src_path)
+
+    # DELETE logic
+    def on_deleted(self, event):
+        if is_temporary_path(event.src_path):
+            return
+        self.coalescer.on_deleted(event.src_path, event.is_directory)
+
+    # CREATED logic
+    def on_created(self, event):
+        if is_temporary_path(event.src_path):
             return
+        self.coalescer.on_created(event.src_path, event.is_directory)
 
-        if event.src_path in self.recently_changed_files:
-            self.recently_changed_files.remove(event.src_path)
+    # MOVED logic
+    def on_moved(self, event):
+        # Moves of the contents of a moved directory are covered by the move of the directory
+        if getattr(event, "is_synthetic", False):
             return
+        # Pushed files are written to a temporary file and moved into place, which creates them
+        if is_temporary_path(event.src_path):
+            self.coalescer.on_created(event.dest_path, event.is_directory)
+            return
+        self.coalescer.on_moved(event.src_path, event.dest_path, event.is_directory)
+
+    # CLOSED logic
+    def on_closed(self, event):
+        self.on_modified(event)
 
-        relative_path = os.path.relpath(event.src_path, self.client_dir)
-        modified_content = self.read_bytes(event.src_path)
-        data_base64 = base64.b64encode(modified_content).decode('utf-8')
+    # Send a modified file, as a delta against the server's copy or as a hash of known content if possible.
+    # Without allow_delta the whole file is sent.
+    def send_modification(self, file_path, allow_delta=True):
+        self.file_index.record(file_path, False)
+        relative_path = os.path.relpath(file_path, self.client_dir)
 
         message = {
             "action": "update",
             "path": relative_path,
-            "event_type": "modified",
-            "data": data_base64
+            "event_type": "modified"
         }
-        self.recently_changed_files.append(event.src_path)
-        self.register_and_send(message)
 
-    # DELETE logic
-    def on_deleted(self, event):
-        relative_path = os.path.relpath(event.src_path, self.client_dir)
+        delta = self.build_delta(file_path, relative_path) if allow_delta else None
+        if delta is not None:
+            message["delta"] = delta["header"]
+            message["data"] = delta["data"]
+            self.file_index.set_synced(file_path, delta["header"]["file_hash"])
+        elif allow_delta and self.send_hash_only(file_path, relative_path, "modified"):
+            return
+        elif self.uploader.should_stream(file_path):
+            self.batcher.flush()
+            self.file_index.set_synced(file_path, self.uploader.upload(file_path, relative_path, "modified"))
+            return
+        else:
+            message["data"] = self.read_bytes(file_path)
+            self.file_index.set_synced(file_path, hashlib.sha256(message["data"]).hexdigest())
+
+        self.send_update(message)
+
+    # Compute a delta against the block signatures of the server's copy (None = send whole file)
+    def build_delta(self, file_path, relative_path):
+        file_size = os.path.getsize(file_path)
+        if not self.delta_sync or file_size < self.delta_min_size:
+            return None
+
+        reply = self.request_signatures(relative_path)
+        if reply is None or not reply["exists"]:
+            return None
+
+        signatures = decode_data(reply["data"])
+        # Only worth it if the delta is noticeably smaller than the file and fits into the upload window
+        max_literal = min(file_size * 0.9, self.uploader.get_window_bytes())
+        delta = compute_delta(file_path, reply["block_size"], signatures, max_literal=max_literal)
+        if delta is None:
+            return None
+
+        return {
+            "header": {
+                "block_size": reply["block_size"],
+                "base_hash": reply["file_hash"],
+                "file_hash": delta["file_hash"]
+            },
+            "data": delta["data"]
+        }
+
+    # Ask the servers for the block signatures of a file and wait for the first answer
+    def request_signatures(self, relative_path):
+        self.batcher.flush()
+        request = {"event": threading.Event(), "reply": None}
+        self.pending_signatures[relative_path] = request
+
+        message = {
+            "action": "signatures",
+            "path": relative_path
+        }
+        send_message(self.client_socket, message, self.get_targets())
+
+        request["event"].wait(self.signature_timeout)
+        self.pending_signatures.pop(relative_path, None)
+        return request["reply"]
+
+    # Called by the client when a server answered a signature request
+    def receive_signatures(self, message):
+        request = self.pending_signatures.get(message["path"])
+        if request is not None and request["reply"] is None:
+            request["reply"] = message
+            request["event"].set()
+
+    # Send only the hash of a file, the server asks for the whole file if it does not store the content yet.
+    # Returns False if the content has to be sent right away.
+    def send_hash_only(self, file_path, relative_path, event_type):
+        if not self.uploader.supports_dedup() or os.path.getsize(file_path) < self.dedup_min_size:
+            return False
+
+        message = {
+            "action": "update",
+            "path": relative_path,
+            "event_type": event_type,
+            "structure": "file",
+            "file_hash": self.file_index.get(file_path)
+        }
+        self.file_index.set_synced(file_path, message["file_hash"])
+        self.send_update(message)
+        return True
+
+    # Called by the client when a server could not apply a delta or does not know a hash and needs the whole file.
+    # Several servers usually ask for the same file at once, their requests are merged by the coalescer.
+    def resync(self, relative_path):
+        file_path = os.path.join(self.client_dir, relative_path)
+        if os.path.isfile(file_path):
+            self.coalescer.on_resync(file_path)
+
+    # Send the current state of every path touched by the messages after last_id to a server that missed them,
+    # the other servers are not sent them again. Returns False if the sent log does not reach back far enough.
+    def replay(self, last_id, server):
+        with self.message_count_lock:
+            if last_id is None:
+                return False
+            if last_id + 1 >= self.message_count:
+                return True
+            if not self.sent_log or self.sent_log[0][0] > last_id + 1:
+                return False
+            touched = {}
+            for first_id, last_message_id, paths in self.sent_log:
+                if last_message_id > last_id:
+                    touched.update(paths)
+
+        # Deletions first, then parents before their children
+        deleted = []
+        existing = []
+        for relative_path, is_directory in touched.items():
+            path = os.path.join(self.client_dir, relative_path)
+            if os.path.lexists(path):
+                existing.append((relative_path.count(os.sep), path))
+            else:
+                deleted.append((path, is_directory))
+
+        # Sent in between the settled events of the coalescer, never batched together with them
+        with self.coalescer.send_lock:
+            self.batcher.flush()
+            self.repair_targets = [server]
+            try:
+                for path, is_directory in deleted:
+                    self.replay_path(path, lambda: self.send_deleted(path, is_directory))
+                for _, path in sorted(existing):
+                    self.replay_path(path, lambda: self.send_created(path, os.path.isdir(path)))
+                self.batcher.flush()
+            finally:
+                self.repair_targets = None
+        return True
+
+    # A path that fails to be sent again is left to the next comparison of the folder
+    def replay_path(self, path, send):
+        try:
+            send()
+        except Exception as e:
+            print(f"Error syncing {path}: {e}")
+
+    # Send a deletion
+    def send_deleted(self, path, is_directory):
+        self.file_index.remove(path)
+        relative_path = os.path.relpath(path, self.client_dir)
 
         message = {
             "action": "update",
@@ -57,16 +285,17 @@ class EventHandler(FileSystemEventHandler):
             "event_type": "deleted"
         }
 
-        if event.is_directory:
+        if is_directory:
             message["structure"] = "dir"
         else:
             message["structure"] = "file"
 
-        self.register_and_send(message)
+        self.send_update(message)
 
-    # CREATED logic
-    def on_created(self, event):
-        relative_path = os.path.relpath(event.src_path, self.client_dir)
+    # Send a created file or directory
+    def send_created(self, path, is_directory):
+        self.file_index.record(path, is_directory)
+        relative_path = os.path.relpath(path, self.client_dir)
 
         message = {
             "action": "update",
@@ -74,23 +303,27 @@ class EventHandler(FileSystemEventHandler):
             "event_type": "created"
         }
 
-        if event.is_directory:
+        if is_directory:
             message["structure"] = "dir"
         else:
-            data_bytes = self.read_bytes(event.src_path)
-            data_base64 = base64.b64encode(data_bytes).decode('utf-8')
+            if self.send_hash_only(path, relative_path, "created"):
+                return
+            if self.uploader.should_stream(path):
+                self.batcher.flush()
+                self.file_index.set_synced(path, self.uploader.upload(path, relative_path, "created"))
+                return
 
             message["structure"] = "file"
-            message["data"] = data_base64
+            message["data"] = self.read_bytes(path)
+            self.file_index.set_synced(path, hashlib.sha256(message["data"]).hexdigest())
 
-            self.recently_changed_files.append(event.src_path)
+        self.send_update(message)
 
-        self.register_and_send(message)
-
-    # MOVED logic
-    def on_moved(self, event):
-        src_relative_path = os.path.relpath(event.src_path, self.client_dir)
-        dest_relative_path = os.path.relpath(event.dest_path, self.client_dir)
+    # Send a move/rename
+    def send_moved(self, src_path, dest_path, is_directory):
+        self.file_index.move(src_path, dest_path)
+        src_relative_path = os.path.relpath(src_path, self.client_dir)
+        dest_relative_path = os.path.relpath(dest_path, self.client_dir)
 
         message = {
             "action": "update",
@@ -99,19 +332,16 @@ class EventHandler(FileSystemEventHandler):
             "event_type": "moved"
         }
 
-        if event.is_directory:
+        if is_directory:
             message["structure"] = "dir"
         else:
             message["structure"] = "file"
 
-        self.register_and_send(message)
-
-    # CLOSED logic
-    def on_closed(self, event):
-        self.on_modified(event)
+        self.send_update(message)
 
     # SHUTDOWN logic
     def on_shutdown(self):
+        self.coalescer.flush()
         message = {
             "action": "disconnect"
         }
@@ -119,5 +349,18 @@ class EventHandler(FileSystemEventHandler):
 
     # Helper function to read files
     def read_bytes(self, file_path):
-        with open(file_path, 'rb') as file:
-            return file.read()
+        with tracer.span_before_id("read_bytes", path=file_path):
+            with open(file_path, 'rb') as file:
+                return file.read()
+
+
+# Paths (relative path, is directory) a message changes on the servers
+def get_paths(message):
+    is_directory = message.get("structure") == "dir"
+    return [(message[key], is_directory) for key in ("path", "src_path", "dest_path")
+            if key in message and message.get("action") in ("update", "upload_start")]
+
+
+# Temporary files (see resources/temp_files.py) are never synchronized
+def is_temporary_path(path):
+    return is_temporary(os.path.basename(path))
@@ -0,0 +1,185 @@
+import os
+import time
+import uuid
+import sqlite3
+import threading
+
+import sys
+sys.path.append('../')
+from resources.delta_sync import hash_file
+
+# Class keeping a persistent index of the synced folder in an SQLite database next to the client directory.
+# It remembers size, modification time, inode and content hash of every file, so that after a restart only
+# files whose stat changed have to be hashed again, which paths were synced before (to detect deletions
+# made while the client was not running) and the hash of the content last sent or received, to tell
+# whether a file was changed locally, on the server or on both sides since.
+class FileIndex:
+    def __init__(self, client_dir):
+        self.client_dir = client_dir
+        client_dir = os.path.abspath(client_dir)
+        self.index_path = os.path.join(os.path.dirname(client_dir), "." + os.path.basename(client_dir) + ".index.db")
+        # The index can always be rebuilt by hashing, so changes are only committed once per interval
+        self.commit_interval = 1 # in seconds
+        self.last_commit = time.time()
+        self.lock = threading.Lock()
+        self.message_count = 0
+
+        self.connection = sqlite3.connect(self.index_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, is_dir INTEGER NOT NULL, "
+                                "size INTEGER, mtime INTEGER, inode INTEGER, hash TEXT, synced_hash TEXT)")
+        # Indexes of earlier versions do not have the synced hashes yet
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(files)")]
+        if "synced_hash" not in columns:
+            self.connection.execute("ALTER TABLE files ADD COLUMN synced_hash TEXT")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value NOT NULL)")
+        row = self.connection.execute("SELECT value FROM state WHERE key = 'message_count'").fetchone()
+        if row is not None:
+            self.message_count = row[0]
+        # Identifies this client folder towards the servers, which log the updates they applied per client id
+        row = self.connection.execute("SELECT value FROM state WHERE key = 'client_id'").fetchone()
+        if row is not None:
+            self.client_id = row[0]
+        else:
+            self.client_id = uuid.uuid4().hex
+            self.connection.execute("INSERT INTO state (key, value) VALUES ('client_id', ?)", (self.client_id,))
+        self.connection.commit()
+
+    def relative_path(self, path):
+        return os.path.relpath(path, self.client_dir)
+
+    # Content hash of a file, only computed if the file changed since it was last hashed.
+    # Same interface as FileHashCache, so that hash trees can be built from the index.
+    def get(self, file_path, stat=None):
+        if stat is None:
+            stat = os.stat(file_path)
+        relative_path = self.relative_path(file_path)
+        with self.lock:
+            row = self.connection.execute("SELECT size, mtime, inode, hash FROM files WHERE path = ?",
+                                          (relative_path,)).fetchone()
+        key = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        if row is not None and row[:3] == key and row[3] is not None:
+            return row[3]
+
+        file_hash = hash_file(file_path)
+        self.store(relative_path, False, key, file_hash)
+        return file_hash
+
+    # Record a file or directory that is being sent to the servers, keeping its hash if it did not change
+    def record(self, path, is_directory, file_hash=None):
+        relative_path = self.relative_path(path)
+        if is_directory:
+            self.store(relative_path, True, (None, None, None), None)
+            return
+        try:
+            stat = os.stat(os.path.join(self.client_dir, relative_path))
+        except OSError:
+            return
+        key = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        if file_hash is None:
+            with self.lock:
+                row = self.connection.execute("SELECT size, mtime, inode, hash FROM files WHERE path = ?",
+                                              (relative_path,)).fetchone()
+            if row is not None and row[:3] == key:
+                file_hash = row[3]
+        self.store(relative_path, False, key, file_hash)
+
+    # Store the stat and hash of an entry, keeping its synced hash
+    def store(self, relative_path, is_directory, key, file_hash):
+        with self.lock:
+            self.connection.execute("INSERT INTO files (path, is_dir, size, mtime, inode, hash) VALUES (?, ?, ?, ?, ?, ?) "
+                                    "ON CONFLICT (path) DO UPDATE SET is_dir = excluded.is_dir, size = excluded.size, "
+                                    "mtime = excluded.mtime, inode = excluded.inode, hash = excluded.hash",
+                                    (relative_path, int(is_directory)) + key + (file_hash,))
+            self.commit_if_due()
+
+    # Remember the hash of the content of a file that was sent to or received from the server
+    def set_synced(self, file_path, file_hash):
+        with self.lock:
+            self.connection.execute("UPDATE files SET synced_hash = ? WHERE path = ?",
+                                    (file_hash, self.relative_path(file_path)))
+            self.commit_if_due()
+
+    # Hash of the content last sent or received, None if unknown
+    def get_synced(self, file_path):
+        with self.lock:
+            row = self.connection.execute("SELECT synced_hash FROM files WHERE path = ?",
+                                          (self.relative_path(file_path),)).fetchone()
+        return row[0] if row is not None else None
+
+    # Forget a deleted file or directory including everything below it
+    def remove(self, path):
+        relative_path = self.relative_path(path)
+        low, high = subtree_range(relative_path)
+        with self.lock:
+            self.connection.execute("DELETE FROM files WHERE path = ? OR (path > ? AND path < ?)",
+                                    (relative_path, low, high))
+            self.commit_if_due()
+
+    # Move the entries of a moved file or directory to the new path
+    def move(self, src_path, dest_path):
+        src_relative_path = self.relative_path(src_path)
+        dest_relative_path = self.relative_path(dest_path)
+        low, high = subtree_range(src_relative_path)
+        with self.lock:
+            rows = self.connection.execute("SELECT path, is_dir, size, mtime, inode, hash, synced_hash FROM files "
+                                           "WHERE path = ? OR (path > ? AND path < ?)",
+                                           (src_relative_path, low, high)).fetchall()
+            self.connection.execute("DELETE FROM files WHERE path = ? OR (path > ? AND path < ?)",
+                                    (src_relative_path, low, high))
+            self.connection.executemany("INSERT OR REPLACE INTO files (path, is_dir, size, mtime, inode, hash, synced_hash) "
+                                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                        [(dest_relative_path + row[0][len(src_relative_path):],) + row[1:] for row in rows])
+            self.commit_if_due()
+
+    # Whether a file or directory existed in the folder before, i.e. was synced by this client
+    def is_known(self, path):
+        relative_path = self.relative_path(path)
+        low, high = subtree_range(relative_path)
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM files WHERE path = ? OR (path > ? AND path < ?) LIMIT 1",
+                                           (relative_path, low, high)).fetchone() is not None
+
+    # Remove the entries of files that no longer exist, e.g. once their deletion was passed on to the servers.
+    # Paths in the given set are known to exist, all others are checked on disk.
+    def prune(self, existing_paths):
+        with self.lock:
+            paths = [row[0] for row in self.connection.execute("SELECT path FROM files")]
+        stale = [(path,) for path in paths
+                 if path not in existing_paths and not os.path.lexists(os.path.join(self.client_dir, path))]
+        with self.lock:
+            self.connection.executemany("DELETE FROM files WHERE path = ?", stale)
+            self.commit_if_due()
+        return len(stale)
+
+    def get_client_id(self):
+        return self.client_id
+
+    # Message ids continue across restarts, so that acknowledged ids stay comparable
+    def get_message_count(self):
+        return self.message_count
+
+    def set_message_count(self, message_count):
+        with self.lock:
+            self.message_count = message_count
+
+    def commit_if_due(self):
+        if time.time() - self.last_commit >= self.commit_interval:
+            self.commit()
+
+    def commit(self):
+        self.connection.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('message_count', ?)",
+                                (self.message_count,))
+        self.connection.commit()
+        self.last_commit = time.time()
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            self.connection.close()
+
+
+# Bounds of the paths inside a directory, so that subtrees can be found with the primary key index
+def subtree_range(relative_path):
+    return relative_path + os.sep, relative_path + chr(ord(os.sep) + 1)
@@ -0,0 +1,102 @@
+import os
+import uuid
+import hashlib
+
+import sys
+sys.path.append('../')
+from resources.profiling import tracer
+
+# Class responsible for streaming large files to the servers in fixed-size chunks,
+# so that a file never has to be held in memory as a whole
+class FileUploader:
+    def __init__(self, event_handler, chunk_size, window):
+        self.event_handler = event_handler
+        self.server_list_manager = event_handler.client.server_list_manager
+        self.chunk_size = chunk_size
+        self.window = window
+        self.ack_timeout = 10 # in seconds
+        # Upload limits announced by each server at login (None = server cannot receive streamed uploads)
+        self.server_limits = {}
+
+    # Remember the upload limits a server announced in its login reply
+    def set_server_limits(self, server_address, limits):
+        self.server_limits[server_address] = limits
+
+    # Chunk size and window usable with all servers uploads are sent to, None if one of them does not support streaming
+    def get_limits(self):
+        chunk_size, window = self.chunk_size, self.window
+        for server in self.event_handler.get_targets():
+            limits = self.server_limits.get(server)
+            if limits is None:
+                return None
+            chunk_size = min(chunk_size, limits["max_chunk_size"])
+            window = min(window, limits["window"])
+        return chunk_size, window
+
+    # Whether all servers uploads are sent to can create files from content they already store, given only the hash
+    def supports_dedup(self):
+        for server in self.event_handler.get_targets():
+            limits = self.server_limits.get(server)
+            if limits is None or not limits.get("dedup", False):
+                return False
+        return True
+
+    # Decide whether a file is large enough to be streamed
+    def should_stream(self, file_path):
+        limits = self.get_limits()
+        return limits is not None and os.path.getsize(file_path) > limits[0]
+
+    # Maximum number of bytes that may be in flight at once
+    def get_window_bytes(self):
+        limits = self.get_limits()
+        if limits is None:
+            return self.chunk_size * self.window
+        return limits[0] * limits[1]
+
+    # Stream a file: start message, one message per chunk and an end message.
+    # Only `window` chunks may wait for their acknowledgement at any time. Returns the hash of the sent content.
+    def upload(self, file_path, relative_path, event_type):
+        chunk_size, window = self.get_limits()
+        upload_id = uuid.uuid4().hex
+        file_hasher = hashlib.sha256()
+
+        self.event_handler.register_and_send({
+            "action": "upload_start",
+            "upload_id": upload_id,
+            "path": relative_path,
+            "event_type": event_type,
+            "size": os.path.getsize(file_path)
+        })
+
+        in_flight = []
+        sequence = 0
+        offset = 0
+        with open(file_path, 'rb') as file:
+            while True:
+                with tracer.span_before_id("read_bytes", path=relative_path):
+                    chunk = file.read(chunk_size)
+                if not chunk:
+                    break
+                if len(in_flight) >= window:
+                    in_flight = self.server_list_manager.wait_for_replies(in_flight, window - 1, self.ack_timeout)
+
+                message_id = self.event_handler.register_and_send({
+                    "action": "upload_chunk",
+                    "upload_id": upload_id,
+                    "seq": sequence,
+                    "offset": offset,
+                    "data": chunk
+                })
+                in_flight.append(message_id)
+                file_hasher.update(chunk)
+                sequence += 1
+                offset += len(chunk)
+
+        self.event_handler.register_and_send({
+            "action": "upload_end",
+            "upload_id": upload_id,
+            "chunks": sequence,
+            "size": offset,
+            "file_hash": file_hasher.hexdigest()
+        })
+        return file_hasher.hexdigest()
@@ -1,51 +1,294 @@
-from datetime import datetime
 import os
+import time
+import heapq
+import threading
+from collections import deque
 
-# Class for keeping the server list up to date with active replication
+import sys
+sys.path.append('../')
+from resources.metrics import metrics
+from resources.profiling import tracer
+
+# Class for keeping the server list up to date with active replication. Servers that do not reply in time
+# or shut down are left out until they caught up: the client regularly logs in to them again, and once
+# one answers, it is sent the updates it missed and added back to the list. Servers still being sent earlier
+# messages, held back by congestion control, are given more time as long as they acknowledge the fragments.
+# With a write quorum, a message is committed once that many servers replied. Servers that reply later are
+# waited for in the background, and those that missed the message are sent the changes since then again,
+# without holding up the client or being removed from the list.
+# In primary mode, updates are only sent to the first server in the list that forwards them to the others,
+# if none of them does, to all servers as with active replication.
 class ServerListManager:
-    def __init__(self, servers, client):
+    def __init__(self, servers, client, max_in_flight=1024, primary=False, write_quorum=None):
         self.client = client
         self.servers = servers
+        self.primary = primary
+        # Number of replies that commit a message, all servers it was sent to by default
+        self.write_quorum = write_quorum
+        # Servers that accepted to forward the updates of this client
+        self.primary_servers = set()
+        # Messages waiting for replies: message id -> deadline and servers that did not reply yet
         self.reply_log = {}
+        # Committed messages still waiting for replies of slower servers: message id -> deadline and servers
+        self.stragglers = {}
+        # (deadline, message id) of the sent messages, acknowledged ones are skipped once they come up
+        self.deadlines = []
+        # Seconds from sending messages until they were committed and until all servers replied
+        self.commit_latencies = deque(maxlen=65536)
+        self.complete_latencies = deque(maxlen=65536)
         self.server_timeout = 5 # in seconds
+        # Senders are blocked while this many messages wait for replies
+        self.max_in_flight = max_in_flight
+        # Servers left out: server -> time of the last attempt to log in again
+        self.lagging = {}
+        # Servers that missed committed messages: server -> time the changes were sent again
+        self.repairing = {}
+        self.probe_interval = 2 # in seconds
+        # Notified whenever a message has been acknowledged by all servers or timed out
+        self.reply_condition = threading.Condition()
+
+        # Timed out messages are handled in the background, only when their deadline is due
+        timeout_thread = threading.Thread(target=self.run_timeouts)
+        timeout_thread.daemon = True
+        timeout_thread.start()
 
     def get_servers(self):
         return self.servers
-    
-    # Register when a message was sent
-    def register_send_event(self, timestamp, message_id):
-        self.reply_log[message_id] = {
-            "timestamp": timestamp,
-            "pending_servers": self.servers.copy()
-        }
+
+    # Servers updates are sent to
+    def get_targets(self):
+        if self.primary:
+            for server in self.servers:
+                if server in self.primary_servers:
+                    return [server]
+        return self.servers
+
+    # Remember whether a server forwards the updates of this client, as announced in its login reply
+    def set_replication(self, server, replication):
+        with self.reply_condition:
+            if replication == "primary":
+                self.primary_servers.add(server)
+            else:
+                self.primary_servers.discard(server)
+
+    # Register when a message was sent to the given servers, all servers updates are sent to by default.
+    # With backpressure, blocks while too many messages wait for replies, at the latest until the oldest
+    # of them timed out. Never used on the thread reading the replies.
+    def register_send_event(self, message_id, backpressure=True, targets=None):
+        with self.reply_condition:
+            deadline = time.monotonic() + self.server_timeout
+            while backpressure and len(self.reply_log) >= self.max_in_flight and time.monotonic() < deadline:
+                self.reply_condition.wait(deadline - time.monotonic())
+
+            now = time.monotonic()
+            deadline = now + self.server_timeout
+            targets = self.get_targets() if targets is None else targets
+            self.reply_log[message_id] = {
+                "deadline": deadline,
+                "sent": now,
+                "pending_servers": set(targets),
+                "quorum": len(targets) if self.write_quorum is None else min(self.write_quorum, len(targets))
+            }
+            heapq.heappush(self.deadlines, (deadline, message_id))
+            # Wake up the timeout thread if it waits for nothing
+            if len(self.deadlines) == 1:
+                self.reply_condition.notify_all()
         if os.environ["DEBUG"] == "on":
-            print(self.reply_log)
+            print("Message {} sent, {} waiting for replies".format(message_id, len(self.reply_log)))
+
+    # Remove the servers that did not reply to a message within the specified timeout window
+    # and regularly try to bring back the ones that were removed
+    def run_timeouts(self):
+        while True:
+            with self.reply_condition:
+                while True:
+                    now = time.monotonic()
+                    timed_out, repairs = self.take_timed_out(now)
+                    probes = self.take_due_probes(now)
+                    if timed_out or probes or repairs:
+                        break
+                    self.reply_condition.wait(self.next_wakeup(now))
+
+            for server in timed_out:
+                print("Server {} timed out and has been removed from the server list until it caught up.".format(server))
+                self.remove_server(server)
+            for server in probes:
+                self.client.probe_server(server)
+            for server, message_id in repairs:
+                print("Server {} missed committed updates and is sent them again.".format(server))
+                self.client.repair_server(server, message_id)
+
+    # Seconds until the next deadline or login attempt, None if there is nothing to wait for
+    def next_wakeup(self, now):
+        wakeups = [probe_time + self.probe_interval for probe_time in self.lagging.values()]
+        if self.deadlines:
+            wakeups.append(self.deadlines[0][0])
+        return max(0, min(wakeups) - now) if wakeups else None
 
-    # Check if any servers did not reply to the message within the specified timeout window
-    def check_server_timeouts(self):
-        for _, msg_data in self.reply_log.items():
-            diff = datetime.now() - msg_data["timestamp"]
-            if diff.total_seconds() >= self.server_timeout:
+    def take_due_probes(self, now):
+        probes = [server for server, probe_time in self.lagging.items() if now - probe_time >= self.probe_interval]
+        for server in probes:
+            self.lagging[server] = now
+        return probes
+
+    # Drop the messages whose deadline passed. Returns the active servers that did not reply to uncommitted
+    # messages, which are removed, and the ones that did not reply to committed messages with the first missed
+    # message id, which are repaired. A server not replying to anything since its repair is removed as well.
+    def take_timed_out(self, now):
+        timed_out = []
+        repairs = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, message_id = heapq.heappop(self.deadlines)
+            msg_data = self.reply_log.get(message_id)
+            if msg_data is not None:
+                busy = False
                 for server in msg_data["pending_servers"]:
-                    print("Server {} timed out and has been removed from the server list.".format(server))
-                    if server in self.servers: self.remove_server(server)
+                    if server in self.servers and self.client.is_sending_to(server):
+                        busy = True
+                    elif server in self.servers and server not in timed_out:
+                        timed_out.append(server)
+                if busy:
+                    msg_data["deadline"] = now + self.server_timeout
+                    heapq.heappush(self.deadlines, (msg_data["deadline"], message_id))
+                else:
+                    del self.reply_log[message_id]
+                self.reply_condition.notify_all()
+                continue
+            msg_data = self.stragglers.pop(message_id, None)
+            if msg_data is None:
+                continue
+            busy = set()
+            for server in msg_data["pending_servers"]:
+                if server not in self.servers or server in timed_out:
+                    continue
+                if self.client.is_sending_to(server):
+                    busy.add(server)
+                elif server not in self.repairing:
+                    self.repairing[server] = now
+                    repairs.append((server, message_id))
+                elif now - self.repairing[server] >= self.server_timeout:
+                    timed_out.append(server)
+            # Servers still being sent earlier messages are waited for longer, the others are repaired
+            if busy:
+                msg_data["pending_servers"] = busy
+                msg_data["deadline"] = now + self.server_timeout
+                self.stragglers[message_id] = msg_data
+                heapq.heappush(self.deadlines, (msg_data["deadline"], message_id))
+        return timed_out, repairs
 
     # Add logic to remove server and shutdown, if no servers are left
     def remove_server(self, removed_server):
-        self.servers.remove(removed_server)
-        if len(self.servers) == 0:
+        with self.reply_condition:
+            if removed_server not in self.servers:
+                return
+            targets = self.get_targets()
+            self.servers.remove(removed_server)
+            self.repairing.pop(removed_server, None)
+            self.lagging[removed_server] = time.monotonic()
+            # Messages only waiting for the removed server count as acknowledged now
+            for message_id, msg_data in list(self.reply_log.items()):
+                msg_data["pending_servers"].discard(removed_server)
+                if not msg_data["pending_servers"]:
+                    del self.reply_log[message_id]
+            for message_id, msg_data in list(self.stragglers.items()):
+                msg_data["pending_servers"].discard(removed_server)
+                if not msg_data["pending_servers"]:
+                    del self.stragglers[message_id]
+            self.reply_condition.notify_all()
+            servers_left = len(self.servers)
+            new_targets = self.get_targets()
+
+        if servers_left == 0:
             self.client.shutdown("All servers disconnected. Closing client...")
         else:
             print("Server {} disconnected. Still enough backups available.".format(removed_server))
+            if self.primary and targets == [removed_server]:
+                self.client.fail_over(new_targets)
+            elif targets[:1] == [removed_server]:
+                self.client.follow_pushes(new_targets[0])
+
+    # Add a removed server back to the list once it answered again, returns False if it was not removed
+    def readmit(self, server):
+        with self.reply_condition:
+            if server not in self.lagging:
+                return False
+            del self.lagging[server]
+            self.servers.append(server)
+            self.reply_condition.notify_all()
+        print("Server {} is reachable again and has been added back to the server list.".format(server))
+        return True
 
-    # Register 
+    # Register
     def register_reply(self, msg_id, server_address):
-        self.check_server_timeouts()
-        if server_address in self.reply_log[msg_id]["pending_servers"]:
-            self.reply_log[msg_id]["pending_servers"].remove(server_address)
-            if os.environ["DEBUG"] == "on": 
+        with self.reply_condition:
+            msg_data = self.reply_log.get(msg_id)
+            if msg_data is None:
+                msg_data = self.stragglers.get(msg_id)
+            # Late replies to messages that already timed out are ignored
+            if msg_data is None or server_address not in msg_data["pending_servers"]:
+                return
+            msg_data["pending_servers"].remove(server_address)
+            self.repairing.pop(server_address, None)
+            if os.environ["DEBUG"] == "on":
                 print("Reply for message {} received from {}".format(msg_id, server_address))
-        
-        # Remove msg_id from reply_log if all messages have been acknowledged
-        if len(self.reply_log[msg_id]["pending_servers"]) == 0:
-            del self.reply_log[msg_id]
+
+            # The message is committed once the quorum replied, the remaining servers are waited for separately
+            latency = time.monotonic() - msg_data["sent"]
+            metrics.observe("ack_latency_seconds", latency, {"server": "{}:{}".format(*server_address)})
+            replied = time.perf_counter()
+            tracer.record("round_trip", replied - latency, replied, msg_id, {"server": server_address})
+            if msg_id in self.reply_log:
+                msg_data["quorum"] -= 1
+                if msg_data["quorum"] <= 0 or not msg_data["pending_servers"]:
+                    del self.reply_log[msg_id]
+                    self.commit_latencies.append(latency)
+                    metrics.observe("commit_latency_seconds", latency)
+                    if msg_data["pending_servers"]:
+                        self.stragglers[msg_id] = msg_data
+                    self.reply_condition.notify_all()
+            if not msg_data["pending_servers"]:
+                self.stragglers.pop(msg_id, None)
+                self.complete_latencies.append(latency)
+
+    # Check whether a message still waits for a reply of a server in the server list
+    def is_pending(self, msg_id):
+        msg_data = self.reply_log.get(msg_id)
+        if msg_data is None:
+            return False
+        return any(server in self.servers for server in msg_data["pending_servers"])
+
+    # Block until at most max_pending of the given messages wait for replies, returns the ones still pending
+    def wait_for_replies(self, msg_ids, max_pending, timeout):
+        deadline = time.time() + timeout
+        with self.reply_condition:
+            while True:
+                pending = [msg_id for msg_id in msg_ids if self.is_pending(msg_id)]
+                remaining = deadline - time.time()
+                if len(pending) <= max_pending or remaining <= 0:
+                    return pending
+                self.reply_condition.wait(remaining)
+
+    # Percentiles of the commit latencies and of the latencies until all servers replied, in milliseconds
+    def get_latency_stats(self):
+        with self.reply_condition:
+            commit_latencies = sorted(self.commit_latencies)
+            complete_latencies = sorted(self.complete_latencies)
+        return {
+            "write_quorum": self.write_quorum,
+            "messages": len(commit_latencies),
+            "commit": {f"p{p}": get_percentile(commit_latencies, p) * 1000 for p in (50, 90, 99)},
+            "all_replicas": {f"p{p}": get_percentile(complete_latencies, p) * 1000 for p in (50, 90, 99)}
+        }
+
+    def latency_summary(self):
+        stats = self.get_latency_stats()
+        commit = ", ".join(f"{name} {value:.1f} ms" for name, value in stats["commit"].items())
+        complete = ", ".join(f"{name} {value:.1f} ms" for name, value in stats["all_replicas"].items())
+        return f"{stats['messages']} messages committed: {commit}; all servers replied: {complete}"
+
+
+# Value below which the given percentage of the sorted values lies, 0 without values
+def get_percentile(values, percent):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
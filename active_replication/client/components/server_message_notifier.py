@@ -1,9 +1,8 @@
 import sys
-import json
 import threading
 
 sys.path.append('../')
-from resources.message_sending import receive_message
+from resources.message_sending import receive_message, load_message
 
 # Class responsible for handling server messages
 class ServerMessageNotifier:
@@ -31,10 +30,10 @@ class ServerMessageNotifier:
                     break
                 try:     
                     for item in messages:
-                        message = json.loads(item)
+                        message = load_message(item)
                         self.notify_listeners(message, server_address)
-                except json.JSONDecodeError:
-                    print("Error decoding JSON message")
+                except ValueError:
+                    print("Error decoding message")
         except (KeyboardInterrupt, ConnectionResetError):
             quit()
 
@@ -0,0 +1,262 @@
+import os
+import math
+import zlib
+import struct
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Helper script implementing rsync-style block signatures and deltas, so that modified files
+# can be synced by sending only the changed bytes plus references to blocks the server already has
+
+MIN_BLOCK_SIZE = 2048
+MAX_BLOCK_SIZE = 131072
+READ_SIZE = 1048576
+ADLER_MOD = 65521
+
+# Signature entry: weak rolling checksum (adler32) and strong hash of one block
+SIGNATURE_ENTRY = struct.Struct("!I16s")
+# Delta operations: copy <count> blocks starting at <block index> / insert <length> literal bytes
+COPY_OP = struct.Struct("!cQI")
+DATA_OP = struct.Struct("!cI")
+
+
+# Pick a block size growing with the square root of the file size (same heuristic as rsync)
+def choose_block_size(file_size):
+    block_size = int(math.sqrt(file_size)) // 8 * 8
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block_size))
+
+
+def strong_hash(block):
+    return hashlib.blake2b(block, digest_size=16).digest()
+
+
+# SHA-256 of a whole file, read in pieces
+def hash_file(file_path):
+    file_hasher = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        while True:
+            data = file.read(READ_SIZE)
+            if not data:
+                break
+            file_hasher.update(data)
+    return file_hasher.hexdigest()
+
+
+# Compute the block signatures of a file together with the hash of its whole content
+def compute_signatures(file_path, block_size=None):
+    if block_size is None:
+        block_size = choose_block_size(os.path.getsize(file_path))
+
+    entries = bytearray()
+    file_hasher = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        while True:
+            block = file.read(block_size)
+            if not block:
+                break
+            file_hasher.update(block)
+            entries += SIGNATURE_ENTRY.pack(zlib.adler32(block), strong_hash(block))
+
+    return {
+        "block_size": block_size,
+        "file_hash": file_hasher.hexdigest(),
+        "signatures": bytes(entries)
+    }
+
+
+# Build a lookup table weak checksum -> [(block index, strong hash)]
+def index_signatures(signatures):
+    index = {}
+    for block_index, (weak, strong) in enumerate(SIGNATURE_ENTRY.iter_unpack(signatures)):
+        index.setdefault(weak, []).append((block_index, strong))
+    return index
+
+
+# Collects delta operations, merging adjacent copies and literals
+class DeltaWriter:
+    def __init__(self):
+        self.output = bytearray()
+        self.literal = bytearray()
+        self.copy_start = None
+        self.copy_count = 0
+        self.literal_bytes = 0
+
+    def add_literal(self, data):
+        if not data:
+            return
+        self.flush_copy()
+        self.literal += data
+        self.literal_bytes += len(data)
+
+    def add_copy(self, block_index):
+        self.flush_literal()
+        if self.copy_start is not None and self.copy_start + self.copy_count == block_index:
+            self.copy_count += 1
+            return
+        self.flush_copy()
+        self.copy_start = block_index
+        self.copy_count = 1
+
+    def flush_literal(self):
+        if self.literal:
+            self.output += DATA_OP.pack(b'D', len(self.literal))
+            self.output += self.literal
+            self.literal = bytearray()
+
+    def flush_copy(self):
+        if self.copy_start is not None:
+            self.output += COPY_OP.pack(b'C', self.copy_start, self.copy_count)
+            self.copy_start = None
+            self.copy_count = 0
+
+    def getvalue(self):
+        self.flush_literal()
+        self.flush_copy()
+        return bytes(self.output)
+
+
+# Compute the delta turning the file described by the signatures into the local file.
+# Returns None if more than max_literal bytes would have to be sent literally.
+def compute_delta(file_path, block_size, signatures, max_literal=None):
+    index = index_signatures(signatures)
+    last_block_index = len(signatures) // SIGNATURE_ENTRY.size - 1
+    writer = DeltaWriter()
+    file_hasher = hashlib.sha256()
+
+    def find_block(weak, window):
+        candidates = index.get(weak)
+        if not candidates:
+            return None
+        strong = strong_hash(window)
+        for block_index, candidate in candidates:
+            if candidate == strong:
+                return block_index
+        return None
+
+    with open(file_path, 'rb') as file:
+        buffer = b""
+        pos = 0
+        literal_start = 0
+        weak = None
+        eof = False
+
+        while True:
+            # Keep at least one block plus one byte ahead of the current position
+            if not eof and len(buffer) - pos <= block_size:
+                writer.add_literal(buffer[literal_start:pos])
+                chunk = file.read(READ_SIZE)
+                file_hasher.update(chunk)
+                eof = not chunk
+                buffer = buffer[pos:] + chunk
+                pos = literal_start = 0
+                continue
+
+            if max_literal is not None and writer.literal_bytes + pos - literal_start > max_literal:
+                return None
+
+            window_end = pos + block_size
+            if window_end > len(buffer):
+                # Less than one block left, which can only match the (shorter) last block
+                tail = buffer[pos:]
+                block_index = find_block(zlib.adler32(tail), tail) if tail else None
+                if block_index == last_block_index:
+                    writer.add_literal(buffer[literal_start:pos])
+                    writer.add_copy(block_index)
+                else:
+                    writer.add_literal(buffer[literal_start:])
+                break
+
+            if weak is None:
+                weak = zlib.adler32(buffer[pos:window_end])
+
+            block_index = find_block(weak, buffer[pos:window_end])
+            if block_index is not None:
+                writer.add_literal(buffer[literal_start:pos])
+                writer.add_copy(block_index)
+                pos = literal_start = window_end
+                weak = None
+                continue
+
+            if window_end == len(buffer):
+                # Window reaches the end of the file without matching
+                writer.add_literal(buffer[literal_start:])
+                break
+
+            # Roll the weak checksum one byte forward
+            out_byte = buffer[pos]
+            in_byte = buffer[window_end]
+            a = ((weak & 0xffff) - out_byte + in_byte) % ADLER_MOD
+            b = ((weak >> 16) - block_size * out_byte + a - 1) % ADLER_MOD
+            weak = (b << 16) | a
+            pos += 1
+
+    if max_literal is not None and writer.literal_bytes > max_literal:
+        return None
+
+    return {
+        "file_hash": file_hasher.hexdigest(),
+        "data": writer.getvalue()
+    }
+
+
+# Reconstruct a file from the base file and a delta, returning the hash of the result
+def apply_delta(base_path, delta, block_size, output_path):
+    file_hasher = hashlib.sha256()
+    view = memoryview(delta)
+    pos = 0
+
+    with open(base_path, 'rb') as base_file, open(output_path, 'wb') as output_file:
+        while pos < len(view):
+            op = bytes(view[pos:pos + 1])
+            if op == b'C':
+                _, block_index, count = COPY_OP.unpack_from(view, pos)
+                pos += COPY_OP.size
+                base_file.seek(block_index * block_size)
+                remaining = count * block_size
+                while remaining > 0:
+                    data = base_file.read(min(remaining, READ_SIZE))
+                    if not data:
+                        break
+                    file_hasher.update(data)
+                    output_file.write(data)
+                    remaining -= len(data)
+            elif op == b'D':
+                _, length = DATA_OP.unpack_from(view, pos)
+                pos += DATA_OP.size
+                data = view[pos:pos + length]
+                pos += length
+                file_hasher.update(data)
+                output_file.write(data)
+            else:
+                raise ValueError("Invalid delta operation {}".format(op))
+
+    return file_hasher.hexdigest()
+
+
+# Server side cache of block signatures, invalidated when the file changes on disk
+class SignatureCache:
+    def __init__(self, max_entries=256):
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+    def get(self, file_path):
+        stat = os.stat(file_path)
+        key = (stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            cached = self.entries.get(file_path)
+            if cached is not None and cached[0] == key:
+                self.entries.move_to_end(file_path)
+                return cached[1]
+
+        signatures = compute_signatures(file_path)
+        with self.lock:
+            self.entries[file_path] = (key, signatures)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return signatures
+
+    def invalidate(self, file_path):
+        with self.lock:
+            self.entries.pop(file_path, None)
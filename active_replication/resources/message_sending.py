@@ -1,35 +1,290 @@
 import json
 import os
+import base64
+import time
+import struct
+import threading
+import weakref
+
+from resources.reliable_transport import ReliableTransport
+from resources.compression import compress_message, decompress_message
+from resources.metrics import metrics
+from resources.profiling import tracer
 
 # Helper script that defines functions for both sending and receiving messages on client and server side
 
+# Wire protocols: the original newline-delimited JSON and versioned, length-prefixed binary frames.
+# Clients offer the protocols they speak at login and the server picks one, so old clients keep working.
+JSON_PROTOCOL = "json"
+BINARY_PROTOCOL = "binary/1"
+SUPPORTED_PROTOCOLS = [BINARY_PROTOCOL, JSON_PROTOCOL]
+
+# Transports: plain datagrams (original) or the reliable, fragmenting transport, negotiated at login as well
+DATAGRAM_TRANSPORT = "datagram"
+RELIABLE_TRANSPORT = "reliable/1"
+SUPPORTED_TRANSPORTS = [RELIABLE_TRANSPORT, DATAGRAM_TRANSPORT]
+
+# Binary frame: fixed header, compact JSON metadata, raw (not base64 encoded) payload
+# Header: magic, version, flags, message type, message id, metadata length, payload length
+FRAME_MAGIC = b"FH"
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct("!2sBBBIIQ")
+FLAG_HAS_ID = 0x01
+FLAG_HAS_PAYLOAD = 0x02
+
+# Message types carried in the header, the action of any other message stays in the metadata (type 0)
+MESSAGE_TYPES = ["", "login", "update", "received", "disconnect", "shutdown", "signatures", "resync", "batch"]
+
+MAX_DATAGRAM_SIZE = 65536
+
+# Per socket state: protocol, compressions and transport negotiated with each peer, reliable transport of the socket
+class SocketState:
+    def __init__(self, socket):
+        self.socket = socket
+        self.protocols = {}
+        self.compressions = {}
+        self.transports = {}
+        self.transport = None
+        self.lock = threading.Lock()
+
+    def get_transport(self):
+        with self.lock:
+            if self.transport is None:
+                self.transport = ReliableTransport(self.socket)
+            return self.transport
+
+socket_states = weakref.WeakKeyDictionary()
+socket_states_lock = threading.Lock()
+
+def get_socket_state(socket):
+    with socket_states_lock:
+        state = socket_states.get(socket)
+        if state is None:
+            state = SocketState(socket)
+            socket_states[socket] = state
+        return state
+
+def set_protocol(socket, protocol, address):
+    get_socket_state(socket).protocols[address] = protocol
+
+def get_protocol(socket, address):
+    return get_socket_state(socket).protocols.get(address, JSON_PROTOCOL)
+
+# Compression algorithms the peer can decode
+def set_compressions(socket, compressions, address):
+    get_socket_state(socket).compressions[address] = compressions or []
+
+def get_compressions(socket, address):
+    return get_socket_state(socket).compressions.get(address, [])
+
+def set_transport(socket, transport, address):
+    get_socket_state(socket).transports[address] = transport
+
+def get_transport(socket, address):
+    return get_socket_state(socket).transports.get(address, DATAGRAM_TRANSPORT)
+
+# Forget the protocol and transport negotiated with a peer that disconnected
+def reset_protocol(socket, address):
+    state = get_socket_state(socket)
+    state.protocols.pop(address, None)
+    state.compressions.pop(address, None)
+    if state.transports.pop(address, None) == RELIABLE_TRANSPORT:
+        state.get_transport().remove_peer(address)
+
+# Cap the bytes per second a socket sends to all peers together, None for no cap
+def set_max_send_rate(socket, max_rate):
+    get_socket_state(socket).get_transport().set_max_rate(max_rate)
+
+# Whether earlier messages are still being delivered to a peer that keeps acknowledging them
+def is_sending(socket, address):
+    if get_transport(socket, address) != RELIABLE_TRANSPORT:
+        return False
+    return get_socket_state(socket).get_transport().is_sending(address)
+
+# Congestion windows and smoothed round trip times of the peers of the reliable transport, by "host:port"
+def get_transport_stats(socket):
+    stats = get_socket_state(socket).get_transport().get_stats()
+    windows = {"{}:{}".format(*address): int(window) for address, (window, _) in stats.items()}
+    round_trip_times = {"{}:{}".format(*address): rtt for address, (_, rtt) in stats.items() if rtt is not None}
+    return windows, round_trip_times
+
+# Pick the first protocol offered by the client that is supported here
+def negotiate_protocol(offered_protocols):
+    for protocol in offered_protocols or []:
+        if protocol in SUPPORTED_PROTOCOLS:
+            return protocol
+    return JSON_PROTOCOL
+
+# Pick the first transport offered by the client that is supported here
+def negotiate_transport(offered_transports):
+    for transport in offered_transports or []:
+        if transport in SUPPORTED_TRANSPORTS:
+            return transport
+    return DATAGRAM_TRANSPORT
+
 # Send messages via UDP/IP sockets
 def send_message(socket, message, receiver_address):
     if os.environ["DEBUG"] == "on":
         print("sending:", message)
-    # Serialize the message to JSON
-    message_json = dump_message(message)
-    
-    # Send the message to the server
-    for chunk in split_into_chunks(message_json, 65536):
-        if type(receiver_address) == list:
-            for receiver in receiver_address:
-                socket.sendto(chunk.encode(), receiver)
-        else:
-            socket.sendto(chunk.encode(), receiver_address)
+    if type(receiver_address) == list:
+        receivers = receiver_address
+    else:
+        receivers = [receiver_address]
+
+    # Serialize (and compress) the message once per protocol and compressions of the receivers
+    encoded_messages = {}
+    labels = {"action": message.get("action")}
+    for receiver in receivers:
+        encoding = (get_protocol(socket, receiver), tuple(get_compressions(socket, receiver)))
+        if encoding not in encoded_messages:
+            with metrics.timer("message_encode_seconds", labels):
+                with tracer.span("compress", message.get("id")):
+                    compressed_message = compress_message(message, encoding[1])
+                encoded_messages[encoding] = encode_message(compressed_message, encoding[0])
+        metrics.inc("messages_sent_total", labels)
+        metrics.inc("message_bytes_sent_total", labels, len(encoded_messages[encoding]))
+
+        # Send the message to the server
+        with tracer.span("send", message.get("id"), action=message.get("action"), to=receiver):
+            if get_transport(socket, receiver) == RELIABLE_TRANSPORT:
+                get_socket_state(socket).get_transport().send(encoded_messages[encoding], receiver)
+            else:
+                for chunk in split_into_chunks(encoded_messages[encoding], MAX_DATAGRAM_SIZE):
+                    get_socket_state(socket).get_transport().throttle(len(chunk))
+                    socket.sendto(chunk, receiver)
+
+# Serialize a message into the byte strings to be sent
+def encode_message(message, protocol=JSON_PROTOCOL):
+    if protocol == BINARY_PROTOCOL:
+        return encode_frame(message)
+    return dump_message(message).encode()
 
 def dump_message(message):
-    # Dump message and add delimiter
-    return json.dumps(message) + '\n'
+    # Dump message and add delimiter, binary data is sent base64 encoded
+    data = message.get("data")
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        with tracer.span("base64", message.get("id")):
+            message = dict(message, data=encode_bytes(data))
+    with tracer.span("json.dumps", message.get("id")):
+        return json.dumps(message, default=encode_bytes) + '\n'
+
+def encode_bytes(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(value).decode('utf-8')
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def encode_frame(message):
+    metadata = dict(message)
+    flags = 0
+
+    message_type = 0
+    if metadata.get("action") in MESSAGE_TYPES:
+        message_type = MESSAGE_TYPES.index(metadata.pop("action"))
+
+    message_id = 0
+    if isinstance(metadata.get("id"), int) and 0 <= metadata["id"] < 2 ** 32:
+        message_id = metadata.pop("id")
+        flags |= FLAG_HAS_ID
+
+    payload = b""
+    if isinstance(metadata.get("data"), (bytes, bytearray, memoryview)):
+        payload = metadata.pop("data")
+        flags |= FLAG_HAS_PAYLOAD
+
+    with tracer.span("json.dumps", message.get("id")):
+        encoded_metadata = json.dumps(metadata, separators=(',', ':'), default=encode_bytes).encode()
+    header = FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, flags, message_type, message_id,
+                               len(encoded_metadata), len(payload))
+
+    return header + encoded_metadata + payload
+
+def is_frame(data):
+    return data[:2] == FRAME_MAGIC
+
+# Turn one received message (JSON line or binary frame) into a message dictionary
+def load_message(data):
+    start = time.perf_counter()
+    message = parse_message(data)
+    end = time.perf_counter()
+    labels = {"action": message.get("action")}
+    metrics.observe("message_decode_seconds", end - start, labels)
+    # The id is only known once the message is parsed
+    tracer.record("parse_frame" if is_frame(data) else "json.loads", start, end, message.get("id"), labels)
+    metrics.inc("messages_received_total", labels)
+    metrics.inc("message_bytes_received_total", labels, len(data))
+    return message
+
+def parse_message(data):
+    if not is_frame(data):
+        return decompress_message(json.loads(data))
+
+    _, version, flags, message_type, message_id, metadata_length, payload_length = FRAME_HEADER.unpack_from(data)
+    if version != FRAME_VERSION:
+        raise ValueError(f"Unsupported frame version {version}")
+
+    view = memoryview(data)
+    metadata_start = FRAME_HEADER.size
+    payload_start = metadata_start + metadata_length
+    message = json.loads(bytes(view[metadata_start:payload_start]))
+
+    if message_type:
+        message["action"] = MESSAGE_TYPES[message_type]
+    if flags & FLAG_HAS_ID:
+        message["id"] = message_id
+    if flags & FLAG_HAS_PAYLOAD:
+        message["data"] = view[payload_start:payload_start + payload_length]
+    return decompress_message(message)
+
+# Binary data of a message, which is base64 encoded if it was received as JSON
+def decode_data(data):
+    if isinstance(data, str):
+        with tracer.span("b64decode"):
+            return base64.b64decode(data)
+    return data
+
+# Pack several messages into one batch message. Their binary data is concatenated into the
+# payload of the batch, so that it is not base64 encoded inside the metadata of binary frames.
+def pack_batch(messages):
+    packed_messages = []
+    payload = bytearray()
+    for message in messages:
+        message = dict(message)
+        if "data" in message:
+            data = message.pop("data")
+            message["data_size"] = len(data)
+            payload += data
+        packed_messages.append(message)
+
+    return {
+        "action": "batch",
+        "messages": packed_messages,
+        "data": bytes(payload)
+    }
+
+# Restore the messages of a batch together with their binary data
+def unpack_batch(batch):
+    payload = decode_data(batch["data"])
+    messages = []
+    offset = 0
+    for message in batch["messages"]:
+        if "data_size" in message:
+            size = message.pop("data_size")
+            message["data"] = payload[offset:offset + size]
+            offset += size
+        messages.append(message)
+    return messages
 
 def split_into_chunks(data, chunk_size):
     return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
 
 # Define function to receive the complete message
 def receive_message(socket):
-    data, sender_address = socket.recvfrom(65536)
+    # The reliable transport reassembles fragmented messages and passes plain datagrams through
+    data, sender_address = get_socket_state(socket).get_transport().receive()
 
-    # Process and decode each individual message
-    decoded_messages = [message.decode() for message in data.split(b'\n') if message]
+    # A message holds either one binary frame or newline-delimited JSON messages
+    if is_frame(data):
+        return [data], sender_address
+    messages = [message for message in data.split(b'\n') if message]
 
-    return decoded_messages, sender_address
+    return messages, sender_address
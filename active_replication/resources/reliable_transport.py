@@ -0,0 +1,502 @@
+import os
+import time
+import random
+import select
+import struct
+import threading
+from collections import deque
+from socket import SOL_SOCKET, SO_RCVBUF, SO_SNDBUF
+
+from resources.metrics import metrics
+
+# Reliable, ordered message delivery on top of UDP: messages are split into MTU-sized fragments,
+# reassembled by the receiver, acknowledged selectively and retransmitted when lost.
+# A sliding window per peer allows many messages to be in flight to every peer at once.
+# The window adapts to the path like TCP's (AIMD): it grows with every acknowledged fragment and is halved
+# when fragments get lost, e.g. because the receive buffer of the peer overflowed. Fragments are paced to
+# the window per round trip time, and all peers together are kept below an optional bandwidth cap.
+
+TRANSPORT_MAGIC = b"RU"
+TRANSPORT_VERSION = 1
+# Packet header: magic, version, kind, sender session, message id, fragment index, fragment count.
+# ACK/NACK packets use the index field for the number of contiguously received fragments and the
+# count field for the highest received fragment + 1, NACKs list the missing fragments as payload.
+PACKET_HEADER = struct.Struct("!2sBBIIII")
+DATA_PACKET = 1
+ACK_PACKET = 2
+NACK_PACKET = 3
+MISSING_ENTRY = struct.Struct("!I")
+
+FRAGMENT_SIZE = 1400
+MAX_DATAGRAM_SIZE = 65536
+MAX_NACK_ENTRIES = 256
+# Extra sending rate allowed on top of window per round trip time, so the window can still grow
+PACING_GAIN = 1.25
+
+# Token bucket limiting the bytes sent per second. Sending may overdraw it, the debt delays the next sends.
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = time.time()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def take(self, size):
+        self.tokens -= size
+
+    # Seconds until sending is allowed again
+    def get_delay(self):
+        return max(0, -self.tokens / self.rate)
+
+# State of a message that was sent but not yet fully acknowledged
+class OutgoingMessage:
+    def __init__(self, message_id, data, fragment_size):
+        self.message_id = message_id
+        self.data = memoryview(data)
+        self.fragment_size = fragment_size
+        self.fragment_count = max(1, -(-len(data) // fragment_size))
+        self.unconfirmed = set(range(self.fragment_count))
+        # Fragment index -> time of its last transmission, for fragments currently in flight
+        self.sent_at = {}
+        self.retries = {}
+        # Fragments sent more than once give no round trip time samples, the ack could be for either copy
+        self.retransmitted = set()
+
+    def get_fragment(self, index):
+        return self.data[index * self.fragment_size:(index + 1) * self.fragment_size]
+
+# State of a message whose fragments are being received
+class IncomingMessage:
+    def __init__(self, fragment_count):
+        self.fragments = [None] * fragment_count
+        self.received = 0
+        # All fragments below next_expected have been received
+        self.next_expected = 0
+        self.highest = -1
+        self.unacknowledged = 0
+        self.last_activity = time.time()
+
+    def missing(self):
+        missing = []
+        for index in range(self.next_expected, self.highest):
+            if self.fragments[index] is None:
+                missing.append(index)
+                if len(missing) == MAX_NACK_ENTRIES:
+                    break
+        return missing
+
+# Sending and receiving state kept per remote address
+class Peer:
+    def __init__(self, address, window, max_window, retransmit_timeout):
+        self.address = address
+        # Sending side, the congestion window (in fragments) limits the fragments in flight
+        self.window = window
+        self.max_window = max_window
+        self.slow_start_threshold = max_window
+        self.next_message_id = 0
+        self.outgoing = {}
+        self.queue = deque()
+        self.in_flight = 0
+        # Round trip time estimation (RFC 6298) and the losses of one round trip counting as one
+        self.smoothed_rtt = None
+        self.rtt_variation = None
+        self.retransmit_timeout = retransmit_timeout
+        self.recovery_until = 0
+        # Paces the fragments once the round trip time is known
+        self.pacer = None
+        # Last time fragments were acknowledged
+        self.last_progress = time.time()
+        # Receiving side, reset whenever the peer starts a new session
+        self.session = None
+        self.expected_id = 0
+        self.incoming = {}
+        self.held = {}
+        self.held_since = None
+
+class ReliableTransport:
+    def __init__(self, socket, fragment_size=FRAGMENT_SIZE, window=256, retransmit_timeout=0.2,
+                 min_retransmit_timeout=0.05, max_retries=10, reassembly_timeout=30, hold_timeout=5,
+                 ack_interval=16, max_rate=None, progress_timeout=1):
+        self.socket = socket
+        self.fragment_size = fragment_size
+        # Largest congestion window, in fragments
+        self.window = window
+        # Receivers only acknowledge every ack_interval fragments, smaller windows would stall until a retransmission
+        self.min_window = min(window, 2 * ack_interval)
+        self.initial_window = min(window, 4 * ack_interval)
+        # Retransmission timeout until round trip times were measured, and its lower bound afterwards
+        self.retransmit_timeout = retransmit_timeout
+        self.min_retransmit_timeout = min_retransmit_timeout
+        self.max_retries = max_retries
+        self.reassembly_timeout = reassembly_timeout
+        self.hold_timeout = hold_timeout
+        self.ack_interval = ack_interval
+        self.session = random.getrandbits(32)
+        self.peers = {}
+        self.ready = deque()
+        self.buffer = bytearray(MAX_DATAGRAM_SIZE)
+        self.lock = threading.RLock()
+        self.work_available = threading.Event()
+        self.tick = 0.02 # in seconds
+        # Bandwidth cap of all peers together
+        self.rate_limit = None
+        self.set_max_rate(max_rate)
+        # A peer still acknowledging fragments within this many seconds counts as busy, not as failed
+        self.progress_timeout = progress_timeout
+        # Peer the background tick serves first, rotated for fairness under the bandwidth cap
+        self.rotation = 0
+
+        # Larger kernel buffers absorb bursts of fragments
+        try:
+            self.socket.setsockopt(SOL_SOCKET, SO_RCVBUF, 4 * 1024 * 1024)
+            self.socket.setsockopt(SOL_SOCKET, SO_SNDBUF, 4 * 1024 * 1024)
+        except OSError:
+            pass
+
+        timer_thread = threading.Thread(target=self.run_timer)
+        timer_thread.daemon = True
+        timer_thread.start()
+
+    def get_peer(self, address):
+        peer = self.peers.get(address)
+        if peer is None:
+            peer = Peer(address, self.initial_window, self.window, self.retransmit_timeout)
+            self.peers[address] = peer
+        return peer
+
+    # Cap the bytes per second sent to all peers together, None for no cap
+    def set_max_rate(self, max_rate):
+        with self.lock:
+            if max_rate:
+                # Enough for a whole tick, as the tick may have to refill the sending
+                self.rate_limit = TokenBucket(max_rate, max(64 * self.fragment_size, 2 * self.tick * max_rate))
+            else:
+                self.rate_limit = None
+
+    # Block until the bandwidth cap allows sending size bytes, for datagrams sent without the transport
+    def throttle(self, size):
+        while True:
+            with self.lock:
+                if self.rate_limit is None:
+                    return
+                self.rate_limit.refill(time.time())
+                delay = self.rate_limit.get_delay()
+                if delay == 0:
+                    self.rate_limit.take(size)
+                    return
+            time.sleep(delay)
+
+    # Whether messages to a peer are still being delivered, as opposed to the peer having stopped acknowledging
+    def is_sending(self, address):
+        with self.lock:
+            peer = self.peers.get(address)
+            return (peer is not None and bool(peer.outgoing)
+                    and time.time() - peer.last_progress < self.progress_timeout)
+
+    # Congestion window (in fragments) and smoothed round trip time (in seconds) of every peer
+    def get_stats(self):
+        with self.lock:
+            return {address: (peer.window, peer.smoothed_rtt) for address, peer in self.peers.items()}
+
+    # Forget all state of a peer, e.g. after it disconnected
+    def remove_peer(self, address):
+        with self.lock:
+            self.peers.pop(address, None)
+
+    # Queue a message for reliable delivery, never blocks
+    def send(self, data, address):
+        with self.lock:
+            peer = self.get_peer(address)
+            message = OutgoingMessage(peer.next_message_id, data, self.fragment_size)
+            peer.next_message_id = (peer.next_message_id + 1) % 2 ** 32
+            peer.outgoing[message.message_id] = message
+            for index in range(message.fragment_count):
+                peer.queue.append((message, index))
+            self.pump(peer)
+        self.work_available.set()
+
+    # Send queued fragments as long as the window of the peer and the pacing allow it
+    def pump(self, peer):
+        now = time.time()
+        if peer.pacer is not None:
+            peer.pacer.refill(now)
+        if self.rate_limit is not None:
+            self.rate_limit.refill(now)
+        while peer.queue and peer.in_flight < int(peer.window):
+            if (peer.pacer is not None and peer.pacer.tokens <= 0) or (self.rate_limit is not None and self.rate_limit.tokens <= 0):
+                # Continued by the background tick or the next acknowledgement
+                return
+            message, index = peer.queue.popleft()
+            if message.message_id not in peer.outgoing or index not in message.unconfirmed:
+                continue
+            self.transmit(peer, message, index)
+
+    # Send a fragment, retransmissions are neither held back by the window nor by the pacing but are accounted for
+    def transmit(self, peer, message, index):
+        now = time.time()
+        if index not in message.sent_at:
+            peer.in_flight += 1
+            if peer.in_flight == 1:
+                # Nothing was in flight, the peer was idle rather than silent
+                peer.last_progress = now
+        else:
+            message.retransmitted.add(index)
+            metrics.inc("transport_fragments_retransmitted_total")
+        message.sent_at[index] = now
+        header = PACKET_HEADER.pack(TRANSPORT_MAGIC, TRANSPORT_VERSION, DATA_PACKET, self.session,
+                                    message.message_id, index, message.fragment_count)
+        packet = header + message.get_fragment(index)
+        if peer.pacer is not None:
+            peer.pacer.take(len(packet))
+        if self.rate_limit is not None:
+            self.rate_limit.take(len(packet))
+        self.socket.sendto(packet, peer.address)
+
+    # Returns True if the fragment was in flight until now
+    def confirm(self, peer, message, index):
+        if index in message.unconfirmed:
+            message.unconfirmed.discard(index)
+            if message.sent_at.pop(index, None) is not None:
+                peer.in_flight -= 1
+                return True
+        return False
+
+    # Fragments arrived: take a round trip time sample, grow the window and adapt the pacing to it
+    def acknowledged(self, peer, count, sample_sent_at, now):
+        peer.last_progress = now
+        if sample_sent_at is not None:
+            rtt = max(0, now - sample_sent_at)
+            if peer.smoothed_rtt is None:
+                peer.smoothed_rtt = rtt
+                peer.rtt_variation = rtt / 2
+            else:
+                peer.rtt_variation = 0.75 * peer.rtt_variation + 0.25 * abs(peer.smoothed_rtt - rtt)
+                peer.smoothed_rtt = 0.875 * peer.smoothed_rtt + 0.125 * rtt
+            peer.retransmit_timeout = max(self.min_retransmit_timeout, peer.smoothed_rtt + 4 * peer.rtt_variation)
+
+        # Slow start doubles the window every round trip, congestion avoidance adds one fragment
+        if peer.window < peer.slow_start_threshold:
+            peer.window = min(peer.window + count, peer.max_window)
+        else:
+            peer.window = min(peer.window + count / peer.window, peer.max_window)
+        self.update_pacing(peer)
+
+    # Fragments got lost: halve the window, once per round trip. A retransmission timing out as well means
+    # that the path is blocked, the window then starts over with slow start.
+    def congested(self, peer, timeout, now):
+        if now < peer.recovery_until:
+            return
+        peer.slow_start_threshold = max(self.min_window, peer.window / 2)
+        peer.window = self.min_window if timeout else peer.slow_start_threshold
+        peer.recovery_until = now + (peer.smoothed_rtt if peer.smoothed_rtt is not None else peer.retransmit_timeout)
+        self.update_pacing(peer)
+        metrics.inc("transport_congestion_events_total", {"kind": "timeout" if timeout else "loss"})
+        if os.environ.get("DEBUG") == "on":
+            print(f"Congestion towards {peer.address}, window reduced to {int(peer.window)} fragments")
+
+    def update_pacing(self, peer):
+        if not peer.smoothed_rtt:
+            return
+        rate = PACING_GAIN * peer.window * (self.fragment_size + PACKET_HEADER.size) / peer.smoothed_rtt
+        burst = max(self.ack_interval * self.fragment_size, 2 * self.tick * rate)
+        if peer.pacer is None:
+            peer.pacer = TokenBucket(rate, burst)
+        else:
+            peer.pacer.rate = rate
+            peer.pacer.burst = burst
+
+    def drop_outgoing(self, peer, message):
+        peer.in_flight -= len(message.sent_at)
+        message.sent_at.clear()
+        del peer.outgoing[message.message_id]
+
+    def send_ack(self, address, session, message_id, incoming=None, fragment_count=None):
+        if incoming is None:
+            # Message is complete
+            packet = PACKET_HEADER.pack(TRANSPORT_MAGIC, TRANSPORT_VERSION, ACK_PACKET, session,
+                                        message_id, fragment_count, fragment_count)
+        else:
+            missing = incoming.missing()
+            kind = NACK_PACKET if missing else ACK_PACKET
+            highest = incoming.highest + 1
+            if len(missing) == MAX_NACK_ENTRIES:
+                # Only report up to the last listed gap, so unlisted gaps are not taken as received
+                highest = missing[-1] + 1
+            packet = PACKET_HEADER.pack(TRANSPORT_MAGIC, TRANSPORT_VERSION, kind, session,
+                                        message_id, incoming.next_expected, highest)
+            packet += b"".join(MISSING_ENTRY.pack(index) for index in missing)
+            incoming.unacknowledged = 0
+        self.socket.sendto(packet, address)
+
+    # Process an ACK or NACK for one of our messages
+    def handle_ack(self, peer, kind, message_id, contiguous, highest, payload):
+        message = peer.outgoing.get(message_id)
+        if message is None:
+            return
+
+        now = time.time()
+        # The fragment sent last among the acknowledged ones most likely triggered the ack
+        if kind == ACK_PACKET and contiguous == message.fragment_count:
+            sample_sent_at = max((sent_at for index, sent_at in message.sent_at.items()
+                                  if index not in message.retransmitted), default=None)
+            count = len(message.sent_at)
+            self.drop_outgoing(peer, message)
+            self.acknowledged(peer, count, sample_sent_at, now)
+            self.pump(peer)
+            return
+
+        missing = set(index for (index,) in MISSING_ENTRY.iter_unpack(payload))
+        count = 0
+        sample_sent_at = None
+        for index in list(message.unconfirmed):
+            if index < contiguous or (index < highest and index not in missing):
+                sent_at = message.sent_at.get(index)
+                if self.confirm(peer, message, index):
+                    count += 1
+                    if index not in message.retransmitted and (sample_sent_at is None or sent_at > sample_sent_at):
+                        sample_sent_at = sent_at
+        if count:
+            self.acknowledged(peer, count, sample_sent_at, now)
+
+        # Fast retransmission of fragments reported missing, unless they were just resent
+        lost = False
+        for index in missing:
+            sent_at = message.sent_at.get(index)
+            if sent_at is not None and now - sent_at > peer.retransmit_timeout / 2:
+                self.transmit(peer, message, index)
+                lost = True
+        if lost:
+            self.congested(peer, False, now)
+        self.pump(peer)
+
+    # Store a received fragment, returns True if the ack state changed enough to report it
+    def handle_data(self, peer, address, session, message_id, index, fragment_count, payload):
+        if session != peer.session:
+            # New session of the sender (e.g. restarted), start over
+            peer.session = session
+            peer.expected_id = 0
+            peer.incoming = {}
+            peer.held = {}
+            peer.held_since = None
+
+        # Duplicate of a message that was already delivered: acknowledge again
+        if (message_id - peer.expected_id) % 2 ** 32 >= 2 ** 31 or message_id in peer.held:
+            self.send_ack(address, session, message_id, fragment_count=fragment_count)
+            return
+
+        if index >= fragment_count:
+            return
+
+        incoming = peer.incoming.get(message_id)
+        if incoming is None:
+            incoming = IncomingMessage(fragment_count)
+            peer.incoming[message_id] = incoming
+        incoming.last_activity = time.time()
+
+        if incoming.fragments[index] is not None:
+            return
+        incoming.fragments[index] = bytes(payload)
+        incoming.received += 1
+        new_gap = index > incoming.highest + 1
+        incoming.highest = max(incoming.highest, index)
+        while incoming.next_expected < fragment_count and incoming.fragments[incoming.next_expected] is not None:
+            incoming.next_expected += 1
+
+        if incoming.received == fragment_count:
+            del peer.incoming[message_id]
+            self.send_ack(address, session, message_id, fragment_count=fragment_count)
+            peer.held[message_id] = b"".join(incoming.fragments)
+            if peer.held_since is None:
+                peer.held_since = time.time()
+            self.release_held(peer)
+            return
+
+        incoming.unacknowledged += 1
+        if new_gap or incoming.unacknowledged >= self.ack_interval:
+            self.send_ack(address, session, message_id, incoming)
+
+    # Deliver completed messages in order; after hold_timeout skip messages that never completed
+    def release_held(self, peer, force=False):
+        if force and peer.held and peer.expected_id not in peer.held:
+            peer.expected_id = min(peer.held, key=lambda message_id: (message_id - peer.expected_id) % 2 ** 32)
+        while peer.expected_id in peer.held:
+            self.ready.append((peer.held.pop(peer.expected_id), peer.address))
+            peer.expected_id = (peer.expected_id + 1) % 2 ** 32
+        peer.held_since = time.time() if peer.held else None
+
+    # Block until the next complete message arrives, returns (data, sender address).
+    # Datagrams from peers not using this transport are returned unchanged.
+    def receive(self):
+        while True:
+            with self.lock:
+                if self.ready:
+                    return self.ready.popleft()
+                held_peers = [peer for peer in self.peers.values() if peer.held]
+            timeout = self.hold_timeout if held_peers else None
+            readable, _, _ = select.select([self.socket], [], [], timeout)
+
+            with self.lock:
+                now = time.time()
+                for peer in held_peers:
+                    if peer.held and peer.held_since is not None and now - peer.held_since >= self.hold_timeout:
+                        if os.environ.get("DEBUG") == "on":
+                            print(f"Skipping lost message {peer.expected_id} from {peer.address}")
+                        self.release_held(peer, force=True)
+                if not readable:
+                    continue
+
+                size, address = self.socket.recvfrom_into(self.buffer)
+                data = memoryview(self.buffer)[:size]
+                if size < PACKET_HEADER.size or data[:2] != TRANSPORT_MAGIC:
+                    return bytes(data), address
+
+                _, version, kind, session, message_id, index, count = PACKET_HEADER.unpack_from(data)
+                if version != TRANSPORT_VERSION:
+                    continue
+                peer = self.get_peer(address)
+                payload = data[PACKET_HEADER.size:]
+                if kind == DATA_PACKET:
+                    self.handle_data(peer, address, session, message_id, index, count, payload)
+                elif session == self.session:
+                    self.handle_ack(peer, kind, message_id, index, count, payload)
+
+    # Background tick: retransmit fragments whose acknowledgement is overdue and drop stale reassemblies
+    def run_timer(self):
+        while True:
+            self.work_available.wait()
+            time.sleep(self.tick)
+            with self.lock:
+                now = time.time()
+                busy = False
+                peers = list(self.peers.values())
+                if peers:
+                    self.rotation = (self.rotation + 1) % len(peers)
+                    peers = peers[self.rotation:] + peers[:self.rotation]
+                for peer in peers:
+                    for message in list(peer.outgoing.values()):
+                        busy = True
+                        for index, sent_at in list(message.sent_at.items()):
+                            retries = message.retries.get(index, 0)
+                            if now - sent_at < peer.retransmit_timeout * 2 ** min(retries, 4):
+                                continue
+                            if retries >= self.max_retries:
+                                if os.environ.get("DEBUG") == "on":
+                                    print(f"Giving up on message {message.message_id} to {peer.address}")
+                                self.drop_outgoing(peer, message)
+                                break
+                            message.retries[index] = retries + 1
+                            self.congested(peer, retries > 0, now)
+                            self.transmit(peer, message, index)
+                    self.pump(peer)
+
+                    for message_id, incoming in list(peer.incoming.items()):
+                        busy = True
+                        if now - incoming.last_activity > self.reassembly_timeout:
+                            del peer.incoming[message_id]
+
+                if not busy:
+                    self.work_available.clear()
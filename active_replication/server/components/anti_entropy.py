@@ -0,0 +1,302 @@
+import os
+import time
+import queue
+import threading
+
+import sys
+sys.path.append('../')
+from resources.message_sending import send_message, decode_data
+from resources.merkle_tree import build_tree, directory_digest, DIRECTORY_ENTRY
+
+REPAIR_ACTIONS = ("repair_digests", "repair_tree_request", "repair_tree", "repair_pull", "repair_file")
+
+# Class keeping the replicas consistent in the background, so that an update one server missed does not
+# leave its copy diverged until a client uploads the file again. Every interval, the server sends the root
+# digests of its user folders to each peer. For every folder that differs, the peer answers with the entries
+# of the folder, and the server descends level by level into the directories that differ, like clients do
+# when reconciling. Each server only repairs its own copy: it pulls files it lacks or that were changed later
+# on the peer, and deletes what the peer deleted after it was last changed here. Whatever the peer lacks is
+# repaired by the rounds of the peer. Only a single server process takes part: the replies of the peers and
+# the acknowledgements of the reliable transport could reach any worker process sharing the port.
+class AntiEntropy:
+    def __init__(self, server, server_dir, peers, interval=30, rate=1048576):
+        self.server = server
+        self.server_dir = server_dir
+        self.peers = peers
+        self.interval = interval # in seconds
+        # Bytes per second pulled from peers, so that repairs leave bandwidth and disk to the clients
+        self.rate = rate
+        self.budget = rate
+        # Larger files are left to the clients
+        self.max_file_size = 67108864
+        # Trees of the user folders are reused while peers descend into them: user -> (time, tree, details)
+        self.trees = {}
+        self.tree_ttl = 5 # in seconds
+        # Repair messages of peers are handled on a thread of their own, never holding up client messages
+        self.messages = queue.Queue()
+        # Files to pull: (peer, user, path, size)
+        self.pulls = queue.Queue()
+        self.lock = threading.Lock()
+
+        message_thread = threading.Thread(target=self.run_messages)
+        message_thread.daemon = True
+        message_thread.start()
+        pull_thread = threading.Thread(target=self.run_pulls)
+        pull_thread.daemon = True
+        pull_thread.start()
+        round_thread = threading.Thread(target=self.run_rounds)
+        round_thread.daemon = True
+        round_thread.start()
+
+    # Called by the server for repair messages of peers
+    def receive(self, message, peer):
+        self.messages.put((message, peer))
+
+    def run_rounds(self):
+        while True:
+            time.sleep(self.interval)
+            digests = {user: self.get_tree(user)[0][""]["digest"] for user in self.list_users()}
+            message = {
+                "action": "repair_digests",
+                "users": digests
+            }
+            send_message(self.server.server_socket, message, self.peers)
+
+    def run_messages(self):
+        while True:
+            message, peer = self.messages.get()
+            try:
+                self.server.tombstones.refresh()
+                if message["action"] == "repair_digests":
+                    self.answer_digests(message, peer)
+                elif not is_valid_user(message.get("user")):
+                    continue
+                elif message["action"] == "repair_tree_request":
+                    self.send_tree(message["user"], message["paths"], peer)
+                elif message["action"] == "repair_tree":
+                    self.compare(message, peer)
+                elif message["action"] == "repair_pull":
+                    self.send_file(message, peer)
+                elif message["action"] == "repair_file":
+                    self.receive_file(message)
+            except (OSError, KeyError, TypeError, ValueError) as e:
+                print(f"Error handling {message.get('action')} from peer {peer}: {e}")
+
+    # Pull files one after the other, keeping the transferred bytes per second below the rate
+    def run_pulls(self):
+        last_refill = time.monotonic()
+        while True:
+            peer, user, path, size = self.pulls.get()
+            now = time.monotonic()
+            self.budget = min(self.rate, self.budget + (now - last_refill) * self.rate)
+            last_refill = now
+            if self.budget < 0:
+                time.sleep(-self.budget / self.rate)
+            self.budget -= size
+
+            message = {
+                "action": "repair_pull",
+                "user": user,
+                "path": path
+            }
+            send_message(self.server.server_socket, message, peer)
+
+    # User folders are the directories of the server directory, the others are hidden
+    def list_users(self):
+        return [entry.name for entry in os.scandir(self.server_dir) if entry.is_dir() and is_valid_user(entry.name)]
+
+    # Tree and details of a user folder, an empty tree if the folder does not exist
+    def get_tree(self, user):
+        with self.lock:
+            cached = self.trees.get(user)
+        if cached is not None and time.monotonic() - cached[0] < self.tree_ttl:
+            return cached[1], cached[2]
+
+        user_dir = os.path.join(self.server_dir, user)
+        details = {}
+        if os.path.isdir(user_dir):
+            tree = build_tree(user_dir, self.server.hash_cache, details)
+        else:
+            tree = {"": {"digest": directory_digest({}), "entries": {}}}
+        with self.lock:
+            self.trees[user] = (time.monotonic(), tree, details)
+        return tree, details
+
+    # Start repairs of the folders whose digests differ on the peer
+    def answer_digests(self, message, peer):
+        remote_digests = message["users"]
+        for user in set(self.list_users()) | set(remote_digests):
+            if not is_valid_user(user):
+                continue
+            tree, _ = self.get_tree(user)
+            if remote_digests.get(user) != tree[""]["digest"]:
+                self.send_tree(user, [""], peer)
+
+    # Send the entries of directories with modification times and sizes, and the deletions in them
+    def send_tree(self, user, paths, peer):
+        tree, details = self.get_tree(user)
+        directories = {}
+        for path in paths:
+            node = tree.get(path)
+            if node is None:
+                directories[path] = None
+                continue
+            entries = {}
+            for name, (kind, digest) in node["entries"].items():
+                child_path = os.path.join(path, name) if path else name
+                entries[name] = [kind, digest] + details.get(child_path, [0, 0])
+            directories[path] = {
+                "digest": node["digest"],
+                "entries": entries,
+                "deleted": self.server.tombstones.get_children(user, path)
+            }
+
+        message = {
+            "action": "repair_tree",
+            "user": user,
+            "directories": directories
+        }
+        send_message(self.server.server_socket, message, peer)
+
+    # Repair the own copy of the directories the peer sent, then ask for the subdirectories that still differ
+    def compare(self, message, peer):
+        user = message["user"]
+        tree, details = self.get_tree(user)
+        next_paths = []
+
+        for path, remote in message["directories"].items():
+            if remote is None or not is_safe_path(path):
+                continue
+            local = tree.get(path)
+            if local is not None and local["digest"] == remote["digest"]:
+                continue
+            local_entries = local["entries"] if local is not None else {}
+
+            for name, (kind, digest, mtime, size) in remote["entries"].items():
+                child_path = os.path.join(path, name) if path else name
+                if not is_safe_path(child_path):
+                    continue
+                local_entry = local_entries.get(name)
+                if local_entry == [kind, digest]:
+                    continue
+                if local_entry is not None and local_entry[0] == kind == DIRECTORY_ENTRY:
+                    next_paths.append(child_path)
+                    continue
+                local_time = details.get(child_path, [0, 0])[0]
+                if local_entry is None:
+                    # Deleted here after it was last changed on the peer, the peer deletes it in its own round
+                    deleted_time = self.server.tombstones.deleted_since(user, child_path)
+                    if deleted_time is not None and deleted_time >= mtime:
+                        continue
+                elif local_time >= mtime:
+                    # Changed here later, the peer pulls it in its own round
+                    continue
+                elif local_entry[0] != kind:
+                    # A file replaced a folder or the other way around on the peer
+                    self.delete(user, child_path, mtime)
+
+                if kind == DIRECTORY_ENTRY:
+                    self.create_directory(user, child_path)
+                    next_paths.append(child_path)
+                elif size <= self.max_file_size:
+                    self.pulls.put((peer, user, child_path, size))
+
+            deleted = remote.get("deleted", {})
+            for name in local_entries:
+                if name in remote["entries"] or name not in deleted:
+                    continue
+                child_path = os.path.join(path, name) if path else name
+                # Deleted on the peer after it was last changed here
+                if deleted[name] > details.get(child_path, [0, 0])[0]:
+                    self.delete(user, child_path, deleted[name])
+
+        if next_paths:
+            request = {
+                "action": "repair_tree_request",
+                "user": user,
+                "paths": next_paths
+            }
+            send_message(self.server.server_socket, request, peer)
+
+    def send_file(self, message, peer):
+        if not is_safe_path(message["path"]):
+            return
+        server_path = os.path.join(self.server_dir, message["user"], message["path"])
+        if not os.path.isfile(server_path):
+            return
+        with open(server_path, 'rb') as server_file:
+            data = server_file.read(self.max_file_size + 1)
+        if len(data) > self.max_file_size:
+            return
+
+        reply = {
+            "action": "repair_file",
+            "user": message["user"],
+            "path": message["path"],
+            "mtime": os.path.getmtime(server_path),
+            "data": data
+        }
+        send_message(self.server.server_socket, reply, peer)
+
+    # Write a pulled file on an I/O thread, unless it was changed or deleted here in the meantime
+    def receive_file(self, message):
+        user = message["user"]
+        relative_path = message["path"]
+        if not is_safe_path(relative_path):
+            return
+        server_path = os.path.join(self.server_dir, user, relative_path)
+        data = decode_data(message["data"])
+
+        def write():
+            if os.path.isdir(server_path):
+                return
+            if os.path.exists(server_path) and os.path.getmtime(server_path) >= message["mtime"]:
+                return
+            deleted_time = self.server.tombstones.deleted_since(user, relative_path)
+            if deleted_time is not None and deleted_time >= message["mtime"]:
+                return
+            os.makedirs(os.path.dirname(server_path), exist_ok=True)
+            self.server.store.write(server_path, data)
+            self.server.signature_cache.invalidate(server_path)
+            print(f"Repaired {relative_path} of {user} from a peer")
+
+        self.server.executor.submit([server_path], write)
+
+    def create_directory(self, user, relative_path):
+        server_path = os.path.join(self.server_dir, user, relative_path)
+        self.server.executor.submit([server_path], lambda: os.makedirs(server_path, exist_ok=True))
+
+    # Delete a file or folder on an I/O thread, unless it was changed here after the given time
+    def delete(self, user, relative_path, deleted_time):
+        server_path = os.path.join(self.server_dir, user, relative_path)
+
+        def remove():
+            if not os.path.lexists(server_path):
+                return
+            if os.path.isdir(server_path):
+                details = {}
+                build_tree(server_path, self.server.hash_cache, details)
+                if details[""][0] > deleted_time:
+                    return
+                self.server.store.remove_tree(server_path)
+            else:
+                if os.path.getmtime(server_path) > deleted_time:
+                    return
+                self.server.store.remove(server_path)
+                self.server.signature_cache.invalidate(server_path)
+            self.server.tombstones.record(user, relative_path, deleted_time)
+            print(f"Deleted {relative_path} of {user} as on a peer")
+
+        self.server.executor.submit([server_path], remove)
+
+
+# User names come from peers and are used as directory names
+def is_valid_user(user):
+    return isinstance(user, str) and user != "" and not user.startswith(".") and os.sep not in user and "/" not in user
+
+
+# Relative paths from peers must stay inside the user folder
+def is_safe_path(relative_path):
+    if not isinstance(relative_path, str) or os.path.isabs(relative_path):
+        return False
+    return relative_path == "" or not os.path.normpath(relative_path).startswith("..")
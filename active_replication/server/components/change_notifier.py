@@ -0,0 +1,141 @@
+import os
+import hashlib
+import threading
+from collections import deque
+
+# Class pushing the changes applied for a user to the other sessions of the same user, so that a user
+# logged in from several devices sees the changes made on the others. Every session has its own queue
+# and sender thread, a slow device only holds up its own pushes. The content of changed files is read
+# when the push is sent, so repeated changes of a file waiting in the queue are sent once.
+class ChangeNotifier:
+    def __init__(self, server_dir, send, max_queued=4096, max_file_size=67108864):
+        self.server_dir = server_dir
+        # Called with a message and the session to send it to
+        self.send = send
+        self.max_queued = max_queued
+        # Larger files are only announced, the devices upload them again themselves
+        self.max_file_size = max_file_size
+        # Session -> (username, queue) and username -> sessions
+        self.sessions = {}
+        self.users = {}
+        self.lock = threading.Lock()
+
+    # Start pushing the changes of a user to a session that logged in
+    def add_session(self, session, username):
+        self.remove_session(session)
+        queue = SessionQueue(self.max_queued)
+        with self.lock:
+            self.sessions[session] = (username, queue)
+            self.users.setdefault(username, set()).add(session)
+
+        sender_thread = threading.Thread(target=self.run_session, args=(session, username, queue))
+        sender_thread.daemon = True
+        sender_thread.start()
+
+    def remove_session(self, session):
+        with self.lock:
+            entry = self.sessions.pop(session, None)
+            if entry is None:
+                return
+            username, queue = entry
+            self.users[username].discard(session)
+            if not self.users[username]:
+                del self.users[username]
+        queue.close()
+
+    # Number of changes waiting to be pushed to all sessions
+    def get_queued(self):
+        with self.lock:
+            queues = [queue for _, queue in self.sessions.values()]
+        return sum(len(queue.changes) for queue in queues)
+
+    # Queue an applied update for all sessions of the user except the one it came from
+    def notify(self, username, origin, update):
+        change = {key: update[key] for key in ("event_type", "structure", "path", "src_path", "dest_path") if key in update}
+        with self.lock:
+            queues = [queue for session, (_, queue) in self.sessions.items()
+                      if session != origin and session in self.users.get(username, ())]
+        for queue in queues:
+            queue.put(change)
+
+    def run_session(self, session, username, queue):
+        while True:
+            change = queue.get()
+            if change is None:
+                return
+            message = self.build_message(username, change)
+            if message is None:
+                continue
+            try:
+                self.send(message, session)
+            except OSError as e:
+                print(f"Error pushing a change to {session}: {e}")
+                return
+
+    # Push message of a change, with the current content of created and modified files
+    def build_message(self, username, change):
+        if change.get("event_type") == "overflow":
+            return {
+                "type": "serverMessage",
+                "action": "push_overflow"
+            }
+
+        message = dict(change, type="serverMessage", action="push")
+        if change["event_type"] in ("created", "modified") and change["structure"] == "file":
+            server_path = os.path.join(self.server_dir, username, change["path"])
+            try:
+                with open(server_path, 'rb') as server_file:
+                    data = server_file.read(self.max_file_size + 1)
+            except OSError:
+                # Deleted or replaced by a folder in the meantime, a later change follows
+                return None
+            if len(data) > self.max_file_size:
+                message["size"] = os.path.getsize(server_path)
+            else:
+                message["data"] = data
+                message["file_hash"] = hashlib.sha256(data).hexdigest()
+        return message
+
+
+# Changes waiting to be pushed to a session. A change directly following a change of the same path
+# replaces it, unless one of them is a move. Once too many changes wait, they are dropped and the session
+# is told that it missed changes.
+class SessionQueue:
+    def __init__(self, max_queued):
+        self.max_queued = max_queued
+        self.changes = deque()
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def put(self, change):
+        with self.condition:
+            if self.closed:
+                return
+            previous = self.changes[-1] if self.changes else None
+            if previous is not None and get_key(previous) == get_key(change) and "moved" not in (previous["event_type"], change["event_type"]):
+                self.changes[-1] = change
+            elif len(self.changes) >= self.max_queued:
+                self.changes.clear()
+                self.changes.append({"event_type": "overflow"})
+            else:
+                self.changes.append(change)
+            self.condition.notify()
+
+    # Next change to push, None once the session ended
+    def get(self):
+        with self.condition:
+            while not self.changes and not self.closed:
+                self.condition.wait()
+            if self.closed:
+                return None
+            return self.changes.popleft()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.changes.clear()
+            self.condition.notify()
+
+
+def get_key(change):
+    return change.get("path", change.get("dest_path"))
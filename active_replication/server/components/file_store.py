@@ -0,0 +1,169 @@
+import os
+import shutil
+import hashlib
+import threading
+
+import sys
+sys.path.append('../')
+from resources.delta_sync import hash_file
+from resources.temp_files import get_temp_path
+
+BLOB_DIR = ".blobs"
+HASH_CHARACTERS = set("0123456789abcdef")
+
+# Class writing the files of users as plain files in the server directory
+class FileStore:
+    deduplicates = False
+
+    def __init__(self, server_dir):
+        self.server_dir = server_dir
+
+    # Write data to a file, replacing its previous content. The data goes to a temporary file first,
+    # so that readers see either the old or the new content, never a partly written file.
+    def write(self, server_path, data):
+        temp_path = get_temp_path(server_path, "tmp")
+        with open(temp_path, 'wb') as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, server_path)
+
+    # Move a completely written temporary file to its target
+    def replace(self, temp_path, server_path, file_hash=None):
+        os.replace(temp_path, server_path)
+
+    # Create a file from content that is already stored, returns False if the content is unknown
+    def link(self, file_hash, server_path):
+        return False
+
+    def remove(self, server_path):
+        os.remove(server_path)
+
+    def remove_tree(self, server_path):
+        shutil.rmtree(server_path)
+
+# Class storing every distinct file content only once, named by its SHA-256 hash. The files of users
+# are hard links to these blobs, so the link count of a blob is its reference count and renames
+# never touch the content. Blobs are never modified, every write links the file to another blob.
+class BlobStore(FileStore):
+    deduplicates = True
+
+    def __init__(self, server_dir):
+        super().__init__(server_dir)
+        self.blob_dir = os.path.join(server_dir, BLOB_DIR)
+        os.makedirs(self.blob_dir, exist_ok=True)
+        # (device, inode) -> hash, to find the blob a file of a user links to
+        self.inodes = {}
+        self.lock = threading.RLock()
+        self.scan()
+
+    def scan(self):
+        inodes = {}
+        for entry in os.scandir(self.blob_dir):
+            if entry.is_file() and is_valid_hash(entry.name):
+                stat = os.stat(entry.path)
+                inodes[(stat.st_dev, stat.st_ino)] = entry.name
+        with self.lock:
+            self.inodes = inodes
+
+    def get_blob_path(self, file_hash):
+        return os.path.join(self.blob_dir, file_hash)
+
+    # Hash of the blob behind a file, None for plain files
+    def lookup(self, server_path):
+        try:
+            stat = os.stat(server_path)
+        except FileNotFoundError:
+            return None
+        if stat.st_nlink < 2:
+            return None
+        key = (stat.st_dev, stat.st_ino)
+        if key not in self.inodes:
+            # Blob may have been added by another server process
+            self.scan()
+        return self.inodes.get(key)
+
+    # Drop a blob once no file links to it anymore
+    def release(self, file_hash):
+        if file_hash is None:
+            return
+        blob_path = self.get_blob_path(file_hash)
+        try:
+            stat = os.stat(blob_path)
+            if stat.st_nlink == 1:
+                os.remove(blob_path)
+                self.inodes.pop((stat.st_dev, stat.st_ino), None)
+        except FileNotFoundError:
+            pass
+
+    # Point a file at a stored blob, replacing whatever it contained before
+    def link(self, file_hash, server_path):
+        if not is_valid_hash(file_hash):
+            return False
+        with self.lock:
+            previous_hash = self.lookup(server_path)
+            if previous_hash == file_hash:
+                return True
+            temp_path = get_temp_path(server_path, "link")
+            try:
+                os.link(self.get_blob_path(file_hash), temp_path)
+            except FileNotFoundError:
+                return False
+            os.replace(temp_path, server_path)
+            self.release(previous_hash)
+        return True
+
+    # Turn a temporary file into a blob (or drop it if the content is already stored) and link to it
+    def add_blob(self, temp_path, file_hash):
+        blob_path = self.get_blob_path(file_hash)
+        with self.lock:
+            if os.path.exists(blob_path):
+                os.remove(temp_path)
+            else:
+                os.replace(temp_path, blob_path)
+                stat = os.stat(blob_path)
+                self.inodes[(stat.st_dev, stat.st_ino)] = file_hash
+
+    # New content is written and synced before taking the lock, so that the I/O threads write in parallel.
+    # Written again if the blob was released in between.
+    def write(self, server_path, data):
+        file_hash = hashlib.sha256(data).hexdigest()
+        while True:
+            temp_path = None
+            if not os.path.exists(self.get_blob_path(file_hash)):
+                temp_path = get_temp_path(server_path, "blob")
+                with open(temp_path, 'wb') as temp_file:
+                    temp_file.write(data)
+                    temp_file.flush()
+                    os.fsync(temp_file.fileno())
+            with self.lock:
+                if temp_path is not None:
+                    self.add_blob(temp_path, file_hash)
+                if self.link(file_hash, server_path):
+                    return
+
+    def replace(self, temp_path, server_path, file_hash=None):
+        if file_hash is None:
+            file_hash = hash_file(temp_path)
+        with self.lock:
+            self.add_blob(temp_path, file_hash)
+            self.link(file_hash, server_path)
+
+    def remove(self, server_path):
+        with self.lock:
+            file_hash = self.lookup(server_path)
+            os.remove(server_path)
+            self.release(file_hash)
+
+    def remove_tree(self, server_path):
+        with self.lock:
+            file_hashes = set()
+            for directory, _, file_names in os.walk(server_path):
+                for file_name in file_names:
+                    file_hashes.add(self.lookup(os.path.join(directory, file_name)))
+            shutil.rmtree(server_path)
+            for file_hash in file_hashes:
+                self.release(file_hash)
+
+
+# Hashes come from clients and are used as file names, so only accept proper SHA-256 hex digests
+def is_valid_hash(file_hash):
+    return isinstance(file_hash, str) and len(file_hash) == 64 and set(file_hash) <= HASH_CHARACTERS
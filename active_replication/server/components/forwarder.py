@@ -0,0 +1,98 @@
+import time
+import threading
+
+import sys
+sys.path.append('../')
+from resources.message_sending import send_message
+
+# Class replicating the updates of clients that upload only to this server (primary replication mode), so
+# that they send every file once instead of once per server. Update, batch and upload messages are forwarded
+# to the peers, which apply them and confirm them. The client is acknowledged once this server applied the
+# message and the configured number of peers confirmed it. Peers that do not confirm in time are no longer
+# waited for until they confirm again, anti-entropy repairs what they missed in the meantime.
+class Forwarder:
+    def __init__(self, server_socket, peers, replica_acks=None, timeout=2):
+        self.server_socket = server_socket
+        self.peers = peers
+        # Number of peers that have to confirm a message, all of them by default
+        self.replica_acks = len(peers) if replica_acks is None else min(replica_acks, len(peers))
+        self.timeout = timeout # in seconds
+        self.down_peers = set()
+        # Forwarded messages waiting for confirmations: sequence number -> state
+        self.pending = {}
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+        timeout_thread = threading.Thread(target=self.run_timeouts)
+        timeout_thread.daemon = True
+        timeout_thread.start()
+
+    # Forward a message of a client to the peers. Returns the callback to call once this server applied it,
+    # on_done is called once the message is replicated.
+    def fan_out(self, message, client_address, username, client_id, on_done):
+        with self.lock:
+            self.sequence += 1
+            sequence = self.sequence
+            self.pending[sequence] = {
+                "deadline": time.monotonic() + self.timeout,
+                "applied": False,
+                "confirmed": set(),
+                "on_done": on_done
+            }
+
+        forward = dict(message)
+        forward["action"] = "forward"
+        forward["forwarded_action"] = message["action"]
+        forward["origin"] = {
+            "user": username,
+            "client": client_id,
+            "address": list(client_address),
+            "seq": sequence
+        }
+        send_message(self.server_socket, forward, self.peers)
+        return lambda: self.confirm(sequence, None)
+
+    # Register that this server (peer None) or a peer applied a message
+    def confirm(self, sequence, peer):
+        with self.lock:
+            if peer in self.down_peers:
+                self.down_peers.remove(peer)
+                print(f"Peer {peer} confirms forwarded updates again.")
+            state = self.pending.get(sequence)
+            if state is None:
+                return
+            if peer is None:
+                state["applied"] = True
+            else:
+                state["confirmed"].add(peer)
+            done = self.is_done(state)
+            if done:
+                del self.pending[sequence]
+        if done:
+            state["on_done"]()
+
+    def is_done(self, state):
+        required = min(self.replica_acks, len(self.peers) - len(self.down_peers))
+        confirmed = len(state["confirmed"] - self.down_peers)
+        return state["applied"] and confirmed >= required
+
+    # Stop waiting for peers that did not confirm a message in time
+    def run_timeouts(self):
+        while True:
+            time.sleep(self.timeout / 4)
+            now = time.monotonic()
+            finished = []
+            with self.lock:
+                for sequence, state in list(self.pending.items()):
+                    if state["deadline"] > now:
+                        continue
+                    for peer in self.peers:
+                        if peer not in state["confirmed"] and peer not in self.down_peers:
+                            self.down_peers.add(peer)
+                            print(f"Peer {peer} did not confirm forwarded updates in time, no longer waiting for it.")
+                for sequence, state in list(self.pending.items()):
+                    if self.is_done(state):
+                        del self.pending[sequence]
+                        finished.append(state["on_done"])
+            for on_done in finished:
+                on_done()
@@ -0,0 +1,131 @@
+import os
+import json
+import threading
+
+# Class persisting the updates a server applied in an append-only log, one JSON record per line with a
+# sequence number, the client that sent the update and its message id. Replicas that fell behind report
+# the last message id they applied for a client, so that the client can send what they missed.
+# Updates are applied in parallel and may fail, so the ids of accepted updates are logged as well before
+# they are applied: the reported id stays below the first accepted update that was not applied.
+# Each worker process appends to its own file, all files of the directory are read on startup.
+class OperationLog:
+    def __init__(self, log_dir, name="server"):
+        os.makedirs(log_dir, exist_ok=True)
+        self.path = os.path.join(log_dir, name + ".log")
+        # The log only needs the last record of each client, larger files are compacted on startup
+        self.compact_size = 67108864
+        # client id -> last applied message id
+        self.last_ids = {}
+        # client id -> ids of accepted updates that were not applied (yet)
+        self.unapplied = {}
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+        for file_name in sorted(os.listdir(log_dir)):
+            if file_name.endswith(".log"):
+                self.load(os.path.join(log_dir, file_name), own=file_name == name + ".log")
+        if os.path.exists(self.path) and os.path.getsize(self.path) > self.compact_size:
+            self.compact()
+        self.file = open(self.path, 'a')
+
+    def load(self, path, own):
+        with open(path, 'r') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Torn write of the last record before a crash
+                    continue
+                self.add_record(record)
+                if own:
+                    self.sequence = max(self.sequence, record["seq"])
+
+    def add_record(self, record):
+        client_id = record["client"]
+        if "accepted" in record:
+            first_id, last_id = record["accepted"]
+            self.unapplied.setdefault(client_id, set()).update(range(first_id, last_id + 1))
+        elif record.get("forgotten"):
+            self.unapplied.pop(client_id, None)
+        else:
+            self.unapplied.get(client_id, set()).discard(record["id"])
+            if record["id"] > self.last_ids.get(client_id, -1):
+                self.last_ids[client_id] = record["id"]
+
+    # Rewrite the log with only the last applied record of each client and the updates not applied yet
+    def compact(self):
+        last_records = {}
+        with open(self.path, 'r') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if "id" in record:
+                    last_records[record["client"]] = record
+        records = sorted(last_records.values(), key=lambda record: record["seq"])
+        for client_id, message_ids in self.unapplied.items():
+            records += [{"seq": self.sequence, "client": client_id, "accepted": [message_id, message_id]} for message_id in sorted(message_ids)]
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w') as file:
+            for record in records:
+                file.write(json.dumps(record) + "\n")
+        os.replace(temp_path, self.path)
+
+    # Record that updates with the ids first_id to last_id are about to be applied
+    def accept(self, client_id, first_id, last_id):
+        with self.lock:
+            self.sequence += 1
+            record = {
+                "seq": self.sequence,
+                "client": client_id,
+                "accepted": [first_id, last_id]
+            }
+            self.write(record)
+
+    # Append an applied update, returns its sequence number
+    def append(self, client_id, message_id, username, update):
+        with self.lock:
+            self.sequence += 1
+            record = {
+                "seq": self.sequence,
+                "client": client_id,
+                "id": message_id,
+                "user": username
+            }
+            for key in ("event_type", "structure", "path", "src_path", "dest_path", "file_hash"):
+                if key in update:
+                    record[key] = update[key]
+            self.write(record)
+            return self.sequence
+
+    # The client sends everything after the reported id again, updates that were not applied are no longer waited for
+    def forget_unapplied(self, client_id):
+        with self.lock:
+            if not self.unapplied.get(client_id):
+                return
+            self.sequence += 1
+            self.write({
+                "seq": self.sequence,
+                "client": client_id,
+                "forgotten": True
+            })
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        self.add_record(record)
+
+    # Last message id of a client up to which this server applied all updates it accepted, None if it never applied any
+    def get_last_id(self, client_id):
+        with self.lock:
+            last_id = self.last_ids.get(client_id)
+            unapplied = self.unapplied.get(client_id)
+            if unapplied:
+                first_unapplied = min(unapplied) - 1
+                last_id = first_unapplied if last_id is None else min(last_id, first_unapplied)
+            return last_id
+
+    def close(self):
+        with self.lock:
+            self.file.close()
@@ -0,0 +1,137 @@
+import os
+import threading
+from collections import deque
+
+# Class applying file operations on a pool of I/O threads, so that a slow operation like deleting a large
+# directory does not hold up the messages of other clients. Operations on the same path, or on a path and a
+# directory above it, run one after the other in the order they were submitted, all others in parallel.
+class StorageExecutor:
+    def __init__(self, workers=4):
+        # Operations whose predecessors all finished
+        self.ready = deque()
+        self.condition = threading.Condition()
+        # Path -> last unfinished operation on exactly that path
+        self.tails = {}
+        # Directory -> unfinished operations on paths below it
+        self.below = {}
+        self.pending = 0
+
+        for _ in range(workers):
+            worker_thread = threading.Thread(target=self.run_worker)
+            worker_thread.daemon = True
+            worker_thread.start()
+
+    # Run operation() once all earlier operations on the paths finished, then on_done() on the same I/O thread
+    def submit(self, paths, operation, on_done=None):
+        task = StorageTask([os.path.normpath(path) for path in paths], operation, on_done)
+        with self.condition:
+            predecessors = set()
+            for path in task.paths:
+                # Earlier operations on the path itself or on a directory above it
+                for parent in [path] + get_parents(path):
+                    if parent in self.tails:
+                        predecessors.add(self.tails[parent])
+                # Earlier operations on anything inside the path
+                predecessors.update(self.below.get(path, ()))
+            predecessors.discard(task)
+
+            for path in task.paths:
+                self.tails[path] = task
+                for parent in get_parents(path):
+                    self.below.setdefault(parent, set()).add(task)
+            for predecessor in predecessors:
+                predecessor.successors.append(task)
+            task.waiting_for = len(predecessors)
+            self.pending += 1
+            if task.waiting_for == 0:
+                self.ready.append(task)
+                self.condition.notify_all()
+
+    # Run several operations and call on_done() once after all of them finished
+    def submit_all(self, operations, on_done):
+        if not operations:
+            on_done()
+            return
+        group = {"remaining": len(operations)}
+
+        def finish_one():
+            with self.condition:
+                group["remaining"] -= 1
+                done = group["remaining"] == 0
+            if done:
+                on_done()
+
+        for paths, operation in operations:
+            self.submit(paths, operation, finish_one)
+
+    def run_worker(self):
+        while True:
+            with self.condition:
+                while not self.ready:
+                    self.condition.wait()
+                task = self.ready.popleft()
+            try:
+                task.operation()
+            except Exception as e:
+                print(f"Error applying operation on {', '.join(task.paths)}: {e}")
+            # Errors while replying must not end the thread either, the pool would shrink with every one of them
+            try:
+                if task.on_done is not None:
+                    task.on_done()
+            except Exception as e:
+                print(f"Error completing operation on {', '.join(task.paths)}: {e}")
+            finally:
+                self.finish(task)
+
+    def finish(self, task):
+        with self.condition:
+            for path in task.paths:
+                if self.tails.get(path) is task:
+                    del self.tails[path]
+                for parent in get_parents(path):
+                    tasks = self.below.get(parent)
+                    if tasks is not None:
+                        tasks.discard(task)
+                        if not tasks:
+                            del self.below[parent]
+            for successor in task.successors:
+                successor.waiting_for -= 1
+                if successor.waiting_for == 0:
+                    self.ready.append(successor)
+            self.pending -= 1
+            self.condition.notify_all()
+
+    # Block until no unfinished operation touches the path or anything above or below it, all paths by default
+    def wait(self, path=None):
+        with self.condition:
+            if path is None:
+                while self.pending:
+                    self.condition.wait()
+                return
+            path = os.path.normpath(path)
+            while path in self.below or any(parent in self.tails for parent in [path] + get_parents(path)):
+                self.condition.wait()
+
+    # Finish all submitted operations, e.g. before the server exits
+    def close(self):
+        self.wait()
+
+
+# Operation waiting for the earlier operations on its paths
+class StorageTask:
+    def __init__(self, paths, operation, on_done):
+        self.paths = paths
+        self.operation = operation
+        self.on_done = on_done
+        self.waiting_for = 0
+        self.successors = []
+
+
+# Directories above a normalized path, from the closest one up
+def get_parents(path):
+    parents = []
+    parent = os.path.dirname(path)
+    while parent and parent != path:
+        parents.append(parent)
+        path, parent = parent, os.path.dirname(parent)
+    return parents
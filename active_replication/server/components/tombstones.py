@@ -0,0 +1,102 @@
+import os
+import json
+import time
+import threading
+
+# Class remembering when files and folders of users were deleted, so that replicas repairing each other
+# delete what the other replica still has instead of copying it back. Deletions are appended to a log,
+# one JSON record per line. Each worker process appends to its own file, the records of all files are read
+# on refresh.
+class Tombstones:
+    def __init__(self, tombstone_dir, name="server"):
+        os.makedirs(tombstone_dir, exist_ok=True)
+        self.tombstone_dir = tombstone_dir
+        self.path = os.path.join(tombstone_dir, name + ".log")
+        # Deletions older than this are forgotten on startup, replicas are expected to be repaired long before
+        self.ttl = 604800 # in seconds
+        # user -> parent directory -> name -> time of the deletion
+        self.deleted = {}
+        # file name -> bytes read so far
+        self.offsets = {}
+        self.lock = threading.Lock()
+
+        if os.path.exists(self.path):
+            self.compact()
+        self.refresh()
+        self.file = open(self.path, 'a')
+
+    # Rewrite the own log without the expired deletions
+    def compact(self):
+        expiry = time.time() - self.ttl
+        temp_path = self.path + ".tmp"
+        with open(self.path, 'r') as file, open(temp_path, 'w') as temp_file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Torn write of the last record before a crash
+                    continue
+                if record["time"] >= expiry:
+                    temp_file.write(line)
+        os.replace(temp_path, self.path)
+
+    # Read the records appended to all logs since the last call
+    def refresh(self):
+        with self.lock:
+            for file_name in os.listdir(self.tombstone_dir):
+                if not file_name.endswith(".log"):
+                    continue
+                with open(os.path.join(self.tombstone_dir, file_name), 'rb') as file:
+                    file.seek(self.offsets.get(file_name, 0))
+                    data = file.read()
+                # Only complete lines, the last one may still be written
+                end = data.rfind(b"\n") + 1
+                self.offsets[file_name] = self.offsets.get(file_name, 0) + end
+                for line in data[:end].splitlines():
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.add(record["user"], record["path"], record["time"])
+
+    def add(self, user, relative_path, deleted_time):
+        parent, name = os.path.split(os.path.normpath(relative_path))
+        names = self.deleted.setdefault(user, {}).setdefault(parent, {})
+        names[name] = max(names.get(name, 0), deleted_time)
+
+    # Remember that a file or folder was deleted, now by default
+    def record(self, user, relative_path, deleted_time=None):
+        if deleted_time is None:
+            deleted_time = time.time()
+        record = {
+            "user": user,
+            "path": os.path.normpath(relative_path),
+            "time": deleted_time
+        }
+        with self.lock:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+            self.add(user, record["path"], deleted_time)
+
+    # Time of the latest deletion of a path or a folder above it, None if it was never deleted
+    def deleted_since(self, user, relative_path):
+        deleted_time = None
+        path = os.path.normpath(relative_path)
+        with self.lock:
+            directories = self.deleted.get(user, {})
+            while path:
+                parent, name = os.path.split(path)
+                candidate = directories.get(parent, {}).get(name)
+                if candidate is not None and (deleted_time is None or candidate > deleted_time):
+                    deleted_time = candidate
+                path = parent
+        return deleted_time
+
+    # Deletions of the entries of a folder: name -> time of the deletion
+    def get_children(self, user, relative_directory):
+        with self.lock:
+            return dict(self.deleted.get(user, {}).get(os.path.normpath(relative_directory) if relative_directory else "", {}))
+
+    def close(self):
+        with self.lock:
+            self.file.close()
@@ -0,0 +1,237 @@
+import os
+import json
+import time
+import zlib
+import struct
+import threading
+
+DURABILITY_NONE = "none"
+DURABILITY_BATCHED = "batched"
+DURABILITY_ALWAYS = "always"
+DURABILITY_MODES = [DURABILITY_NONE, DURABILITY_BATCHED, DURABILITY_ALWAYS]
+
+# Length of the metadata, length of the data and CRC32 of both
+RECORD_HEADER = struct.Struct("!III")
+
+# Class making updates durable before they are acknowledged. Updates are appended to a log file, which is
+# synced to disk before the acknowledgements of the updates are released: in batched mode once for all updates
+# arriving within the group window (group commit), in always mode once per update. The file tree itself is
+# updated in the background, durable updates are handed over in log order to be applied. After a crash, the
+# updates still in the log are applied again on startup. Writes and deletions leave the same result when applied
+# a second time, moves do not: the file at the source may have been created anew after the move. The content
+# hash of a moved file is therefore noted in the log before it is moved, and on recovery the move is only
+# applied again if the source still has this content.
+class WriteAheadLog:
+    def __init__(self, wal_dir, name, durability, apply, group_window=0.005, max_group=256):
+        os.makedirs(wal_dir, exist_ok=True)
+        self.wal_dir = wal_dir
+        self.path = os.path.join(wal_dir, name + ".wal")
+        # Log replaced by a checkpoint, kept until the file tree was synced to disk
+        self.old_path = self.path + ".old"
+        self.checkpointing = False
+        self.durability = durability
+        # Called with the metadata, data and client address of each update and a callback to call once
+        # the update was written to the file tree
+        self.apply = apply
+        self.group_window = group_window # in seconds
+        self.max_group = max_group
+        # The log is emptied once everything in it was applied and it grew larger than this
+        self.checkpoint_size = 67108864
+
+        # Number of appended and of applied updates
+        self.appended = 0
+        self.applied = 0
+        # Appended updates waiting for the next group commit: (records, client address, on_durable)
+        self.unsynced = []
+        self.lock = threading.Condition()
+        self.applied_condition = threading.Condition()
+        # Content hashes noted for moves, by log sequence number, while the updates left by a crash are applied
+        self.notes = {}
+        self.recovering = False
+
+        # The updates left by a crash are applied by calling recover(), before any new ones are appended
+        self.file = open(self.path, 'ab')
+
+        if durability == DURABILITY_BATCHED:
+            commit_thread = threading.Thread(target=self.run_group_commits)
+            commit_thread.daemon = True
+            commit_thread.start()
+
+    # Apply the updates left in the logs by a crash, the one of an unfinished checkpoint first, then start with an empty log.
+    # Notes taken while applying them are appended to the current log, so that they are found after another crash.
+    def recover(self):
+        paths = [path for path in (self.old_path, self.path) if os.path.exists(path)]
+        self.recovering = True
+        for path in paths:
+            for metadata, _ in read_records(path):
+                if "note" in metadata:
+                    self.notes.setdefault(metadata["note"], metadata["state"])
+        count = 0
+        for path in paths:
+            for metadata, data in read_records(path):
+                if "note" in metadata:
+                    continue
+                self.appended += 1
+                self.apply(metadata, data, None, self.mark_applied)
+                count += 1
+        self.wait_for_writes()
+        if count:
+            print(f"Recovered {count} updates from the write-ahead log")
+        sync_file_system()
+        with self.lock:
+            self.file.truncate(0)
+            os.fsync(self.file.fileno())
+        if os.path.exists(self.old_path):
+            os.remove(self.old_path)
+        self.notes = {}
+        self.recovering = False
+
+    # Called right before a file is moved, with the sequence number of the update and the content hash of the file.
+    # Returns False if the update is applied again on recovery and the file no longer has the content it had
+    # when it was moved before the crash. Otherwise the hash is synced to the log before the file is moved.
+    def prepare_move(self, seq, file_hash):
+        if seq in self.notes:
+            return self.notes[seq] == file_hash
+        with self.lock:
+            self.file.write(encode_record({"note": seq, "state": file_hash}, None))
+            self.file.flush()
+            file = self.file
+        os.fsync(file.fileno())
+        return True
+
+    # Log updates (list of (metadata, data)) of a client and call on_durable once they are safely on disk
+    def append(self, records, client_address, on_durable):
+        with self.lock:
+            for index, (metadata, data) in enumerate(records):
+                # Sequence number in the log, referred to by the notes taken while the update is applied
+                metadata["seq"] = self.appended + index
+                self.file.write(encode_record(metadata, data))
+            self.appended += len(records)
+            entry = (records, client_address, on_durable)
+
+            if self.durability == DURABILITY_ALWAYS:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            else:
+                self.unsynced.append(entry)
+                self.lock.notify_all()
+                return
+        self.release([entry])
+
+    # Sync all updates appended within the group window with a single fsync
+    def run_group_commits(self):
+        while True:
+            with self.lock:
+                while not self.unsynced:
+                    self.lock.wait()
+                # Give updates arriving right after the first one the chance to join the group
+                deadline = time.monotonic() + self.group_window
+                while sum(len(entry[0]) for entry in self.unsynced) < self.max_group:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.lock.wait(remaining)
+                group = self.unsynced
+                self.unsynced = []
+                self.file.flush()
+                # A checkpoint only replaces the file once the group was released
+                file = self.file
+            os.fsync(file.fileno())
+            self.release(group)
+
+    # Hand durable updates over to be applied and send their acknowledgements
+    def release(self, entries):
+        for records, client_address, on_durable in entries:
+            for metadata, data in records:
+                self.apply(metadata, data, client_address, self.mark_applied)
+            on_durable()
+
+    def mark_applied(self):
+        with self.applied_condition:
+            self.applied += 1
+            self.applied_condition.notify_all()
+        self.checkpoint_if_due()
+
+    # Block until all appended updates were applied to the file tree, e.g. before reading from it
+    def wait_for_writes(self):
+        with self.lock:
+            appended = self.appended
+        with self.applied_condition:
+            while self.applied < appended:
+                self.applied_condition.wait()
+
+    # Start a new log once all updates in the current one were applied. The old log is deleted once the file tree
+    # was synced to disk, which can take seconds and is done outside the lock, so appends and group commits go on.
+    def checkpoint_if_due(self):
+        with self.lock:
+            if (self.recovering or self.checkpointing or self.applied < self.appended
+                    or self.file.tell() < self.checkpoint_size):
+                return
+            self.checkpointing = True
+            self.file.close()
+            os.replace(self.path, self.old_path)
+            self.file = open(self.path, 'ab')
+            # The new log has to be found after a crash, the updates appended to it are acknowledged
+            sync_directory(self.wal_dir)
+        try:
+            sync_file_system()
+            os.remove(self.old_path)
+        finally:
+            self.checkpointing = False
+
+    def close(self):
+        self.wait_for_writes()
+        with self.lock:
+            self.file.close()
+
+
+def encode_record(metadata, data):
+    metadata_bytes = json.dumps(dict(metadata, has_data=data is not None)).encode()
+    data = bytes(data) if data is not None else b""
+    checksum = zlib.crc32(data, zlib.crc32(metadata_bytes))
+    return RECORD_HEADER.pack(len(metadata_bytes), len(data), checksum) + metadata_bytes + data
+
+
+# Records of a log file, up to its end or a record torn by a crash
+def read_records(path):
+    with open(path, 'rb') as file:
+        while True:
+            record = read_record(file)
+            if record is None:
+                return
+            yield record
+
+
+# Read the next record, None at the end of the log or at a record torn by a crash
+def read_record(file):
+    header = file.read(RECORD_HEADER.size)
+    if len(header) < RECORD_HEADER.size:
+        return None
+    metadata_size, data_size, checksum = RECORD_HEADER.unpack(header)
+    metadata_bytes = file.read(metadata_size)
+    data = file.read(data_size)
+    if len(metadata_bytes) < metadata_size or len(data) < data_size:
+        return None
+    if zlib.crc32(data, zlib.crc32(metadata_bytes)) != checksum:
+        return None
+    metadata = json.loads(metadata_bytes)
+    return metadata, data if metadata.pop("has_data", False) else None
+
+
+# Persist the entries of a directory, e.g. a renamed file (not possible on Windows)
+def sync_directory(path):
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    directory = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+
+# Write all modified files to disk, so that the updates in the log are no longer needed.
+# Without os.sync (Windows) the log is emptied anyway and only the acknowledged updates since the
+# last checkpoint are protected.
+def sync_file_system():
+    if hasattr(os, "sync"):
+        os.sync()
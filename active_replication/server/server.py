@@ -3,12 +3,30 @@ import os
 import sys
 import socket
 import json
-import base64
+import time
 import shutil
-import pandas as pd
+import signal
+import threading
+import multiprocessing
 
 sys.path.append("../")
-from resources.message_sending import send_message, receive_message
+from resources.message_sending import send_message, receive_message, load_message, decode_data, negotiate_protocol, set_protocol, reset_protocol, negotiate_transport, set_transport, unpack_batch, set_compressions, set_max_send_rate, get_transport_stats, BINARY_PROTOCOL, RELIABLE_TRANSPORT
+from resources.compression import negotiate_compressions, compression_stats
+from resources.metrics import metrics, start_metrics_server
+from resources.profiling import tracer, start_profiling
+from resources.delta_sync import SignatureCache, apply_delta
+from resources.merkle_tree import FileHashCache, build_tree
+from resources.temp_files import get_temp_path
+from components.upload_receiver import UploadReceiver
+from components.file_store import FileStore, BlobStore
+from components.user_store import UserStore
+from components.operation_log import OperationLog
+from components.storage_executor import StorageExecutor
+from components.write_ahead_log import WriteAheadLog, DURABILITY_MODES, DURABILITY_NONE
+from components.tombstones import Tombstones
+from components.anti_entropy import AntiEntropy, REPAIR_ACTIONS, is_safe_path
+from components.forwarder import Forwarder
+from components.change_notifier import ChangeNotifier
 
 # Import server configuration
 # Load configuration from the JSON file
@@ -19,6 +37,27 @@ with open('server_config.json', 'r') as config_file:
 SERVER_HOST = config["server_host"]
 SERVER_PORT = config["server_port"]
 SERVER_DIR = config["server_dir"]
+MAX_CHUNK_SIZE = config["max_chunk_size"]
+UPLOAD_WINDOW = config["upload_window"]
+WORKERS = config["workers"]
+STORAGE = config["storage"]
+USERS_FILE = config["users_file"]
+MAX_BATCH_MESSAGES = config["max_batch_messages"]
+DURABILITY = config["durability"]
+GROUP_COMMIT_WINDOW = config["group_commit_window"]
+IO_WORKERS = config["io_workers"]
+PEERS = config["peers"]
+ANTI_ENTROPY_INTERVAL = config["anti_entropy_interval"]
+REPAIR_RATE = config["repair_rate"]
+REPLICA_ACKS = config["replica_acks"]
+METRICS_PORT = config["metrics_port"]
+MAX_SEND_RATE = config["max_send_rate"]
+# Trace file and seconds of stack and memory sampling, only set on the command line
+PROFILE = None
+PROFILE_WINDOW = None
+
+# Messages of clients that change the user folder
+CLIENT_UPDATE_ACTIONS = ("update", "batch", "upload_start", "upload_chunk", "upload_end")
 
 def get_local_ip():
     try:
@@ -33,13 +72,31 @@ def get_local_ip():
         return None
 
 def parse_command_line_args():
-    global SERVER_HOST, SERVER_PORT, SERVER_DIR
+    global SERVER_HOST, SERVER_PORT, SERVER_DIR, MAX_CHUNK_SIZE, UPLOAD_WINDOW, WORKERS, STORAGE, MAX_BATCH_MESSAGES, DURABILITY, GROUP_COMMIT_WINDOW, IO_WORKERS, PEERS, ANTI_ENTROPY_INTERVAL, REPAIR_RATE, REPLICA_ACKS, METRICS_PORT, MAX_SEND_RATE, USERS_FILE, PROFILE, PROFILE_WINDOW
     parser = argparse.ArgumentParser(description="Client replicating Dropbox functionality by syncing files and folders in the background")
     
     # Add command-line arguments to overwrite configuration values
+    parser.add_argument('--server-host', help='Address to bind to, the address of the outgoing network interface by default')
     parser.add_argument('--server-port', type=int, help='Server port number')
     parser.add_argument('--debug', action='store_true', help='Decide whether sent messages should be logged for debugging')
     parser.add_argument('--server-dir', help='Server directory path')
+    parser.add_argument('--max-chunk-size', type=int, help='Largest chunk in bytes accepted for streamed uploads')
+    parser.add_argument('--upload-window', type=int, help='Maximum number of streamed chunks a client may have in flight')
+    parser.add_argument('--workers', type=int, help='Number of server processes sharing the port, each serving a share of the clients')
+    parser.add_argument('--max-batch-messages', type=int, help='Largest number of updates a client may send in one batch')
+    parser.add_argument('--storage', choices=["files", "blobs"], help='Store files as plain files or deduplicated by content hash')
+    parser.add_argument('--durability', choices=DURABILITY_MODES, help='Acknowledge updates without syncing them to disk, after a group commit of the write-ahead log or after syncing each one')
+    parser.add_argument('--group-commit-window', type=float, help='Seconds to wait for further updates before syncing the write-ahead log')
+    parser.add_argument('--peers', nargs='+', help='Addresses (host:port) of the other servers, which repair each other in the background')
+    parser.add_argument('--anti-entropy-interval', type=float, help='Seconds between two comparisons of the user folders with the peers')
+    parser.add_argument('--repair-rate', type=int, help='Bytes per second a server may pull from its peers to repair its folders')
+    parser.add_argument('--replica-acks', type=int, help='Number of peers that have to confirm the updates of clients uploading only to this server before they are acknowledged')
+    parser.add_argument('--metrics-port', type=int, help='Local port serving counters and latency histograms in the Prometheus text format, workers use the following ports')
+    parser.add_argument('--max-send-rate', type=int, help='Bytes per second a server process may send to its clients and peers together')
+    parser.add_argument('--io-workers', type=int, help='Number of threads writing updates to disk, updates of different paths are written in parallel')
+    parser.add_argument('--users-file', help='CSV file with the usernames and passwords')
+    parser.add_argument('--profile', help='Record the time spent in each stage of every message and save it as a Chrome trace to this file on exit, workers add their number to the name')
+    parser.add_argument('--profile-window', type=float, help='Seconds after the start to sample the stacks of all threads and the memory allocations (with --profile)')
 
     args = parser.parse_args()
 
@@ -48,10 +105,45 @@ def parse_command_line_args():
     else: 
         os.environ["DEBUG"] = "off"
 
-    SERVER_HOST = get_local_ip()
+    SERVER_HOST = args.server_host or get_local_ip()
     # Update the configuration based on the command-line arguments
     if args.server_port:
         SERVER_PORT = args.server_port
+    if args.max_chunk_size:
+        MAX_CHUNK_SIZE = args.max_chunk_size
+    if args.upload_window:
+        UPLOAD_WINDOW = args.upload_window
+    if args.workers:
+        WORKERS = args.workers
+    if args.storage:
+        STORAGE = args.storage
+    if args.max_batch_messages:
+        MAX_BATCH_MESSAGES = args.max_batch_messages
+    if args.durability:
+        DURABILITY = args.durability
+    if args.group_commit_window is not None:
+        GROUP_COMMIT_WINDOW = args.group_commit_window
+    if args.io_workers:
+        IO_WORKERS = args.io_workers
+    if args.peers:
+        PEERS = args.peers
+    if args.anti_entropy_interval:
+        ANTI_ENTROPY_INTERVAL = args.anti_entropy_interval
+    if args.repair_rate:
+        REPAIR_RATE = args.repair_rate
+    if args.replica_acks is not None:
+        REPLICA_ACKS = args.replica_acks
+    if args.metrics_port:
+        METRICS_PORT = args.metrics_port
+    if args.max_send_rate:
+        MAX_SEND_RATE = args.max_send_rate
+    if args.users_file:
+        USERS_FILE = args.users_file
+    if args.profile:
+        PROFILE = args.profile
+        PROFILE_WINDOW = args.profile_window
+    # Peers are recognized by the address their messages come from
+    PEERS = [parse_peer(peer) for peer in PEERS]
     if args.server_dir and os.path.exists(args.server_dir):
         SERVER_DIR = args.server_dir
     elif ((args.server_dir and not os.path.exists(args.server_dir)) or
@@ -59,11 +151,84 @@ def parse_command_line_args():
         print("The server directory does not exist.")
         sys.exit(0)
 
+def parse_peer(peer):
+    host, port = peer.rsplit(":", 1)
+    return (socket.gethostbyname(host), int(port))
+
+# Server paths an update changes, updates of the same paths are applied in order
+def get_server_paths(update, username):
+    if update["event_type"] == "moved":
+        return [os.path.join(SERVER_DIR, username, update["src_path"]), os.path.join(SERVER_DIR, username, update["dest_path"])]
+    return [os.path.join(SERVER_DIR, username, update["path"])]
+
+# Several processes can only share a port if the kernel balances datagrams between them by sender address
+def supports_reuse_port():
+    return hasattr(socket, "SO_REUSEPORT") and sys.platform.startswith("linux")
+
 class Server:
-    def __init__(self, host, port):
+    def __init__(self, host, port, reuse_port=False, name="server"):
+        # With several workers, each one only knows the clients the kernel assigns to it
         self.logged_in_clients = {}
+        # Client ids sent at login, applied updates are logged per client id
+        self.client_ids = {}
+        self.operation_log = OperationLog(os.path.join(SERVER_DIR, ".oplog"), name)
+        self.signature_cache = SignatureCache()
+        # Hash trees of the user folders, built when a client starts reconciling after login
+        self.hash_cache = FileHashCache()
+        self.trees = {}
+        # Deletions are remembered, so that replicas repairing each other do not bring back deleted files
+        self.tombstones = Tombstones(os.path.join(SERVER_DIR, ".tombstones"), name)
+        self.store = BlobStore(SERVER_DIR) if STORAGE == "blobs" else FileStore(SERVER_DIR)
+        # Users "database", loaded once and kept in memory. Workers only read the file, the parent hashed it.
+        self.user_store = UserStore(USERS_FILE, rewrite=name == "server")
+        self.upload_receiver = UploadReceiver(MAX_CHUNK_SIZE, UPLOAD_WINDOW, self.store, sync=DURABILITY != DURABILITY_NONE)
+        # File operations run on I/O threads, so the receiving thread never waits for the disk
+        self.executor = StorageExecutor(IO_WORKERS)
+        # Updates applied for a user are pushed to the other devices the user is logged in from
+        self.notifier = ChangeNotifier(SERVER_DIR, lambda message, client_address: send_message(self.server_socket, message, client_address))
+        # Updates are acknowledged once they are durable in the log and written to the file tree in the background.
+        # Created last, as updates left by a crash are applied right away.
+        self.wal = None
+        if DURABILITY != DURABILITY_NONE:
+            self.wal = WriteAheadLog(os.path.join(SERVER_DIR, ".wal"), name, DURABILITY, self.materialize, GROUP_COMMIT_WINDOW)
+            self.wal.recover()
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reuse_port:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_socket.bind((host, port))
+        set_max_send_rate(self.server_socket, MAX_SEND_RATE)
+
+        # Replicas compare their folders with each other in the background, talking binary frames over the reliable transport.
+        # Every worker process has a transport session of its own, while the peers see a single address and the kernel
+        # hands all their datagrams to one worker, so only a single server process talks to the peers on its own.
+        self.anti_entropy = None
+        if PEERS and name == "server":
+            for peer in PEERS:
+                set_protocol(self.server_socket, BINARY_PROTOCOL, peer)
+                set_transport(self.server_socket, RELIABLE_TRANSPORT, peer)
+            self.anti_entropy = AntiEntropy(self, SERVER_DIR, PEERS, ANTI_ENTROPY_INTERVAL, REPAIR_RATE)
+
+        # Clients may upload only to this server, which then forwards their updates to the peers. Confirmations
+        # of the peers could reach any worker process, so only a single server process forwards.
+        self.forwarder = None
+        if PEERS and name == "server":
+            self.forwarder = Forwarder(self.server_socket, PEERS, REPLICA_ACKS)
+        self.primary_clients = set()
+        self.register_gauges()
+
+    # Queue depths, only read when the metrics are scraped
+    def register_gauges(self):
+        metrics.register_gauge("logged_in_clients", lambda: len(self.logged_in_clients))
+        metrics.register_gauge("storage_operations_pending", lambda: self.executor.pending)
+        metrics.register_gauge("push_changes_queued", self.notifier.get_queued)
+        metrics.register_gauge("transport_congestion_window", lambda: get_transport_stats(self.server_socket)[0], "peer")
+        metrics.register_gauge("transport_smoothed_rtt_seconds", lambda: get_transport_stats(self.server_socket)[1], "peer")
+        if self.wal is not None:
+            metrics.register_gauge("wal_updates_unapplied", lambda: self.wal.appended - self.wal.applied)
+        if self.forwarder is not None:
+            metrics.register_gauge("forwarded_messages_pending", lambda: len(self.forwarder.pending))
+        if self.anti_entropy is not None:
+            metrics.register_gauge("repair_pulls_queued", self.anti_entropy.pulls.qsize)
 
     # Main function dedicated to each client
     def handle_clients(self):
@@ -78,19 +243,44 @@ class Server:
                 try:
                     for item in messages:
                         # Perform update handling
-                        message = json.loads(item)
-                        if message["action"] == "update" and sender_address in self.logged_in_clients:
-                            self.handle_update(message, sender_address)
+                        message = load_message(item)
+                        if message["action"] in CLIENT_UPDATE_ACTIONS and sender_address in self.logged_in_clients:
+                            with tracer.message(message["id"]):
+                                self.handle_client_update(message, sender_address)
                         # Perform login handling
                         elif message["action"] == "login":
                             self.handle_login(message, sender_address)
+                        # Answer block signature requests used for delta syncing
+                        elif message["action"] == "signatures" and sender_address in self.logged_in_clients:
+                            self.handle_signatures(message, sender_address)
+                        # Answer hash tree requests of clients reconciling their folder
+                        elif message["action"] == "tree" and sender_address in self.logged_in_clients:
+                            self.handle_tree(message, sender_address)
+                        # Send copies of files changed by other devices to clients reconciling their folder
+                        elif message["action"] == "fetch" and sender_address in self.logged_in_clients:
+                            self.handle_fetch(message, sender_address)
+                        # Apply updates a primary server forwarded and confirm them
+                        elif message["action"] == "forward" and sender_address in PEERS:
+                            with tracer.message(message.get("id")):
+                                self.handle_forward(message, sender_address)
+                        elif message["action"] == "forward_ack" and self.forwarder is not None and sender_address in PEERS:
+                            self.forwarder.confirm(message["seq"], sender_address)
+                        # Hand repair messages of other servers over to the anti-entropy thread
+                        elif message["action"] in REPAIR_ACTIONS and self.anti_entropy is not None and sender_address in PEERS:
+                            self.anti_entropy.receive(message, sender_address)
                         # Remove client on disconnect
                         elif message["action"] == "disconnect":
                             print(f"{sender_address} disconnected")
                             if sender_address in self.logged_in_clients:
                                 del self.logged_in_clients[sender_address]
-                except json.JSONDecodeError:
-                    print("Error decoding JSON message")
+                            self.client_ids.pop(sender_address, None)
+                            self.primary_clients.discard(sender_address)
+                            self.notifier.remove_session(sender_address)
+                            self.trees.pop(sender_address, None)
+                            reset_protocol(self.server_socket, sender_address)
+                            self.upload_receiver.abort_all(sender_address)
+                except ValueError:
+                    print("Error decoding message")
         except KeyboardInterrupt:
             message = {
                 "action": "shutdown"
@@ -99,55 +289,148 @@ class Server:
             for client in self.logged_in_clients.keys():
                 send_message(self.server_socket, message, client)
 
-    # Define what to do on specific client messages
-    def handle_update(self, message, client_address):
+    # Apply an update, batch or upload message of a client and acknowledge it once it is done. The whole id range
+    # of a batch is acknowledged with a single reply. Messages of clients uploading only to this server are
+    # forwarded to the peers and acknowledged once they are replicated.
+    def handle_client_update(self, message, client_address):
+        username = self.logged_in_clients[client_address]
+        client_id = self.client_ids.get(client_address)
+
+        reply = {
+            "action": "received",
+            "id": message["id"]
+        }
+        if "last_id" in message:
+            reply["last_id"] = message["last_id"]
+
+        on_done = lambda: send_message(self.server_socket, reply, client_address)
+        if client_address in self.primary_clients:
+            on_done = self.forwarder.fan_out(message, client_address, username, client_id, on_done)
+        self.apply_client_message(message, client_address, username, client_id, on_done)
+
+    # Apply a client message a primary server forwarded, on behalf of the client, and confirm it to the primary
+    def handle_forward(self, message, primary):
+        origin = message.pop("origin")
+        message["action"] = message.pop("forwarded_action")
+        confirmation = {
+            "action": "forward_ack",
+            "seq": origin["seq"]
+        }
+        on_done = lambda: send_message(self.server_socket, confirmation, primary)
+        self.apply_client_message(message, tuple(origin["address"]), origin["user"], origin["client"], on_done)
+
+    def apply_client_message(self, message, client_address, username, client_id, on_done):
+        if message["action"] == "update":
+            self.write_updates([message], message["id"], client_address, username, client_id, on_done)
+        elif message["action"] == "batch":
+            self.write_updates(unpack_batch(message), message["id"], client_address, username, client_id, on_done)
+        else:
+            self.handle_upload(message, client_address, username, client_id, on_done)
+
+    # Apply updates with consecutive message ids and call on_done. Without a write-ahead log, on_done is called
+    # once the I/O threads applied all updates. With it, on_done is called once the updates are durable in the
+    # log, the file tree is changed afterwards in the background.
+    def write_updates(self, updates, first_id, client_address, username, client_id, on_done):
+        self.log_accepted(client_id, first_id, first_id + len(updates) - 1)
+        if self.wal is None:
+            operations = []
+            for index, update in enumerate(updates):
+                operations.append((get_server_paths(update, username),
+                                   self.make_operation(update, username, client_id, first_id + index, client_address)))
+            self.executor.submit_all(operations, on_done)
+            return
+
+        records = []
+        for index, update in enumerate(updates):
+            metadata = {key: value for key, value in update.items() if key not in ("action", "id", "last_id", "data")}
+            metadata["user"] = username
+            metadata["client"] = client_id
+            metadata["message_id"] = first_id + index
+            records.append((metadata, decode_data(update["data"]) if "data" in update else None))
+        with tracer.span("wal_append", first_id):
+            self.wal.append(records, client_address, on_done)
+
+    # Apply an update from the write-ahead log to the file tree, client_address is None during recovery
+    def materialize(self, metadata, data, client_address, on_applied):
+        update = {key: value for key, value in metadata.items() if key not in ("user", "client", "message_id", "seq")}
+        if data is not None:
+            update["data"] = data
+        operation = self.make_operation(update, metadata["user"], metadata["client"], metadata["message_id"], client_address, metadata.get("seq"))
+        self.executor.submit(get_server_paths(update, metadata["user"]), operation, on_applied)
+
+    # Operation applying an update on an I/O thread and logging it, wal_seq is the sequence number in the write-ahead log
+    def make_operation(self, update, username, client_id, message_id, client_address, wal_seq=None):
+        labels = {"event_type": update["event_type"]}
+
+        def operation():
+            try:
+                with metrics.timer("update_apply_seconds", labels), tracer.message(message_id), tracer.span("disk_write", path=update.get("path", update.get("dest_path"))):
+                    self.apply_update(update, username, client_address, wal_seq)
+                self.notifier.notify(username, client_address, update)
+            except OSError as e:
+                # Not logged, so the update counts as missed and the client sends it again after its next login
+                print(f"Error applying update of {update.get('path', update.get('src_path'))}: {e}")
+                return
+            self.log_operation(client_id, username, message_id, update)
+            metrics.inc("updates_applied_total", labels)
+            if update.get("data") is not None:
+                metrics.inc("update_bytes_applied_total", labels, len(update["data"]))
+        return operation
+
+    def apply_update(self, message, username, client_address=None, wal_seq=None):
         if os.environ["DEBUG"] == "on": 
             print(message["event_type"])
 
         if message["event_type"] == "modified":
-            # Handle file modification event with differences maybe to be added (?)
-
-            # For the moment, use the same logic as for file creation
-            # Handle file creation event
-            server_path = os.path.join(SERVER_DIR, self.logged_in_clients[client_address], message["path"])
-
-            # Decode the Base64-encoded data received from the client
-            client_data_base64 = message["data"]
-            client_data_bytes = base64.b64decode(client_data_base64)
-
-            # Write the client data to the server file
-            with open(server_path, 'wb') as server_file:
-                server_file.write(client_data_bytes)
+            # Handle file modification event
+            server_path = os.path.join(SERVER_DIR, username, message["path"])
+
+            if "data" not in message:
+                # Only the hash was sent, the content has to be stored already
+                self.link_content(message, server_path, client_address)
+            elif "delta" in message:
+                # Rebuild the file from the delta, asking for the whole file if that fails
+                if not self.apply_delta_update(server_path, message["delta"], decode_data(message["data"])):
+                    self.request_resync(message["path"], client_address)
+            else:
+                # Write the client data (Base64-encoded for JSON messages) to the server file
+                self.store.write(server_path, decode_data(message["data"]))
+                self.signature_cache.invalidate(server_path)
 
         elif message["event_type"] == "deleted":
             # Handle file deletion event
-            server_path = os.path.join(SERVER_DIR, self.logged_in_clients[client_address], message["path"])
+            server_path = os.path.join(SERVER_DIR, username, message["path"])
             if os.path.exists(server_path):
                 if message["structure"] == "dir":
-                    shutil.rmtree(server_path)
+                    self.store.remove_tree(server_path)
                 else:
-                    os.remove(server_path)
+                    self.store.remove(server_path)
+                    self.signature_cache.invalidate(server_path)
+            self.tombstones.record(username, message["path"])
 
         elif message["event_type"] == "created":
             # Handle file creation event
-            server_path = os.path.join(SERVER_DIR, self.logged_in_clients[client_address], message["path"])
+            server_path = os.path.join(SERVER_DIR, username, message["path"])
 
             if message["structure"] == "dir":
-                os.makedirs(server_path)
+                os.makedirs(server_path, exist_ok=True)
+            elif "data" not in message:
+                # Only the hash was sent, the content has to be stored already
+                self.link_content(message, server_path, client_address)
             else:
-                # Decode the Base64-encoded data received from the client
-                client_data_base64 = message["data"]
-                client_data_bytes = base64.b64decode(client_data_base64)
+                # Decode the data received from the client (Base64-encoded for JSON messages)
+                client_data_bytes = decode_data(message["data"])
 
                 # Write the decoded data to the file on the server
-                with open(server_path, 'wb') as server_file:
-                    server_file.write(client_data_bytes)
+                self.store.write(server_path, client_data_bytes)
+                self.signature_cache.invalidate(server_path)
 
         elif message["event_type"] == "moved":
             # Handle file move/rename event
-            src_server_path = os.path.join(SERVER_DIR, self.logged_in_clients[client_address], message["src_path"])
-            dest_server_path = os.path.join(SERVER_DIR, self.logged_in_clients[client_address], message["dest_path"])
-            if os.path.exists(src_server_path):
+            src_server_path = os.path.join(SERVER_DIR, username, message["src_path"])
+            dest_server_path = os.path.join(SERVER_DIR, username, message["dest_path"])
+            self.tombstones.record(username, message["src_path"])
+            if os.path.exists(src_server_path) and self.prepare_move(message, src_server_path, dest_server_path, wal_seq):
                 if message["structure"] == "dir":
                     try:
                         shutil.move(src_server_path, dest_server_path)
@@ -158,22 +441,190 @@ class Server:
                         os.rename(src_server_path, dest_server_path)
                     except:
                         pass
+                # Moving keeps the modification time, but peers have to see the new path as changed after the old one was deleted
+                if os.path.exists(dest_server_path):
+                    os.utime(dest_server_path)
+
+    # Whether a move from the write-ahead log is applied. Moved files are noted in the log first, so that a move
+    # applied before a crash is not applied again to a file created anew at the source. Folders are not moved
+    # again on recovery if the destination exists.
+    def prepare_move(self, message, src_server_path, dest_server_path, wal_seq):
+        if wal_seq is None:
+            return True
+        if message["structure"] == "dir":
+            return not (self.wal.recovering and os.path.exists(dest_server_path))
+        return self.wal.prepare_move(wal_seq, self.hash_cache.get(src_server_path))
+
+    # Record updates that are about to be applied, until they are logged as applied they count as missed
+    def log_accepted(self, client_id, first_id, last_id):
+        if client_id is None:
+            return
+        self.operation_log.accept(client_id, first_id, last_id)
+
+    # Record an applied update in the operation log, so that the client knows what this server missed
+    def log_operation(self, client_id, username, message_id, update):
+        if client_id is None:
+            return
+        if "delta" in update:
+            update = dict(update, file_hash=update["delta"]["file_hash"])
+        self.operation_log.append(client_id, message_id, username, update)
+
+    # Create a file from content the server already stores, asking for the whole file if it does not
+    def link_content(self, message, server_path, client_address):
+        if self.store.link(message["file_hash"], server_path):
+            self.signature_cache.invalidate(server_path)
+        else:
+            self.request_resync(message["path"], client_address)
+
+    # Ask the client for the whole file, unless the update is applied during recovery or was
+    # forwarded for a client that is not logged in here
+    def request_resync(self, path, client_address):
+        if client_address not in self.logged_in_clients:
+            return
+        resync_message = {
+            "action": "resync",
+            "path": path
+        }
+        send_message(self.server_socket, resync_message, client_address)
+
+    # Handle the start, chunks and end of a streamed upload
+    def handle_upload(self, message, client_address, username, client_id, on_done):
+        user_dir = os.path.join(SERVER_DIR, username)
+        upload_id = message["upload_id"]
+
+        if message["action"] == "upload_start":
+            server_path = os.path.join(user_dir, message["path"])
+            # The temporary file is created next to the target, after the updates sent before the upload
+            self.wait_for_writes(server_path)
+            self.upload_receiver.start(client_address, upload_id, server_path)
+
+        elif message["action"] == "upload_chunk":
+            # Chunks are written straight to the temporary file of the upload
+            data = decode_data(message["data"])
+            with tracer.span("disk_write", seq=message["seq"]):
+                written = self.upload_receiver.write_chunk(client_address, upload_id, message["offset"], data)
+            if not written:
+                print(f"Dropped chunk {message['seq']} of upload {upload_id}")
+
+        elif message["action"] == "upload_end":
+            self.log_accepted(client_id, message["id"], message["id"])
+            server_path = self.upload_receiver.get_path(client_address, upload_id)
+            if server_path is not None:
+                # The complete file is moved into place on an I/O thread, acknowledged once it is there
+                self.wait_for_writes(server_path)
+                operation = lambda: self.finish_upload(message, client_address, username, client_id, user_dir)
+                self.executor.submit([server_path], operation, on_done)
+                return
+
+        on_done()
+
+    def finish_upload(self, message, client_address, username, client_id, user_dir):
+        server_path, complete = self.upload_receiver.finish(client_address, message["upload_id"], message["chunks"], message["size"])
+        if server_path is None:
+            return
+        self.signature_cache.invalidate(server_path)
+        update = {
+            "event_type": "modified",
+            "structure": "file",
+            "path": os.path.relpath(server_path, user_dir),
+            "file_hash": message["file_hash"]
+        }
+        self.log_operation(client_id, username, message["id"], update)
+        if complete:
+            self.notifier.notify(username, client_address, update)
+        else:
+            # Ask for the whole file again if chunks went missing
+            self.request_resync(os.path.relpath(server_path, user_dir), client_address)
+
+    # Files are read only after the updates received before were written to the file tree
+    def wait_for_writes(self, path):
+        if self.wal is not None:
+            self.wal.wait_for_writes()
+        self.executor.wait(path)
+
+    # Apply a block-level delta to a file, returns False if the base file does not match
+    def apply_delta_update(self, server_path, delta, delta_bytes):
+        if not os.path.isfile(server_path):
+            return False
+        if self.signature_cache.get(server_path)["file_hash"] != delta["base_hash"]:
+            return False
+
+        # Reconstruct next to the original and swap it in once the result is verified
+        temp_path = get_temp_path(server_path, "delta")
+        try:
+            file_hash = apply_delta(server_path, delta_bytes, delta["block_size"], temp_path)
+            if file_hash != delta["file_hash"]:
+                os.remove(temp_path)
+                return False
+            self.store.replace(temp_path, server_path, file_hash)
+        except (OSError, ValueError) as e:
+            print(f"Error applying delta to {server_path}: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return False
+
+        self.signature_cache.invalidate(server_path)
+        return True
+
+    # Send the block signatures of a file to the client
+    def handle_signatures(self, message, client_address):
+        server_path = os.path.join(SERVER_DIR, self.logged_in_clients[client_address], message["path"])
+        self.wait_for_writes(server_path)
 
         reply = {
-            "action": "received",
-            "id": message["id"]
+            "action": "signatures",
+            "path": message["path"],
+            "exists": os.path.isfile(server_path)
         }
 
+        if reply["exists"]:
+            signatures = self.signature_cache.get(server_path)
+            reply["block_size"] = signatures["block_size"]
+            reply["file_hash"] = signatures["file_hash"]
+            reply["data"] = signatures["signatures"]
+
         send_message(self.server_socket, reply, client_address)
 
-    # Handle client login
+    # Send the entries of the requested directories of the user folder. Clients start at the root and only
+    # ask for the directories whose digests differ from their own, the tree is built once per reconciliation.
+    def handle_tree(self, message, client_address):
+        if "" in message["paths"] or client_address not in self.trees:
+            user_dir = os.path.join(SERVER_DIR, self.logged_in_clients[client_address])
+            self.wait_for_writes(user_dir)
+            self.trees[client_address] = build_tree(user_dir, self.hash_cache)
+        tree = self.trees[client_address]
+
+        reply = {
+            "action": "tree",
+            "request_id": message["request_id"],
+            "directories": {path: tree.get(path) for path in message["paths"]}
+        }
+
+        send_message(self.server_socket, reply, client_address)
+
+    # Send the copy of a file, read on an I/O thread once the updates of the file received before were applied
+    def handle_fetch(self, message, client_address):
+        if not is_safe_path(message["path"]):
+            return
+        username = self.logged_in_clients[client_address]
+
+        def operation():
+            reply = self.notifier.build_message(username, {"event_type": "created", "structure": "file", "path": message["path"]})
+            if reply is not None:
+                reply["action"] = "fetched"
+                send_message(self.server_socket, reply, client_address)
+
+        self.executor.submit([os.path.join(SERVER_DIR, username, message["path"])], operation)
+
+    # Handle client login. Checking a password takes tens of milliseconds (PBKDF2), so it is done on an I/O
+    # thread, together with the reply, instead of holding up the messages of all clients.
     def handle_login(self, message, client_address):
+        self.executor.submit([], lambda: self.login(message, client_address))
+
+    def login(self, message, client_address):
         if os.environ["DEBUG"] == "on": 
             print(message["action"])
 
-        # Read users "database"
-        users = pd.read_csv("users.csv")
-
         # Read credentials from message
         username = message["username"]
         password = message["password"]
@@ -185,12 +636,36 @@ class Server:
         }
 
         # Verify Credentials
-        if username in users["username"].unique():
-            saved_password = users[users["username"] == username]["password"].item()
-            if saved_password == password or pd.isnull(saved_password):
+        if self.user_store.exists(username):
+            if self.user_store.verify(username, password):
                 login_message["result"] = "successful"
                 login_message["text"] = "Logged in successfully"
+                # Agree on the wire protocol, clients not offering any keep using JSON
+                login_message["protocol"] = negotiate_protocol(message.get("protocols"))
+                login_message["transport"] = negotiate_transport(message.get("transports"))
+                # Algorithms both sides can decode, the sender decides per message whether to compress
+                login_message["compressions"] = negotiate_compressions(message.get("compressions"))
+                # Announce how large files may be streamed
+                login_message["upload"] = self.upload_receiver.get_limits()
+                login_message["batch_limit"] = MAX_BATCH_MESSAGES
+                # Last update of this client applied here, a replica rejoining after an outage is sent what it missed
+                login_message["last_id"] = self.operation_log.get_last_id(message.get("client_id"))
+                self.operation_log.forget_unapplied(message.get("client_id"))
                 self.logged_in_clients[client_address] = username
+                self.client_ids[client_address] = message.get("client_id")
+                self.trees.pop(client_address, None)
+                # Clients asking to upload only here are accepted if this server forwards to its peers
+                if message.get("replication") == "primary" and self.forwarder is not None:
+                    login_message["replication"] = "primary"
+                    self.primary_clients.add(client_address)
+                else:
+                    login_message["replication"] = "active"
+                    self.primary_clients.discard(client_address)
+                # Clients asking for it are pushed the changes made on the other devices of the user
+                if message.get("push"):
+                    self.notifier.add_session(client_address, username)
+                else:
+                    self.notifier.remove_session(client_address)
                 userpath = os.path.join(SERVER_DIR, username)
                 if not os.path.isdir(userpath):
                     os.makedirs(userpath)
@@ -203,16 +678,27 @@ class Server:
             login_message["text"] = "Username does not exist"
 
         send_message(self.server_socket, login_message, client_address)
-
-
-if __name__ == "__main__":
-    # Parse cmd line args
-    parse_command_line_args()
-
-    # Boot server
+        if login_message["result"] == "successful":
+            set_protocol(self.server_socket, login_message["protocol"], client_address)
+            set_transport(self.server_socket, login_message["transport"], client_address)
+            set_compressions(self.server_socket, login_message["compressions"], client_address)
+
+
+# Boot a server and serve clients until Ctrl+C is pressed
+def run_server(worker=None):
+    name = "Server" if worker is None else f"Worker {worker}"
+    if PROFILE:
+        root, extension = os.path.splitext(PROFILE)
+        start_profiling(PROFILE if worker is None else f"{root}.worker{worker}{extension}", name.lower(), PROFILE_WINDOW)
+    if METRICS_PORT:
+        try:
+            start_metrics_server(METRICS_PORT + (worker or 0))
+        except OSError as e:
+            print(f"Error serving metrics on port {METRICS_PORT + (worker or 0)}: {e}")
     try:
-        server = Server(SERVER_HOST, SERVER_PORT)
-        print(f"Server listening on {SERVER_HOST}:{SERVER_PORT}")
+        server = Server(SERVER_HOST, SERVER_PORT, reuse_port=worker is not None,
+                        name="server" if worker is None else f"worker-{worker}")
+        print(f"{name} listening on {SERVER_HOST}:{SERVER_PORT}")
     except OSError as e:
         print(f"Error binding to {SERVER_HOST}:{SERVER_PORT}: {e}")
         sys.exit(1)
@@ -221,5 +707,77 @@ if __name__ == "__main__":
         sys.exit(1)
 
     server.handle_clients()
+    if server.wal is not None:
+        server.wal.close()
+    server.executor.close()
+    server.tombstones.close()
+    server.operation_log.close()
+
+    if compression_stats.messages:
+        print(compression_stats.summary())
+    tracer.dump()
+    print(f"{name} terminated")
+
+# Start one process per worker, all bound to the same port. The kernel hashes the address of each
+# client to pick the worker, so all messages of a client are handled in order by the same process.
+def run_workers(count):
+    if not supports_reuse_port():
+        print("Multiple workers require SO_REUSEPORT load balancing, which is only available on Linux")
+        sys.exit(1)
+
+    if PEERS:
+        print("Anti-entropy repairs and forwarding to peers are disabled with several workers")
+
+    # Plain text passwords are hashed once, before the workers read the file
+    UserStore(USERS_FILE)
+
+    # Workers inherit the parsed configuration
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=run_worker, args=(worker, os.getpid())) for worker in range(count)]
+
+    # Ctrl+C or a termination signal of the parent is forwarded to every worker, which then notifies its own clients
+    def forward_signal(signum, frame):
+        for process in workers:
+            if process.pid is not None and process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGINT, forward_signal)
+    signal.signal(signal.SIGTERM, forward_signal)
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+
+    print("Server terminated")
+
+# Workers only stop when the parent tells them to (a Ctrl+C in the terminal reaches the parent as well, they
+# are not interrupted twice) or when the parent died, so that no worker keeps the port without it
+def run_worker(worker, parent_pid):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, stop_worker)
+
+    parent_thread = threading.Thread(target=watch_parent, args=(parent_pid,))
+    parent_thread.daemon = True
+    parent_thread.start()
+
+    run_server(worker)
+
+# Shut down like on Ctrl+C, further signals are ignored until the clients are notified
+def stop_worker(signum, frame):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise KeyboardInterrupt
+
+def watch_parent(parent_pid, interval=1):
+    while os.getppid() == parent_pid:
+        time.sleep(interval)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+if __name__ == "__main__":
+    # Parse cmd line args
+    parse_command_line_args()
 
-    print("Server terminated")
\ No newline at end of file
+    if WORKERS > 1:
+        run_workers(WORKERS)
+    else:
+        run_server()
\ No newline at end of file
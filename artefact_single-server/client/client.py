@@ -9,10 +9,15 @@ from watchdog.observers import Observer
 from components.abstract_message_listener import MessageListener
 from components.event_handler import EventHandler
 from components.server_message_notifier import ServerMessageNotifier
+from components.reconciler import Reconciler
+from components.file_index import FileIndex
 
 import sys
 sys.path.append('../')
-from resources.message_sending import send_message
+from resources.message_sending import send_message, set_protocol, SUPPORTED_PROTOCOLS, JSON_PROTOCOL, set_compressions
+from resources.compression import SUPPORTED_COMPRESSIONS, compression_stats
+from resources.metrics import metrics, start_metrics_server
+from resources.profiling import tracer, start_profiling
 
 # Import server configuration
 # Load configuration from the JSON file
@@ -23,9 +28,22 @@ with open('client_config.json', 'r') as config_file:
 SERVER_HOST = config["server_host"]
 SERVER_PORT = config["server_port"]
 CLIENT_DIR = config["client_dir"]
+DELTA_SYNC = config["delta_sync"]
+COMPRESSION = config["compression"]
+UPLOAD_CHUNK_SIZE = config["upload_chunk_size"]
+UPLOAD_WINDOW = config["upload_window"]
+SETTLE_WINDOW = config["settle_window"]
+RECONCILE = config["reconcile"]
+METRICS_PORT = config["metrics_port"]
+# Credentials are never stored in the configuration, only given on the command line
+USERNAME = None
+PASSWORD = None
+# Trace file and seconds of stack and memory sampling, only set on the command line
+PROFILE = None
+PROFILE_WINDOW = None
 
 def parse_command_line_args():
-    global SERVER_HOST, SERVER_PORT, CLIENT_DIR
+    global SERVER_HOST, SERVER_PORT, CLIENT_DIR, DELTA_SYNC, COMPRESSION, UPLOAD_CHUNK_SIZE, UPLOAD_WINDOW, SETTLE_WINDOW, RECONCILE, METRICS_PORT, USERNAME, PASSWORD, PROFILE, PROFILE_WINDOW
     parser = argparse.ArgumentParser(description="Client replicating Dropbox functionality "
                                                  "by syncing files and folders in the background")
     
@@ -34,6 +52,17 @@ def parse_command_line_args():
     parser.add_argument('--server-port', type=int, help='Server port number')
     parser.add_argument('--debug', action='store_true', help='Decide whether sent messages should be logged for debugging')
     parser.add_argument('--client-dir', help='Client directory path')
+    parser.add_argument('--no-delta-sync', action='store_true', help='Always send whole files instead of block-level deltas on modifications')
+    parser.add_argument('--no-compression', action='store_true', help='Never compress the data sent to the server')
+    parser.add_argument('--upload-chunk-size', type=int, help='Size in bytes of the chunks larger files are streamed in')
+    parser.add_argument('--upload-window', type=int, help='Maximum number of streamed chunks waiting for acknowledgement')
+    parser.add_argument('--settle-window', type=float, help='Seconds a path has to stay unchanged before its events are sent')
+    parser.add_argument('--no-reconcile', action='store_true', help='Only sync live changes instead of comparing the whole folder with the server after login')
+    parser.add_argument('--metrics-port', type=int, help='Local port serving counters and latency histograms in the Prometheus text format')
+    parser.add_argument('--username', help='Log in as this user without prompting for the credentials')
+    parser.add_argument('--password', help='Password of the user given with --username, empty if omitted')
+    parser.add_argument('--profile', help='Record the time spent in each stage of every message and save it as a Chrome trace to this file on exit')
+    parser.add_argument('--profile-window', type=float, help='Seconds after the start to sample the stacks of all threads and the memory allocations (with --profile)')
 
     args = parser.parse_args()
 
@@ -42,6 +71,27 @@ def parse_command_line_args():
     else: 
         os.environ["DEBUG"] = "off"
 
+    if args.no_delta_sync:
+        DELTA_SYNC = False
+    if args.no_compression:
+        COMPRESSION = False
+    if args.upload_chunk_size:
+        UPLOAD_CHUNK_SIZE = args.upload_chunk_size
+    if args.upload_window:
+        UPLOAD_WINDOW = args.upload_window
+    if args.settle_window is not None:
+        SETTLE_WINDOW = args.settle_window
+    if args.no_reconcile:
+        RECONCILE = False
+    if args.metrics_port:
+        METRICS_PORT = args.metrics_port
+    if args.username:
+        USERNAME = args.username
+        PASSWORD = args.password or ""
+    if args.profile:
+        PROFILE = args.profile
+        PROFILE_WINDOW = args.profile_window
+
     # Update the configuration based on the command-line arguments
     if args.server_host:
         SERVER_HOST = args.server_host
@@ -59,10 +109,18 @@ class Client(MessageListener):
     def __init__(self):
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.message_handler = ServerMessageNotifier(self.client_socket)
-        self.event_handler = EventHandler(self.client_socket, CLIENT_DIR)
+        # Persistent index of the synced files next to the client directory
+        self.file_index = FileIndex(CLIENT_DIR)
+        self.event_handler = EventHandler(self.client_socket, CLIENT_DIR, self.file_index, DELTA_SYNC, UPLOAD_CHUNK_SIZE, UPLOAD_WINDOW, SETTLE_WINDOW)
+        self.reconciler = Reconciler(self.client_socket, CLIENT_DIR, self.event_handler.coalescer, self.event_handler.push_receiver, self.file_index)
         self.login_response = False
         self.logged_in = False
         self.disconnected = False
+        self.observer = None
+
+        # Queue depths, only read when the metrics are scraped
+        metrics.register_gauge("events_pending", lambda: len(self.event_handler.coalescer.pending))
+        metrics.register_gauge("push_changes_queued", self.event_handler.push_receiver.changes.qsize)
 
     # Handle server messages
     def notify_server_message(self, message):
@@ -70,6 +128,22 @@ class Client(MessageListener):
             self.shutdown("Server disconnected. Closing client...")
         elif message["action"] == "login" or not self.logged_in:
             self.handle_login_message(message)
+        elif message["action"] == "signatures":
+            self.event_handler.receive_signatures(message)
+        elif message["action"] == "tree":
+            self.reconciler.receive_tree(message)
+        elif message["action"] == "resync":
+            self.event_handler.resync(message["path"])
+        elif message["action"] == "upload_ack":
+            self.event_handler.uploader.receive_ack(message)
+        # Changes made on other devices of the user
+        elif message["action"] == "push":
+            self.event_handler.push_receiver.receive(message)
+        # Copies of files fetched while reconciling the folder
+        elif message["action"] == "fetched":
+            self.event_handler.push_receiver.receive(message)
+        elif message["action"] == "push_overflow":
+            print("Some changes made on other devices could not be pushed and are missing in this folder.")
 
     # Connect to server
     def connect(self):
@@ -83,13 +157,20 @@ class Client(MessageListener):
     # Login logic
     def login(self):
         while not self.logged_in:
-            username = input("Enter username: ")
-            password = maskpass.askpass(prompt="Password: ", mask="*")
+            # Credentials given on the command line are used without prompting (e.g. for benchmark runs)
+            if USERNAME:
+                username, password = USERNAME, PASSWORD
+            else:
+                username = input("Enter username: ")
+                password = maskpass.askpass(prompt="Password: ", mask="*")
 
             message = {
                 "action": "login",
                 "username": username,
-                "password": password
+                "password": password,
+                "protocols": SUPPORTED_PROTOCOLS,
+                "compressions": SUPPORTED_COMPRESSIONS if COMPRESSION else [],
+                "push": True
             }
 
             if not self.disconnected:
@@ -107,30 +188,44 @@ class Client(MessageListener):
                 print("Server is not responding. Please try again.")
             elif not self.logged_in:
                 self.login_response = False
+                # Trying the same credentials again would not help
+                if USERNAME:
+                    self.shutdown("Login failed. Closing client...")
 
     def handle_login_message(self, message):
         if message["action"] == "login":
             print(message["text"])
             self.login_response = True
             if message["result"] == "successful":
+                # Switch to the wire protocol chosen by the server (older servers only speak JSON)
+                set_protocol(self.client_socket, message.get("protocol", JSON_PROTOCOL))
+                set_compressions(self.client_socket, message.get("compressions"))
+                self.event_handler.uploader.set_server_limits(message.get("upload"))
+                self.event_handler.batcher.set_server_limit(None, message.get("batch_limit"))
                 self.logged_in = True
         elif message["action"] == "shutdown":
             self.disconnected = True
 
     # Start observing to events
     def start(self):
-        observer = Observer()
-        observer.schedule(self.event_handler, path=CLIENT_DIR, recursive=True)
-        observer.start()
+        self.observer = Observer()
+        self.observer.schedule(self.event_handler, path=CLIENT_DIR, recursive=True)
+        self.observer.start()
 
         # start listening for messages
         self.message_handler.add_listener(self)
-        self.message_handler.start_listening(observer)
+        self.message_handler.start_listening(self.observer)
 
-        observer.join()
+        self.observer.join()
 
     # Run client
     def run(self):
+        if METRICS_PORT:
+            try:
+                start_metrics_server(METRICS_PORT)
+            except OSError as e:
+                print(f"Error serving metrics on port {METRICS_PORT}: {e}")
+
         # Connect to the server
         self.connect()
 
@@ -143,20 +238,41 @@ class Client(MessageListener):
             # Login
             self.login()
 
+            # Sync what changed while the client was not running
+            if RECONCILE:
+                reconcile_thread = threading.Thread(target=self.reconciler.run)
+                reconcile_thread.daemon = True
+                reconcile_thread.start()
+
             listen_thread.join()
-        except (KeyboardInterrupt, ConnectionResetError):
+        except KeyboardInterrupt:
+            self.shutdown("Closing client...", flush=self.logged_in and not self.disconnected)
+        except ConnectionResetError:
             self.shutdown("Closing client...")
 
     # Close client
-    def shutdown(self, message):
+    def shutdown(self, message, flush=False):
         print(message)
         self.message_handler.stop_listening()
+        # No events may come up once the coalescer is flushed and the index is closed
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+        # Send the events still waiting in the coalescer
+        if flush:
+            self.event_handler.coalescer.flush()
+        if compression_stats.messages:
+            print(compression_stats.summary())
+        tracer.dump()
         self.client_socket.close()
+        self.file_index.close()
         sys.exit(0)
 
 if __name__ == "__main__":
     # Parse cmd line args
     parse_command_line_args()
+    if PROFILE:
+        start_profiling(PROFILE, "client", PROFILE_WINDOW)
     # Create Client instance
     client = Client()
     # Start Client instance
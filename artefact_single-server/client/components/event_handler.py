@@ -1,46 +1,211 @@
 import os
-import base64
+import hashlib
+import threading
 from watchdog.events import FileSystemEventHandler
 
 import sys
 sys.path.append('../')
-from resources.message_sending import send_message
+from resources.message_sending import send_message, decode_data, pack_batch
+from resources.delta_sync import compute_delta
+from resources.metrics import metrics
+from resources.profiling import tracer
+from resources.temp_files import is_temporary
+from components.file_uploader import FileUploader
+from components.event_coalescer import EventCoalescer
+from components.update_batcher import UpdateBatcher
+from components.push_receiver import PushReceiver
 
 # Class responsible for detecting events and sending sync messages to server
 class EventHandler(FileSystemEventHandler):
     # Set socket in constructor
-    def __init__(self, client_socket, client_dir):
+    def __init__(self, client_socket, client_dir, file_index, delta_sync=True, upload_chunk_size=1048576, upload_window=8, settle_window=0.5):
         self.client_socket = client_socket
         self.CLIENT_DIR = client_dir
-        # Keep track of recently created/modified files to catch the successive modified event thrown by watchdog
-        self.recently_changed_files = []
+        # Synced files are recorded in the index
+        self.file_index = file_index
+        # Delta sync settings and pending signature requests (path -> waiting request)
+        self.delta_sync = delta_sync
+        self.delta_min_size = 65536
+        self.signature_timeout = 5 # in seconds
+        self.pending_signatures = {}
+        # Files from this size on are first announced by their hash only, in case the server already stores the content
+        self.dedup_min_size = 65536
+        # Large files are streamed in chunks instead of being sent in a single message
+        self.uploader = FileUploader(client_socket, upload_chunk_size, upload_window)
+        # Small updates are sent in batches of up to 128 messages / 256 KB
+        self.batcher = UpdateBatcher(self.send_batch, 128, 262144)
+        # Events are merged per path and only sent once the path settled
+        self.coalescer = EventCoalescer(self, settle_window)
+        # Changes made on other devices of the user are pushed by the server
+        self.push_receiver = PushReceiver(client_dir, file_index, self.coalescer)
         super().__init__()
 
+    # Send an update, small ones are collected into batches
+    def send_update(self, message):
+        labels = {"event_type": message["event_type"]}
+        metrics.inc("updates_sent_total", labels)
+        if message.get("data") is not None:
+            metrics.inc("update_bytes_sent_total", labels, len(message["data"]))
+        if not self.batcher.add(message, [None]):
+            self.batcher.flush()
+            self.send(message)
+
+    def send_batch(self, messages):
+        if len(messages) == 1:
+            self.send(messages[0])
+        else:
+            self.send(pack_batch(messages))
+
+    # Updates carry no ids over TCP. While profiling they are numbered, so that the spans of the client
+    # and the server belonging to one message can be matched.
+    def send(self, message):
+        if tracer.enabled:
+            message["id"] = tracer.next_id()
+            tracer.assign(message["id"])
+        send_message(self.client_socket, message)
+
+    # Called once the coalescer sent all settled events
+    def flush_updates(self):
+        self.batcher.flush()
+
     # MODIFIED logic
     def on_modified(self, event):
-        if event.is_directory:
+        if event.is_directory or is_temporary_path(event.src_path):
             return
+        self.coalescer.on_modified(event.src_path)
 
-        if event.src_path in self.recently_changed_files:
-            self.recently_changed_files.remove(event.src_path)
+    # DELETE logic
+    def on_deleted(self, event):
+        if is_temporary_path(event.src_path):
+            return
+        self.coalescer.on_deleted(event.src_path, event.is_directory)
+
+    # CREATED logic
+    def on_created(self, event):
+        if is_temporary_path(event.src_path):
+            return
+        self.coalescer.on_created(event.src_path, event.is_directory)
+
+    # MOVED logic
+    def on_moved(self, event):
+        # Moves of the contents of a moved directory are covered by the move of the directory
+        if getattr(event, "is_synthetic", False):
+            return
+        # Pushed files are written to a temporary file and moved into place, which creates them
+        if is_temporary_path(event.src_path):
+            self.coalescer.on_created(event.dest_path, event.is_directory)
             return
+        self.coalescer.on_moved(event.src_path, event.dest_path, event.is_directory)
+
+    # CLOSED logic
+    def on_closed(self, event):
+        self.on_modified(event)
 
-        relative_path = os.path.relpath(event.src_path, self.CLIENT_DIR)
-        modified_content = self.read_bytes(event.src_path)
-        data_base64 = base64.b64encode(modified_content).decode('utf-8')
+    # Send a modified file, as a delta against the server's copy or as a hash of known content if possible.
+    # Without allow_delta the whole file is sent.
+    def send_modification(self, file_path, allow_delta=True):
+        self.file_index.record(file_path, False)
+        relative_path = os.path.relpath(file_path, self.CLIENT_DIR)
 
         message = {
             "action": "update",
             "path": relative_path,
-            "event_type": "modified",
-            "data": data_base64
+            "event_type": "modified"
+        }
+
+        delta = self.build_delta(file_path, relative_path) if allow_delta else None
+        if delta is not None:
+            message["delta"] = delta["header"]
+            message["data"] = delta["data"]
+            self.file_index.set_synced(file_path, delta["header"]["file_hash"])
+        elif allow_delta and self.send_hash_only(file_path, relative_path, "modified"):
+            return
+        elif self.uploader.should_stream(file_path):
+            self.batcher.flush()
+            self.file_index.set_synced(file_path, self.uploader.upload(file_path, relative_path, "modified"))
+            return
+        else:
+            message["data"] = self.read_bytes(file_path)
+            self.file_index.set_synced(file_path, hashlib.sha256(message["data"]).hexdigest())
+
+        self.send_update(message)
+
+    # Compute a delta against the block signatures of the server's copy (None = send whole file)
+    def build_delta(self, file_path, relative_path):
+        file_size = os.path.getsize(file_path)
+        if not self.delta_sync or file_size < self.delta_min_size:
+            return None
+
+        reply = self.request_signatures(relative_path)
+        if reply is None or not reply["exists"]:
+            return None
+
+        signatures = decode_data(reply["data"])
+        # Only worth it if the delta is noticeably smaller than the file and fits into the upload window
+        max_literal = min(file_size * 0.9, self.uploader.get_window_bytes())
+        delta = compute_delta(file_path, reply["block_size"], signatures, max_literal=max_literal)
+        if delta is None:
+            return None
+
+        return {
+            "header": {
+                "block_size": reply["block_size"],
+                "base_hash": reply["file_hash"],
+                "file_hash": delta["file_hash"]
+            },
+            "data": delta["data"]
+        }
+
+    # Ask the server for the block signatures of a file and wait for the answer
+    def request_signatures(self, relative_path):
+        self.batcher.flush()
+        request = {"event": threading.Event(), "reply": None}
+        self.pending_signatures[relative_path] = request
+
+        message = {
+            "action": "signatures",
+            "path": relative_path
         }
-        self.recently_changed_files.append(event.src_path)
         send_message(self.client_socket, message)
 
-    # DELETE logic
-    def on_deleted(self, event):
-        relative_path = os.path.relpath(event.src_path, self.CLIENT_DIR)
+        request["event"].wait(self.signature_timeout)
+        self.pending_signatures.pop(relative_path, None)
+        return request["reply"]
+
+    # Called by the client when the server answered a signature request
+    def receive_signatures(self, message):
+        request = self.pending_signatures.get(message["path"])
+        if request is not None and request["reply"] is None:
+            request["reply"] = message
+            request["event"].set()
+
+    # Send only the hash of a file, the server asks for the whole file if it does not store the content yet.
+    # Returns False if the content has to be sent right away.
+    def send_hash_only(self, file_path, relative_path, event_type):
+        if not self.uploader.supports_dedup() or os.path.getsize(file_path) < self.dedup_min_size:
+            return False
+
+        message = {
+            "action": "update",
+            "path": relative_path,
+            "event_type": event_type,
+            "structure": "file",
+            "file_hash": self.file_index.get(file_path)
+        }
+        self.file_index.set_synced(file_path, message["file_hash"])
+        self.send_update(message)
+        return True
+
+    # Called by the client when the server could not apply a delta or does not know a hash and needs the whole file
+    def resync(self, relative_path):
+        file_path = os.path.join(self.CLIENT_DIR, relative_path)
+        if os.path.isfile(file_path):
+            self.coalescer.on_resync(file_path)
+
+    # Send a deletion
+    def send_deleted(self, path, is_directory):
+        self.file_index.remove(path)
+        relative_path = os.path.relpath(path, self.CLIENT_DIR)
 
         message = {
             "action": "update",
@@ -48,16 +213,17 @@ class EventHandler(FileSystemEventHandler):
             "event_type": "deleted"
         }
 
-        if event.is_directory:
+        if is_directory:
             message["structure"] = "dir"
         else:
             message["structure"] = "file"
 
-        send_message(self.client_socket, message)
+        self.send_update(message)
 
-    # CREATED logic
-    def on_created(self, event):
-        relative_path = os.path.relpath(event.src_path, self.CLIENT_DIR)
+    # Send a created file or directory
+    def send_created(self, path, is_directory):
+        self.file_index.record(path, is_directory)
+        relative_path = os.path.relpath(path, self.CLIENT_DIR)
 
         message = {
             "action": "update",
@@ -65,23 +231,27 @@ class EventHandler(FileSystemEventHandler):
             "event_type": "created"
         }
 
-        if event.is_directory:
+        if is_directory:
             message["structure"] = "dir"
         else:
-            data_bytes = self.read_bytes(event.src_path)
-            data_base64 = base64.b64encode(data_bytes).decode('utf-8')
+            if self.send_hash_only(path, relative_path, "created"):
+                return
+            if self.uploader.should_stream(path):
+                self.batcher.flush()
+                self.file_index.set_synced(path, self.uploader.upload(path, relative_path, "created"))
+                return
 
             message["structure"] = "file"
-            message["data"] = data_base64
+            message["data"] = self.read_bytes(path)
+            self.file_index.set_synced(path, hashlib.sha256(message["data"]).hexdigest())
 
-            self.recently_changed_files.append(event.src_path)
+        self.send_update(message)
 
-        send_message(self.client_socket, message)
-
-    # MOVED logic
-    def on_moved(self, event):
-        src_relative_path = os.path.relpath(event.src_path, self.CLIENT_DIR)
-        dest_relative_path = os.path.relpath(event.dest_path, self.CLIENT_DIR)
+    # Send a move/rename
+    def send_moved(self, src_path, dest_path, is_directory):
+        self.file_index.move(src_path, dest_path)
+        src_relative_path = os.path.relpath(src_path, self.CLIENT_DIR)
+        dest_relative_path = os.path.relpath(dest_path, self.CLIENT_DIR)
 
         message = {
             "action": "update",
@@ -90,18 +260,20 @@ class EventHandler(FileSystemEventHandler):
             "event_type": "moved"
         }
 
-        if event.is_directory:
+        if is_directory:
             message["structure"] = "dir"
         else:
             message["structure"] = "file"
 
-        send_message(self.client_socket, message)
-
-    # CLOSED logic
-    def on_closed(self, event):
-        self.on_modified(event)
+        self.send_update(message)
 
     # Helper function to read files
     def read_bytes(self, file_path):
-        with open(file_path, 'rb') as file:
-            return file.read()
+        with tracer.span_before_id("read_bytes", path=file_path):
+            with open(file_path, 'rb') as file:
+                return file.read()
+
+
+# Temporary files (see resources/temp_files.py) are never synchronized
+def is_temporary_path(path):
+    return is_temporary(os.path.basename(path))
@@ -0,0 +1,122 @@
+import os
+import uuid
+import hashlib
+import threading
+
+import sys
+sys.path.append('../')
+from resources.message_sending import send_message
+from resources.profiling import tracer
+
+# Class responsible for streaming large files to the server in fixed-size chunks,
+# so that a file never has to be held in memory as a whole
+class FileUploader:
+    def __init__(self, client_socket, chunk_size, window):
+        self.client_socket = client_socket
+        self.chunk_size = chunk_size
+        self.window = window
+        self.ack_timeout = 30 # in seconds
+        # Upload limits announced by the server at login (None = server cannot receive streamed uploads)
+        self.server_limits = None
+        # Number of acknowledged chunks per upload
+        self.acknowledged = {}
+        self.ack_condition = threading.Condition()
+
+    # Remember the upload limits the server announced in its login reply
+    def set_server_limits(self, limits):
+        self.server_limits = limits
+
+    # Chunk size and window usable with the server, None if it does not support streaming
+    def get_limits(self):
+        if self.server_limits is None:
+            return None
+        return (min(self.chunk_size, self.server_limits["max_chunk_size"]),
+                min(self.window, self.server_limits["window"]))
+
+    # Whether the server can create files from content it already stores, given only the hash
+    def supports_dedup(self):
+        return self.server_limits is not None and self.server_limits.get("dedup", False)
+
+    # Decide whether a file is large enough to be streamed
+    def should_stream(self, file_path):
+        limits = self.get_limits()
+        return limits is not None and os.path.getsize(file_path) > limits[0]
+
+    # Maximum number of bytes that may be in flight at once
+    def get_window_bytes(self):
+        limits = self.get_limits()
+        if limits is None:
+            return self.chunk_size * self.window
+        return limits[0] * limits[1]
+
+    # Called by the client when the server acknowledged a chunk
+    def receive_ack(self, message):
+        with self.ack_condition:
+            if message["upload_id"] in self.acknowledged:
+                if message["result"] == "successful":
+                    self.acknowledged[message["upload_id"]] += 1
+                else:
+                    # Server gave up on the upload
+                    self.acknowledged[message["upload_id"]] = None
+            self.ack_condition.notify_all()
+
+    # Wait until fewer than `window` chunks are unacknowledged, returns False if the upload failed
+    def wait_for_window(self, upload_id, sent, window):
+        with self.ack_condition:
+            acknowledged = self.ack_condition.wait_for(
+                lambda: self.acknowledged[upload_id] is None or sent - self.acknowledged[upload_id] < window,
+                self.ack_timeout)
+            return acknowledged and self.acknowledged[upload_id] is not None
+
+    # Stream a file: start message, one message per chunk and an end message.
+    # Returns the hash of the sent content, None if the upload failed.
+    def upload(self, file_path, relative_path, event_type):
+        chunk_size, window = self.get_limits()
+        upload_id = uuid.uuid4().hex
+        file_hasher = hashlib.sha256()
+        with self.ack_condition:
+            self.acknowledged[upload_id] = 0
+
+        try:
+            send_message(self.client_socket, {
+                "action": "upload_start",
+                "upload_id": upload_id,
+                "path": relative_path,
+                "event_type": event_type,
+                "size": os.path.getsize(file_path)
+            })
+
+            sequence = 0
+            offset = 0
+            with open(file_path, 'rb') as file:
+                while True:
+                    with tracer.span("read_bytes", path=relative_path, seq=sequence):
+                        chunk = file.read(chunk_size)
+                    if not chunk:
+                        break
+                    if not self.wait_for_window(upload_id, sequence, window):
+                        print(f"Upload of {relative_path} failed, the server did not acknowledge in time")
+                        return
+
+                    send_message(self.client_socket, {
+                        "action": "upload_chunk",
+                        "upload_id": upload_id,
+                        "seq": sequence,
+                        "offset": offset,
+                        "data": chunk
+                    })
+                    file_hasher.update(chunk)
+                    sequence += 1
+                    offset += len(chunk)
+
+            send_message(self.client_socket, {
+                "action": "upload_end",
+                "upload_id": upload_id,
+                "chunks": sequence,
+                "size": offset,
+                "file_hash": file_hasher.hexdigest()
+            })
+            return file_hasher.hexdigest()
+        finally:
+            with self.ack_condition:
+                del self.acknowledged[upload_id]
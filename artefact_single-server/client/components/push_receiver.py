@@ -0,0 +1,183 @@
+import os
+import time
+import queue
+import shutil
+import threading
+
+import sys
+sys.path.append('../')
+from resources.message_sending import decode_data
+from resources.temp_files import get_temp_path
+
+# Pushed states of a path besides the hash of a pushed file
+PUSHED_DIRECTORY = "dir"
+PUSHED_DELETION = "deleted"
+
+# Class applying the changes the server pushes from the other devices of the user to the client folder.
+# Applying them causes file system events like local changes do. These are recognized by comparing the
+# folder with the pushed state and not sent back to the server (echo suppression). Paths with local changes
+# that were not sent yet are left alone, the local change is sent afterwards and wins.
+class PushReceiver:
+    def __init__(self, client_dir, file_index, coalescer):
+        self.client_dir = client_dir
+        self.file_index = file_index
+        self.coalescer = coalescer
+        # Applied changes whose events may still come up: relative path -> (pushed state, time).
+        # Moves are stored under the destination with the source as state.
+        self.pushed = {}
+        self.echo_timeout = 60 # in seconds
+        self.lock = threading.Lock()
+        # Changes are applied on a thread of their own, never holding up the messages of the server
+        self.changes = queue.Queue()
+
+        apply_thread = threading.Thread(target=self.run)
+        apply_thread.daemon = True
+        apply_thread.start()
+
+    # Called by the client for push messages of the server
+    def receive(self, message):
+        self.changes.put(message)
+
+    def run(self):
+        while True:
+            message = self.changes.get()
+            try:
+                self.apply(message)
+            except (OSError, KeyError, ValueError) as e:
+                print(f"Error applying a change pushed by the server: {e}")
+
+    def apply(self, message):
+        if message["event_type"] == "moved":
+            paths = [message["src_path"], message["dest_path"]]
+        else:
+            paths = [message["path"]]
+        if not all(is_safe_path(path) for path in paths):
+            return
+        if any(self.coalescer.has_pending(os.path.join(self.client_dir, path)) for path in paths):
+            if os.environ["DEBUG"] == "on":
+                print(f"Not applying pushed change of {paths[-1]}, it was changed here as well")
+            return
+
+        if message["event_type"] == "moved":
+            self.apply_move(message["src_path"], message["dest_path"])
+        elif message["event_type"] == "deleted":
+            self.apply_deletion(message["path"])
+        elif message["structure"] == "dir":
+            self.apply_directory(message["path"])
+        elif "data" not in message:
+            print(f"{message['path']} was changed on another device, but is too large to be pushed.")
+        else:
+            self.apply_file(message["path"], decode_data(message["data"]), message["file_hash"])
+
+    def apply_file(self, relative_path, data, file_hash):
+        path = os.path.join(self.client_dir, relative_path)
+        if os.path.isfile(path) and self.file_index.get(path) == file_hash:
+            self.file_index.set_synced(path, file_hash)
+            return
+        self.remember(relative_path, file_hash)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # The file is written to a temporary file next to it and moved into place, so that only complete files show up
+        temp_path = get_temp_path(path, "tmp")
+        try:
+            with open(temp_path, 'wb') as temp_file:
+                temp_file.write(data)
+            os.replace(temp_path, path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self.file_index.record(path, False, file_hash)
+        self.file_index.set_synced(path, file_hash)
+        print(f"{relative_path} was updated from another device.")
+
+    def apply_directory(self, relative_path):
+        path = os.path.join(self.client_dir, relative_path)
+        if os.path.isdir(path):
+            return
+        self.remember(relative_path, PUSHED_DIRECTORY)
+        if os.path.lexists(path):
+            os.remove(path)
+        os.makedirs(path, exist_ok=True)
+        self.file_index.record(path, True)
+
+    def apply_deletion(self, relative_path):
+        path = os.path.join(self.client_dir, relative_path)
+        if not os.path.lexists(path):
+            return
+        self.remember(relative_path, PUSHED_DELETION)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+        self.file_index.remove(path)
+        print(f"{relative_path} was deleted on another device.")
+
+    def apply_move(self, src_relative_path, dest_relative_path):
+        src_path = os.path.join(self.client_dir, src_relative_path)
+        dest_path = os.path.join(self.client_dir, dest_relative_path)
+        if not os.path.lexists(src_path):
+            return
+        self.remember(dest_relative_path, os.path.normpath(src_relative_path))
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        shutil.move(src_path, dest_path)
+        self.file_index.move(src_path, dest_path)
+        print(f"{src_relative_path} was moved to {dest_relative_path} on another device.")
+
+    def remember(self, relative_path, state):
+        with self.lock:
+            self.pushed[os.path.normpath(relative_path)] = (state, time.time())
+
+    # Whether an event of the coalescer was caused by applying a pushed change, i.e. the path is still in
+    # the pushed state. Any other event of a path ends the suppression of its pushed change.
+    def is_echo(self, path, event):
+        relative_path = os.path.normpath(os.path.relpath(path, self.client_dir))
+        with self.lock:
+            now = time.time()
+            for pushed_path, (_, pushed_time) in list(self.pushed.items()):
+                if now - pushed_time > self.echo_timeout:
+                    del self.pushed[pushed_path]
+            if not self.pushed:
+                return False
+            entry = self.pushed.get(relative_path)
+            # Files inside a deleted folder are deleted with it
+            if event["kind"] == "deleted" and entry is None:
+                entry = next((self.pushed[parent] for parent in get_parents(relative_path)
+                              if self.pushed.get(parent, (None,))[0] == PUSHED_DELETION), None)
+        if entry is None:
+            return False
+
+        state = entry[0]
+        if event["kind"] == "deleted":
+            echo = state == PUSHED_DELETION and not os.path.lexists(path)
+        elif event["kind"] == "moved":
+            src_relative_path = os.path.normpath(os.path.relpath(event["src_path"], self.client_dir))
+            echo = state == src_relative_path and not event["modified"] and not os.path.lexists(event["src_path"])
+        elif state == PUSHED_DIRECTORY:
+            echo = os.path.isdir(path)
+        elif state == PUSHED_DELETION:
+            echo = False
+        else:
+            echo = os.path.isfile(path) and self.file_index.get(path) == state
+
+        if not echo:
+            with self.lock:
+                self.pushed.pop(relative_path, None)
+        return echo
+
+
+# Relative paths from the server must stay inside the client folder
+def is_safe_path(relative_path):
+    if not isinstance(relative_path, str) or relative_path == "" or os.path.isabs(relative_path):
+        return False
+    return not os.path.normpath(relative_path).startswith("..")
+
+
+def get_parents(relative_path):
+    parents = []
+    parent = os.path.dirname(relative_path)
+    while parent:
+        parents.append(parent)
+        parent = os.path.dirname(parent)
+    return parents
@@ -0,0 +1,218 @@
+import os
+import time
+import threading
+
+import sys
+sys.path.append('../')
+from resources.message_sending import send_message
+from resources.merkle_tree import build_tree, list_subtree, directory_digest, DIRECTORY_ENTRY
+
+# Class bringing the server and the client folder up to date with each other after login. Changes made while
+# the client was not running never caused a watchdog event, so the hash tree of the folder is compared level
+# by level with the tree of the server, only descending into directories whose digests differ. Local changes
+# are fed into the coalescer like watchdog events, where they merge with the live events of the same paths.
+# Changes made on the server by other devices are fetched and applied like pushed changes.
+class Reconciler:
+    def __init__(self, client_socket, client_dir, coalescer, push_receiver, file_index):
+        self.client_socket = client_socket
+        self.client_dir = client_dir
+        self.coalescer = coalescer
+        self.push_receiver = push_receiver
+        # Files are only hashed again if their stat differs from the one in the index
+        self.file_index = file_index
+        self.timeout = 10 # in seconds
+        self.request_count = 0
+        self.request = None
+        self.lock = threading.Lock()
+
+    def run(self):
+        start_time = time.time()
+        tree = build_tree(self.client_dir, self.file_index)
+        changes = {"created": 0, "modified": 0, "deleted": 0, "received": 0}
+        merge = True
+        round_trips = 0
+
+        level = [""]
+        while level:
+            directories = self.request_tree(level)
+            round_trips += 1
+            if directories is None:
+                print("The server did not answer while reconciling the folder, only live changes are synced.")
+                return
+
+            next_level = []
+            for path in level:
+                local = tree[path]
+                remote = directories.get(path)
+                # Missing directories were already created entirely one level up
+                if remote is None or remote["digest"] == local["digest"]:
+                    continue
+                # A server without any files of the user is new or was reset, it did not delete everything
+                if path == "" and not remote["entries"]:
+                    merge = False
+                next_level.extend(self.compare(tree, path, local, [(None, remote)], changes, merge))
+            level = next_level
+
+        # Entries of files deleted in the meantime are no longer needed once the deletions are queued
+        self.file_index.prune(list_paths(tree))
+        print(f"Folder reconciled with the server in {round_trips} round trips and {time.time() - start_time:.1f}s: "
+              f"{changes['created']} entries created, {changes['modified']} files modified, "
+              f"{changes['deleted']} entries deleted, {changes['received']} changes taken from the server.")
+
+    # Queue the differences of a directory and its copies on the servers ((server, node) of every server that has
+    # the directory), returns the subdirectories that differ. With merge, the synced hashes of the index tell
+    # which side changed a file since it was last synced: files changed only locally are uploaded, files changed
+    # only on the servers are fetched and files changed on both sides are uploaded, so the local change wins.
+    # Without merge, or for files whose synced hash is unknown, the folder is taken as it is.
+    def compare(self, tree, path, local, remotes, changes, merge):
+        differing_directories = []
+        names = dict.fromkeys(local["entries"])
+        for _, remote in remotes:
+            names.update(dict.fromkeys(remote["entries"]))
+
+        for name in names:
+            local_entry = local["entries"].get(name)
+            remote_entries = [(server, remote["entries"].get(name)) for server, remote in remotes]
+            if all(remote_entry == local_entry for _, remote_entry in remote_entries):
+                continue
+
+            child_path = os.path.join(path, name) if path else name
+            local_path = os.path.join(self.client_dir, child_path)
+            if local_entry is None:
+                self.compare_server_only(tree, child_path, remote_entries, changes, merge, differing_directories)
+                continue
+
+            kind, digest = local_entry
+            replaced = [remote_entry for _, remote_entry in remote_entries if remote_entry is not None and remote_entry[0] != kind]
+            if replaced:
+                # A file replaced a directory or the other way around
+                self.coalescer.on_deleted(local_path, replaced[0][0] == DIRECTORY_ENTRY)
+            copies = [(server, remote_entry) for server, remote_entry in remote_entries
+                      if remote_entry is not None and remote_entry[0] == kind]
+            # Entries no server has at all were deleted there if they were synced before and did not change since
+            deleted_remotely = merge and not copies and not replaced
+
+            if kind == DIRECTORY_ENTRY:
+                if deleted_remotely and self.is_unchanged_subtree(tree, child_path):
+                    self.remove_locally(child_path, changes)
+                    continue
+                if len(copies) < len(remote_entries):
+                    self.create_subtree(tree, child_path, changes)
+                if any(remote_entry != local_entry for _, remote_entry in copies):
+                    differing_directories.append(child_path)
+                continue
+
+            synced = self.file_index.get_synced(local_path) if merge else None
+            changed = [server for server, remote_entry in copies if remote_entry[1] not in (digest, synced)]
+            if synced == digest and changed:
+                self.fetch(changed[0], child_path, changes)
+            elif synced == digest and deleted_remotely:
+                self.remove_locally(child_path, changes)
+            elif len(copies) < len(remote_entries):
+                self.coalescer.on_created(local_path, False)
+                changes["created"] += 1
+            elif synced != digest:
+                self.coalescer.on_modified(local_path)
+                changes["modified"] += 1
+        return differing_directories
+
+    # Entries only the servers have were deleted locally if the index knows them from an earlier run, unless
+    # a file changed on the servers since it was last synced. With merge, all others are new on the servers
+    # and fetched, directories are created and compared further with an empty local directory.
+    def compare_server_only(self, tree, path, remote_entries, changes, merge, differing_directories):
+        copies = [(server, remote_entry) for server, remote_entry in remote_entries if remote_entry is not None]
+        kind = copies[0][1][0]
+        local_path = os.path.join(self.client_dir, path)
+        known = self.file_index.is_known(local_path)
+        if kind == DIRECTORY_ENTRY:
+            if known:
+                self.coalescer.on_deleted(local_path, True)
+                changes["deleted"] += 1
+            elif merge:
+                self.push_receiver.receive({"event_type": "created", "structure": "dir", "path": path})
+                tree[path] = {"digest": directory_digest({}), "entries": {}}
+                differing_directories.append(path)
+                changes["received"] += 1
+            return
+
+        synced = self.file_index.get_synced(local_path) if merge else None
+        changed = [server for server, remote_entry in copies if remote_entry[0] == kind and remote_entry[1] != synced]
+        if known and (synced is None or not changed):
+            self.coalescer.on_deleted(local_path, False)
+            changes["deleted"] += 1
+        elif merge and changed:
+            self.fetch(changed[0], path, changes)
+
+    # Whether a directory and all files in it were synced before and did not change locally since
+    def is_unchanged_subtree(self, tree, path):
+        if not self.file_index.is_known(os.path.join(self.client_dir, path)):
+            return False
+        _, files = list_subtree(tree, path)
+        for file in files:
+            digest = tree[os.path.dirname(file)]["entries"][os.path.basename(file)][1]
+            if self.file_index.get_synced(os.path.join(self.client_dir, file)) != digest:
+                return False
+        return True
+
+    # Apply a deletion made on the servers to the folder, like a pushed change, unless it changed here meanwhile
+    def remove_locally(self, path, changes):
+        self.push_receiver.receive({"event_type": "deleted", "path": path})
+        changes["received"] += 1
+
+    # Queue a directory the server does not have together with all its contents
+    def create_subtree(self, tree, path, changes):
+        directories, files = list_subtree(tree, path)
+        for directory in [path] + directories:
+            self.coalescer.on_created(os.path.join(self.client_dir, directory), True)
+        for file in files:
+            self.coalescer.on_created(os.path.join(self.client_dir, file), False)
+        changes["created"] += 1 + len(directories) + len(files)
+
+    # Ask the server for its copy of a file, applied like a pushed change once it arrives
+    def fetch(self, server, path, changes):
+        message = {
+            "action": "fetch",
+            "path": path
+        }
+        send_message(self.client_socket, message)
+        changes["received"] += 1
+
+    # Ask the server for the entries of directories and wait for the answer
+    def request_tree(self, paths):
+        with self.lock:
+            self.request_count += 1
+            request = {
+                "id": self.request_count,
+                "event": threading.Event(),
+                "reply": None
+            }
+            self.request = request
+
+        message = {
+            "action": "tree",
+            "request_id": request["id"],
+            "paths": paths
+        }
+        send_message(self.client_socket, message)
+
+        request["event"].wait(self.timeout)
+        with self.lock:
+            self.request = None
+            return request["reply"]
+
+    # Called by the client when the server answered a tree request
+    def receive_tree(self, message):
+        with self.lock:
+            request = self.request
+            if request is None or message.get("request_id") != request["id"]:
+                return
+            request["reply"] = message["directories"]
+            request["event"].set()
+
+
+# Relative paths of all files and directories in a tree
+def list_paths(tree):
+    paths = set(tree)
+    for directory, node in tree.items():
+        paths.update(os.path.join(directory, name) if directory else name for name in node["entries"])
+    return paths
@@ -1,9 +1,8 @@
 import sys
-import json
 import threading
 
 sys.path.append('../')
-from resources.message_sending import receive_message
+from resources.message_sending import receive_message, load_message
 
 # Class responsible for handling server messages
 class ServerMessageNotifier:
@@ -31,13 +30,13 @@ class ServerMessageNotifier:
                 try:
                     messages = []
                     for data_item in data:
-                        message = json.loads(data_item)
+                        message = load_message(data_item)
                         messages.append(message)
                         
                     for message in messages:
                         self.notify_listeners(message)
-                except json.JSONDecodeError:
-                    print("Error decoding JSON message")
+                except ValueError:
+                    print("Error decoding message")
         except (KeyboardInterrupt, ConnectionResetError):
             observer.stop()
 
@@ -0,0 +1,52 @@
+import threading
+
+# Class packing small update messages into batch messages, so that a folder full of small files
+# costs one message (and one acknowledgement per server) per batch instead of one per file
+class UpdateBatcher:
+    def __init__(self, send_batch, max_messages, max_bytes):
+        self.send_batch = send_batch
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        # Largest batch each server accepts, announced at login (None = server does not support batches)
+        self.server_limits = {}
+        self.messages = []
+        self.size = 0
+        self.lock = threading.RLock()
+
+    def set_server_limit(self, server, limit):
+        self.server_limits[server] = limit
+
+    # Largest batch usable with all given servers, 1 if one of them does not support batches
+    def get_max_messages(self, servers):
+        max_messages = self.max_messages
+        for server in servers:
+            limit = self.server_limits.get(server)
+            if not limit:
+                return 1
+            max_messages = min(max_messages, limit)
+        return max_messages
+
+    # Queue a message for the next batch, returns False if it has to be sent on its own
+    def add(self, message, servers):
+        size = len(message.get("data", b""))
+        max_messages = self.get_max_messages(servers)
+        if max_messages <= 1 or size > self.max_bytes // 4:
+            return False
+
+        with self.lock:
+            if self.size + size > self.max_bytes:
+                self.flush()
+            self.messages.append(message)
+            self.size += size
+            if len(self.messages) >= max_messages:
+                self.flush()
+        return True
+
+    # Send the queued messages, must happen before any message that is not batched to keep the order
+    def flush(self):
+        with self.lock:
+            messages = self.messages
+            self.messages = []
+            self.size = 0
+            if messages:
+                self.send_batch(messages)
@@ -0,0 +1,171 @@
+import os
+import math
+import lzma
+import zlib
+import base64
+import threading
+from collections import Counter
+
+# Helper script compressing the binary data of messages. Peers agree at login on the algorithms both
+# can decode, the sender then picks per message whether and how to compress: small payloads are sent
+# as they are, a sample of the data is checked for its entropy so that already compressed files
+# (media, archives) do not burn CPU, and the result is only used if it is noticeably smaller.
+
+ZLIB_COMPRESSION = "zlib"
+LZMA_COMPRESSION = "lzma"
+SUPPORTED_COMPRESSIONS = [LZMA_COMPRESSION, ZLIB_COMPRESSION]
+
+MIN_COMPRESS_SIZE = 1024
+# Data with more bits of entropy per byte is considered incompressible
+MAX_ENTROPY = 7.5
+# Highly redundant data (text, logs, CSVs) up to this size is worth the slower but stronger lzma
+LZMA_MAX_ENTROPY = 5.0
+LZMA_MAX_SIZE = 4194304
+# zlib uses its fastest level for large payloads
+FAST_ZLIB_SIZE = 1048576
+# Compressed data has to be at most this fraction of the original to be sent
+MAX_RATIO = 0.9
+SAMPLE_SIZE = 4096
+
+
+# Statistics on the compression of sent messages, for tuning the thresholds
+class CompressionStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.skipped = Counter()
+        # algorithm -> [messages, original bytes, compressed bytes]
+        self.compressed = {}
+
+    def record_skip(self, reason):
+        with self.lock:
+            self.messages += 1
+            self.skipped[reason] += 1
+
+    def record(self, algorithm, raw_size, compressed_size):
+        with self.lock:
+            self.messages += 1
+            totals = self.compressed.setdefault(algorithm, [0, 0, 0])
+            totals[0] += 1
+            totals[1] += raw_size
+            totals[2] += compressed_size
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "messages": self.messages,
+                "skipped": dict(self.skipped),
+                "compressed": {algorithm: {
+                    "messages": totals[0],
+                    "raw_bytes": totals[1],
+                    "compressed_bytes": totals[2],
+                    "ratio": totals[1] / totals[2] if totals[2] else 0
+                } for algorithm, totals in self.compressed.items()}
+            }
+
+    def summary(self):
+        stats = self.get_stats()
+        parts = [f"{stats['messages']} payloads"]
+        for algorithm, totals in stats["compressed"].items():
+            parts.append(f"{algorithm}: {totals['messages']} compressed {totals['raw_bytes']} -> "
+                         f"{totals['compressed_bytes']} bytes (ratio {totals['ratio']:.2f})")
+        for reason, count in stats["skipped"].items():
+            parts.append(f"{count} not compressed ({reason})")
+        return "Compression: " + ", ".join(parts)
+
+compression_stats = CompressionStats()
+
+
+# Keep the algorithms offered by the peer that are supported here, in our order of preference
+def negotiate_compressions(offered_compressions):
+    return [compression for compression in SUPPORTED_COMPRESSIONS if compression in (offered_compressions or [])]
+
+
+# Shannon entropy in bits per byte of samples from the start, middle and end of the data
+def estimate_entropy(data):
+    if len(data) <= 3 * SAMPLE_SIZE:
+        sample = bytes(data)
+    else:
+        middle = len(data) // 2
+        sample = bytes(data[:SAMPLE_SIZE]) + bytes(data[middle:middle + SAMPLE_SIZE]) + bytes(data[-SAMPLE_SIZE:])
+    counts = Counter(sample)
+    return -sum(count / len(sample) * math.log2(count / len(sample)) for count in counts.values())
+
+
+# Pick algorithm and level for the data, None if it should be sent uncompressed
+def choose_compression(data, compressions):
+    if not compressions:
+        return None, None
+    if len(data) < MIN_COMPRESS_SIZE:
+        compression_stats.record_skip("small")
+        return None, None
+
+    entropy = estimate_entropy(data)
+    if entropy > MAX_ENTROPY:
+        compression_stats.record_skip("entropy")
+        return None, None
+
+    if LZMA_COMPRESSION in compressions and entropy < LZMA_MAX_ENTROPY and len(data) <= LZMA_MAX_SIZE:
+        return LZMA_COMPRESSION, 1
+    if ZLIB_COMPRESSION in compressions:
+        return ZLIB_COMPRESSION, 1 if len(data) > FAST_ZLIB_SIZE else 6
+    return LZMA_COMPRESSION, 0
+
+
+def compress(data, algorithm, level):
+    if algorithm == LZMA_COMPRESSION:
+        return lzma.compress(data, preset=level)
+    return zlib.compress(data, level)
+
+
+# Decompress data, refusing anything that does not have exactly the announced size
+def decompress(data, algorithm, raw_size):
+    if algorithm == LZMA_COMPRESSION:
+        decompressor = lzma.LZMADecompressor()
+    elif algorithm == ZLIB_COMPRESSION:
+        decompressor = zlib.decompressobj()
+    else:
+        raise ValueError(f"Unsupported compression {algorithm}")
+
+    try:
+        raw_data = decompressor.decompress(data, raw_size + 1)
+    except (lzma.LZMAError, zlib.error) as e:
+        raise ValueError(f"Corrupt {algorithm} data: {e}")
+    if len(raw_data) != raw_size:
+        raise ValueError(f"Decompressed data has {len(raw_data)} bytes instead of {raw_size}")
+    return raw_data
+
+
+# Return the message with compressed data if that is worth it, the original message otherwise
+def compress_message(message, compressions):
+    data = message.get("data")
+    if not isinstance(data, (bytes, bytearray, memoryview)):
+        return message
+
+    algorithm, level = choose_compression(data, compressions)
+    if algorithm is None:
+        return message
+
+    compressed_data = compress(data, algorithm, level)
+    if len(compressed_data) > len(data) * MAX_RATIO:
+        compression_stats.record_skip("ratio")
+        return message
+    compression_stats.record(algorithm, len(data), len(compressed_data))
+    if os.environ.get("DEBUG") == "on":
+        print(f"Compressed {len(data)} bytes to {len(compressed_data)} with {algorithm} level {level}")
+
+    message = dict(message)
+    message["data"] = compressed_data
+    message["compression"] = algorithm
+    message["raw_size"] = len(data)
+    return message
+
+
+# Restore the data of a received message that was compressed
+def decompress_message(message):
+    if "compression" in message:
+        data = message["data"]
+        if isinstance(data, str):
+            data = base64.b64decode(data)
+        message["data"] = decompress(data, message.pop("compression"), message.pop("raw_size"))
+    return message
@@ -0,0 +1,104 @@
+import os
+import hashlib
+import threading
+
+from resources.delta_sync import hash_file
+from resources.temp_files import is_temporary
+
+# Helper script building hash trees over a directory, used to find the differences between the folder
+# of a client and its copy on a server without comparing every file. Each directory gets a digest over
+# the names, kinds and digests of its entries, so two trees only differ below directories whose
+# digests differ.
+
+FILE_ENTRY = "f"
+DIRECTORY_ENTRY = "d"
+
+
+# Content hashes of files, only computed again when the size, modification time or inode of a file changed
+class FileHashCache:
+    def __init__(self):
+        # path -> (size, modification time, inode, hash)
+        self.hashes = {}
+        self.lock = threading.Lock()
+
+    def get(self, file_path, stat=None):
+        if stat is None:
+            stat = os.stat(file_path)
+        with self.lock:
+            cached = self.hashes.get(file_path)
+        key = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        if cached is not None and cached[:3] == key:
+            return cached[3]
+
+        file_hash = hash_file(file_path)
+        with self.lock:
+            self.hashes[file_path] = key + (file_hash,)
+        return file_hash
+
+
+def directory_digest(entries):
+    hasher = hashlib.sha256()
+    for name in sorted(entries):
+        kind, digest = entries[name]
+        hasher.update("{}\0{}\0{}\n".format(kind, name, digest).encode())
+    return hasher.hexdigest()
+
+
+# Build the tree of a directory: relative directory path ("" for the root) ->
+# {"digest": digest of the directory, "entries": {name: [kind, digest]}}.
+# If a dict is passed as details, it is filled with relative path -> [newest modification time, size]
+# of every file and directory, directories counting everything below them.
+def build_tree(root_dir, hash_cache, details=None):
+    tree = {}
+
+    def visit(directory, relative_path):
+        entries = {}
+        newest = os.stat(directory).st_mtime if details is not None else 0
+        total_size = 0
+        with os.scandir(directory) as scanner:
+            for entry in scanner:
+                # Unfinished uploads, deltas and blob links on the server side
+                if is_temporary(entry.name):
+                    continue
+                child_path = os.path.join(relative_path, entry.name) if relative_path else entry.name
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        entries[entry.name] = [DIRECTORY_ENTRY, visit(entry.path, child_path)]
+                    elif entry.is_file(follow_symlinks=False):
+                        stat = entry.stat()
+                        entries[entry.name] = [FILE_ENTRY, hash_cache.get(entry.path, stat)]
+                        if details is not None:
+                            details[child_path] = [stat.st_mtime, stat.st_size]
+                    else:
+                        continue
+                except OSError:
+                    # Vanished while the tree was built, a later event covers it
+                    continue
+                if details is not None:
+                    newest = max(newest, details[child_path][0])
+                    total_size += details[child_path][1]
+        digest = directory_digest(entries)
+        tree[relative_path] = {"digest": digest, "entries": entries}
+        if details is not None:
+            details[relative_path] = [newest, total_size]
+        return digest
+
+    visit(root_dir, "")
+    return tree
+
+
+# All directories and files below a directory of the tree, parents before their children
+def list_subtree(tree, relative_path):
+    directories = []
+    files = []
+    pending = [relative_path]
+    while pending:
+        directory = pending.pop(0)
+        for name, (kind, _) in sorted(tree[directory]["entries"].items()):
+            child_path = os.path.join(directory, name) if directory else name
+            if kind == DIRECTORY_ENTRY:
+                directories.append(child_path)
+                pending.append(child_path)
+            else:
+                files.append(child_path)
+    return directories, files
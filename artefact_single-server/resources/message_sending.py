@@ -1,46 +1,312 @@
 import json
 import os
+import base64
+import asyncio
+import time
+import struct
+import threading
+import weakref
+
+from resources.compression import compress_message, decompress_message
+from resources.metrics import metrics
+from resources.profiling import tracer
 
 # Helper script that defines functions for both sending and receiving messages on client and server side
 
+# Wire protocols: the original newline-delimited JSON and versioned, length-prefixed binary frames.
+# Clients offer the protocols they speak at login and the server picks one, so old clients keep working.
+JSON_PROTOCOL = "json"
+BINARY_PROTOCOL = "binary/1"
+SUPPORTED_PROTOCOLS = [BINARY_PROTOCOL, JSON_PROTOCOL]
+
+# Binary frame: fixed header, compact JSON metadata, raw (not base64 encoded) payload
+# Header: magic, version, flags, message type, message id, metadata length, payload length
+FRAME_MAGIC = b"FH"
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct("!2sBBBIIQ")
+FLAG_HAS_ID = 0x01
+FLAG_HAS_PAYLOAD = 0x02
+
+# Message types carried in the header, the action of any other message stays in the metadata (type 0)
+MESSAGE_TYPES = ["", "login", "update", "received", "disconnect", "shutdown", "signatures", "resync", "batch"]
+
+RECEIVE_BUFFER_SIZE = 65536
+
+# Per socket state: negotiated protocol and compressions, send lock and receive buffer
+class SocketState:
+    def __init__(self):
+        self.protocol = JSON_PROTOCOL
+        self.compressions = []
+        self.send_lock = threading.Lock()
+        self.receiver = None
+
+socket_states = weakref.WeakKeyDictionary()
+socket_states_lock = threading.Lock()
+
+def get_socket_state(socket):
+    with socket_states_lock:
+        state = socket_states.get(socket)
+        if state is None:
+            state = SocketState()
+            socket_states[socket] = state
+        return state
+
+def set_protocol(socket, protocol):
+    get_socket_state(socket).protocol = protocol
+
+def get_protocol(socket):
+    return get_socket_state(socket).protocol
+
+# Compression algorithms the peer can decode
+def set_compressions(socket, compressions):
+    get_socket_state(socket).compressions = compressions or []
+
+# Pick the first protocol offered by the client that is supported here
+def negotiate_protocol(offered_protocols):
+    for protocol in offered_protocols or []:
+        if protocol in SUPPORTED_PROTOCOLS:
+            return protocol
+    return JSON_PROTOCOL
+
 def send_message(socket, message):
     if os.environ["DEBUG"] == "on":
         print("sending:", message)
-    # Serialize the message to JSON
-    message_json = dump_message(message)
-    # Send the message to the server
-    socket.sendall(message_json.encode())
+    state = get_socket_state(socket)
+    # Serialize the message with the protocol negotiated for this connection, compressing its data if worth it
+    labels = {"action": message.get("action")}
+    with metrics.timer("message_encode_seconds", labels):
+        with tracer.span("compress", message.get("id")):
+            compressed_message = compress_message(message, state.compressions)
+        parts = encode_message(compressed_message, state.protocol)
+    metrics.inc("messages_sent_total", labels)
+    metrics.inc("message_bytes_sent_total", labels, sum(len(part) for part in parts))
+    # Send the message to the server, the lock keeps messages from different threads from interleaving
+    with state.send_lock:
+        with tracer.span("send", message.get("id"), action=message.get("action")):
+            for part in parts:
+                socket.sendall(part)
+
+# Serialize a message into the byte strings to be sent
+def encode_message(message, protocol=JSON_PROTOCOL):
+    if protocol == BINARY_PROTOCOL:
+        return encode_frame(message)
+    return [dump_message(message).encode()]
 
 def dump_message(message):
-    # Dump message and add delimiter
-    return json.dumps(message) + '\n'
+    # Dump message and add delimiter, binary data is sent base64 encoded
+    data = message.get("data")
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        with tracer.span("base64", message.get("id")):
+            message = dict(message, data=encode_bytes(data))
+    with tracer.span("json.dumps", message.get("id")):
+        return json.dumps(message, default=encode_bytes) + '\n'
 
-# Define function to receive the complete message in 1024 byte blocks
-def receive_message(client_socket):
-    data = b""
+def encode_bytes(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(value).decode('utf-8')
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def encode_frame(message):
+    metadata = dict(message)
+    flags = 0
+
+    message_type = 0
+    if metadata.get("action") in MESSAGE_TYPES:
+        message_type = MESSAGE_TYPES.index(metadata.pop("action"))
+
+    message_id = 0
+    if isinstance(metadata.get("id"), int) and 0 <= metadata["id"] < 2 ** 32:
+        message_id = metadata.pop("id")
+        flags |= FLAG_HAS_ID
+
+    payload = b""
+    if isinstance(metadata.get("data"), (bytes, bytearray, memoryview)):
+        payload = metadata.pop("data")
+        flags |= FLAG_HAS_PAYLOAD
+
+    with tracer.span("json.dumps", message.get("id")):
+        encoded_metadata = json.dumps(metadata, separators=(',', ':'), default=encode_bytes).encode()
+    header = FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, flags, message_type, message_id,
+                               len(encoded_metadata), len(payload))
+
+    if len(payload) < RECEIVE_BUFFER_SIZE:
+        return [header + encoded_metadata + payload]
+    # Large payloads are sent as they are instead of being copied into one buffer
+    return [header + encoded_metadata, payload]
+
+def is_frame(data):
+    return data[:2] == FRAME_MAGIC
+
+# Turn one received message (JSON line or binary frame) into a message dictionary
+def load_message(data):
+    start = time.perf_counter()
+    message = parse_message(data)
+    end = time.perf_counter()
+    labels = {"action": message.get("action")}
+    metrics.observe("message_decode_seconds", end - start, labels)
+    # The id is only known once the message is parsed
+    tracer.record("parse_frame" if is_frame(data) else "json.loads", start, end, message.get("id"), labels)
+    metrics.inc("messages_received_total", labels)
+    metrics.inc("message_bytes_received_total", labels, len(data))
+    return message
+
+def parse_message(data):
+    if not is_frame(data):
+        return decompress_message(json.loads(data))
+
+    _, version, flags, message_type, message_id, metadata_length, payload_length = FRAME_HEADER.unpack_from(data)
+    if version != FRAME_VERSION:
+        raise ValueError(f"Unsupported frame version {version}")
+
+    view = memoryview(data)
+    metadata_start = FRAME_HEADER.size
+    payload_start = metadata_start + metadata_length
+    message = json.loads(bytes(view[metadata_start:payload_start]))
+
+    if message_type:
+        message["action"] = MESSAGE_TYPES[message_type]
+    if flags & FLAG_HAS_ID:
+        message["id"] = message_id
+    if flags & FLAG_HAS_PAYLOAD:
+        message["data"] = view[payload_start:payload_start + payload_length]
+    return decompress_message(message)
+
+# Binary data of a message, which is base64 encoded if it was received as JSON
+def decode_data(data):
+    if isinstance(data, str):
+        with tracer.span("b64decode"):
+            return base64.b64decode(data)
+    return data
+
+# Pack several messages into one batch message. Their binary data is concatenated into the
+# payload of the batch, so that it is not base64 encoded inside the metadata of binary frames.
+def pack_batch(messages):
+    packed_messages = []
+    payload = bytearray()
+    for message in messages:
+        message = dict(message)
+        if "data" in message:
+            data = message.pop("data")
+            message["data_size"] = len(data)
+            payload += data
+        packed_messages.append(message)
+
+    return {
+        "action": "batch",
+        "messages": packed_messages,
+        "data": bytes(payload)
+    }
+
+# Restore the messages of a batch together with their binary data
+def unpack_batch(batch):
+    payload = decode_data(batch["data"])
     messages = []
+    offset = 0
+    for message in batch["messages"]:
+        if "data_size" in message:
+            size = message.pop("data_size")
+            message["data"] = payload[offset:offset + size]
+            offset += size
+        messages.append(message)
+    return messages
+
+# Receives messages of one connection into a preallocated buffer
+class StreamReceiver:
+    def __init__(self, socket, buffer_size=RECEIVE_BUFFER_SIZE):
+        self.socket = socket
+        self.buffer = bytearray(buffer_size)
+        self.start = 0
+        self.end = 0
 
-    # Receive data until the custom delimiter is found
-    while True:
-        chunk = client_socket.recv(1024)
-        if not chunk:
-            break
-        data += chunk
+    # Return the next complete messages, an empty list once the connection is closed
+    def receive(self):
+        while True:
+            messages = self.parse_buffered()
+            if messages:
+                return messages
+            if not self.fill():
+                return []
 
-        # Split the received data by the delimiter
-        parts = data.split(b'\n')
+    # Extract all complete messages currently held in the buffer
+    def parse_buffered(self):
+        messages = []
+        while self.end > self.start:
+            available = self.end - self.start
+            # JSON messages start with "{", frames with the magic bytes
+            if self.buffer[self.start] == FRAME_MAGIC[0]:
+                if available < FRAME_HEADER.size:
+                    break
+                header = FRAME_HEADER.unpack_from(self.buffer, self.start)
+                frame_length = FRAME_HEADER.size + header[5] + header[6]
+                if frame_length > len(self.buffer):
+                    # Receive frames exceeding the buffer straight into their own buffer
+                    messages.append(self.receive_large_frame(frame_length))
+                    continue
+                if available < frame_length:
+                    break
+                messages.append(bytes(self.buffer[self.start:self.start + frame_length]))
+                self.start += frame_length
+            else:
+                delimiter = self.buffer.find(b'\n', self.start, self.end)
+                if delimiter == -1:
+                    if self.start == 0 and self.end == len(self.buffer):
+                        # JSON line longer than the buffer
+                        self.buffer.extend(bytes(len(self.buffer)))
+                    break
+                if delimiter > self.start:
+                    messages.append(bytes(self.buffer[self.start:delimiter]))
+                self.start = delimiter + 1
+        return messages
 
-        for i in range(len(parts) - 1):
-            messages.append(parts[i])
+    def receive_large_frame(self, frame_length):
+        frame = bytearray(frame_length)
+        buffered = self.end - self.start
+        frame[:buffered] = self.buffer[self.start:self.end]
+        self.start = self.end = 0
 
-        if b'\n' in chunk:
-            data = parts[-1]
-        
-        if chunk.endswith(b'\n'):
-            break
+        view = memoryview(frame)
+        while buffered < frame_length:
+            received = self.socket.recv_into(view[buffered:])
+            if not received:
+                raise ConnectionResetError("Connection closed in the middle of a message")
+            buffered += received
+        return frame
+
+    # Receive more data into the buffer, returns False when the connection was closed
+    def fill(self):
+        if self.start > 0:
+            # Move the incomplete message to the front of the buffer
+            remaining = self.end - self.start
+            self.buffer[:remaining] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, remaining
+
+        received = self.socket.recv_into(memoryview(self.buffer)[self.end:])
+        if not received:
+            return False
+        self.end += received
+        return True
+
+# Define function to receive the complete messages of a connection
+def receive_message(client_socket):
+    state = get_socket_state(client_socket)
+    if state.receiver is None:
+        state.receiver = StreamReceiver(client_socket)
+    return state.receiver.receive()
 
-    # Process and decode each individual message
-    decoded_messages = [message.decode() for message in messages]
+# Receive the next raw message from an asyncio stream, None once the connection is closed.
+# Messages larger than max_message_size raise a ValueError instead of being buffered.
+async def receive_message_async(reader, max_message_size):
+    try:
+        first_byte = await reader.readexactly(1)
+    except asyncio.IncompleteReadError:
+        return None
 
-    return decoded_messages
+    if first_byte == FRAME_MAGIC[:1]:
+        header = first_byte + await reader.readexactly(FRAME_HEADER.size - 1)
+        metadata_length, payload_length = FRAME_HEADER.unpack(header)[5:]
+        if FRAME_HEADER.size + metadata_length + payload_length > max_message_size:
+            raise ValueError("Message exceeds the buffer limit")
+        return header + await reader.readexactly(metadata_length + payload_length)
 
+    # JSON lines longer than the stream limit raise a LimitOverrunError
+    return first_byte + await reader.readuntil(b'\n')
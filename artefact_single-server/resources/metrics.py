@@ -0,0 +1,159 @@
+import time
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Helper script collecting counters, histograms and gauges of clients and servers and serving them as
+# Prometheus text on a local HTTP endpoint. Recording only updates a few numbers in memory, gauges
+# (e.g. queue depths) are only computed when the endpoint is scraped.
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, labels) -> value, labels being a sorted tuple of (key, value) pairs
+        self.counters = {}
+        # (name, labels) -> [bucket counts, sum, count]
+        self.histograms = {}
+        # name -> (function returning the current value or a dict of label value -> value, label name)
+        self.gauges = {}
+
+    def inc(self, name, labels=None, value=1):
+        key = (name, get_label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    # Record a duration in seconds
+    def observe(self, name, seconds, labels=None):
+        key = (name, get_label_key(labels))
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = [[0] * (len(LATENCY_BUCKETS) + 1), 0, 0]
+                self.histograms[key] = histogram
+            histogram[0][bucket] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    # Time a block: with metrics.timer("name"): ...
+    def timer(self, name, labels=None):
+        return Timer(self, name, labels)
+
+    def register_gauge(self, name, function, label=None):
+        self.gauges[name] = (function, label)
+
+    def get_stats(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (list(buckets), total, count) for key, (buckets, total, count) in self.histograms.items()}
+        gauges = {}
+        for name, (function, label) in list(self.gauges.items()):
+            try:
+                value = function()
+                if isinstance(value, dict):
+                    value = {((label, str(label_value)),): labelled_value for label_value, labelled_value in value.items()}
+                gauges[name] = value
+            except Exception as e:
+                print(f"Error reading gauge {name}: {e}")
+        return counters, histograms, gauges
+
+    # All metrics in the Prometheus text exposition format
+    def render(self):
+        counters, histograms, gauges = self.get_stats()
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name in described:
+                return
+            described.add(name)
+            lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name, "counter")
+            lines.append(f"{name}{format_labels(labels)} {value}")
+
+        for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+            header(name, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS + ["+Inf"], buckets):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
+
+        for name, value in sorted(gauges.items()):
+            header(name, "gauge")
+            if isinstance(value, dict):
+                for labels, labelled_value in sorted(value.items()):
+                    lines.append(f"{name}{format_labels(labels)} {labelled_value}")
+            else:
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+
+class Timer:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, self.labels)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Scrapes are not logged
+    def log_message(self, format, *args):
+        pass
+
+
+# Serve the metrics on http://host:port/metrics from a background thread
+def start_metrics_server(port, host="127.0.0.1"):
+    http_server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    http_server.daemon_threads = True
+    server_thread = threading.Thread(target=http_server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    print(f"Metrics available on http://{host}:{port}/metrics")
+    return http_server
+
+
+# Labels as a hashable key, a dict or a tuple of (key, value) pairs
+def get_label_key(labels):
+    if not labels:
+        return ()
+    if isinstance(labels, dict):
+        labels = labels.items()
+    return tuple(sorted((str(key), str(value)) for key, value in labels))
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in labels) + "}"
+
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
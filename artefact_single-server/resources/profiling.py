@@ -0,0 +1,258 @@
+import os
+import sys
+import json
+import time
+import threading
+import tracemalloc
+from collections import Counter
+
+# Helper script recording where the time of the messages goes (--profile). The stages a message passes, from
+# reading the file on the client to writing it on the server, are recorded as spans carrying the id of the
+# message and saved in the Chrome trace format (chrome://tracing, https://ui.perfetto.dev). Timestamps are
+# wall clock times, so the traceEvents of clients and servers on one machine can be merged into one trace.
+# Recording is off by default and then costs a single check per stage.
+
+# Spans kept at most, later ones are only counted
+MAX_SPANS = 1000000
+# Spans a thread keeps while waiting for the id of the message they belong to
+MAX_UNASSIGNED = 1024
+
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.process_name = None
+        # [name, start, end, message id, thread id, args], start and end in perf_counter seconds
+        self.spans = []
+        self.dropped = 0
+        self.thread_names = {}
+        self.lock = threading.Lock()
+        # Message handled by the thread and spans recorded before their message got an id (span_before_id)
+        self.local = threading.local()
+        self.unassigned_lists = []
+        self.clock_offset = time.time() - time.perf_counter()
+        # Ids of the messages of a process numbering them only while profiling
+        self.message_count = 0
+
+    def start(self, path, process_name):
+        self.path = path
+        self.process_name = process_name
+        self.enabled = True
+        print(f"Profiling, the trace is saved to {path} on exit")
+
+    # Time a block as a span of a message, by default of the message the thread is handling
+    def span(self, name, message_id=None, **args):
+        if not self.enabled:
+            return NO_SPAN
+        return Span(self, name, message_id, args, False)
+
+    # Time a block of a message that only gets its id afterwards on the same thread (e.g. reading the file)
+    def span_before_id(self, name, **args):
+        if not self.enabled:
+            return NO_SPAN
+        return Span(self, name, None, args, True)
+
+    # Handle a message on this thread: spans without an explicit id belong to it
+    def message(self, message_id):
+        if not self.enabled:
+            return NO_SPAN
+        return MessageContext(self, message_id)
+
+    # Message the thread is handling, e.g. to hand it over to an I/O thread
+    def get_message_id(self):
+        return getattr(self.local, "message_id", None)
+
+    # The spans this thread recorded before the message got its id belong to it
+    def assign(self, message_id):
+        if not self.enabled:
+            return
+        spans = self.get_unassigned()
+        for span in spans:
+            span[3] = message_id
+        self.add(spans)
+        spans.clear()
+
+    # Id for a message of a process that does not number its messages otherwise
+    def next_id(self):
+        with self.lock:
+            self.message_count += 1
+            return self.message_count
+
+    def record(self, name, start, end, message_id=None, args=None, before_id=False):
+        if not self.enabled:
+            return
+        if message_id is None and not before_id:
+            message_id = self.get_message_id()
+        thread = threading.current_thread()
+        if thread.ident not in self.thread_names:
+            self.thread_names[thread.ident] = thread.name
+        span = [name, start, end, message_id, thread.ident, args]
+        if not before_id:
+            self.add([span])
+            return
+        unassigned = self.get_unassigned()
+        unassigned.append(span)
+        if len(unassigned) > MAX_UNASSIGNED:
+            self.add(unassigned[:-MAX_UNASSIGNED])
+            del unassigned[:-MAX_UNASSIGNED]
+
+    def add(self, spans):
+        with self.lock:
+            room = MAX_SPANS - len(self.spans)
+            self.spans.extend(spans[:room])
+            self.dropped += max(0, len(spans) - room)
+
+    def get_unassigned(self):
+        unassigned = getattr(self.local, "unassigned", None)
+        if unassigned is None:
+            unassigned = []
+            self.local.unassigned = unassigned
+            # Kept to be saved with the trace if no id follows
+            with self.lock:
+                self.unassigned_lists.append(unassigned)
+        return unassigned
+
+    # Save the recorded spans in the Chrome trace format
+    def dump(self, path=None):
+        if not self.enabled:
+            return
+        path = path or self.path
+        with self.lock:
+            spans = self.spans + [span for unassigned in self.unassigned_lists for span in list(unassigned)]
+            thread_names = dict(self.thread_names)
+        pid = os.getpid()
+
+        events = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": self.process_name}}]
+        for thread_id, thread_name in thread_names.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": thread_id, "args": {"name": thread_name}})
+        for name, start, end, message_id, thread_id, args in spans:
+            event_args = {key: format_value(value) for key, value in (args or {}).items()}
+            if message_id is not None:
+                event_args["message_id"] = message_id
+            events.append({
+                "name": name,
+                "cat": "message",
+                "ph": "X",
+                "ts": round((start + self.clock_offset) * 1000000, 1),
+                "dur": round((end - start) * 1000000, 1),
+                "pid": pid,
+                "tid": thread_id,
+                "args": event_args
+            })
+
+        with open(path, 'w') as trace_file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"dropped_spans": self.dropped}}, trace_file)
+        print(f"Trace of {len(spans)} spans saved to {path}")
+
+tracer = Tracer()
+
+
+class Span:
+    def __init__(self, tracer, name, message_id, args, before_id):
+        self.tracer = tracer
+        self.name = name
+        self.message_id = message_id
+        self.args = args
+        self.before_id = before_id
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.record(self.name, self.start, time.perf_counter(), self.message_id, self.args, self.before_id)
+
+
+class MessageContext:
+    def __init__(self, tracer, message_id):
+        self.tracer = tracer
+        self.message_id = message_id
+
+    def __enter__(self):
+        self.previous = getattr(self.tracer.local, "message_id", None)
+        self.tracer.local.message_id = self.message_id
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.local.message_id = self.previous
+
+
+# Returned while profiling is off
+class NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+NO_SPAN = NoSpan()
+
+
+# Samples the stacks of all threads and traces the memory allocations for a bounded window after the start
+# (--profile-window). Unlike cProfile, which only sees the thread that enabled it, the samples cover the
+# receiving, sending and I/O threads alike. Threads waiting (e.g. for messages) show up in the samples as well.
+class Sampler:
+    def __init__(self, path, seconds, interval=0.005):
+        self.path = path
+        self.seconds = seconds
+        self.interval = interval
+
+        sampler_thread = threading.Thread(target=self.run)
+        sampler_thread.daemon = True
+        sampler_thread.start()
+
+    def run(self):
+        tracemalloc.start()
+        stacks = Counter()
+        own_thread = threading.get_ident()
+        deadline = time.monotonic() + self.seconds
+        while time.monotonic() < deadline:
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_thread:
+                    stacks[get_stack(thread_names.get(thread_id, str(thread_id)), frame)] += 1
+            time.sleep(self.interval)
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        # Folded stacks, the input format of flamegraph.pl and speedscope
+        with open(self.path + ".stacks", 'w') as stacks_file:
+            for stack, count in stacks.most_common():
+                stacks_file.write(f"{stack} {count}\n")
+        statistics = snapshot.statistics("lineno")
+        with open(self.path + ".memory", 'w') as memory_file:
+            for statistic in statistics[:100]:
+                memory_file.write(f"{statistic}\n")
+
+        leaves = Counter()
+        for stack, count in stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        print(f"Profiling window of {self.seconds}s over, most sampled functions:")
+        for leaf, count in leaves.most_common(10):
+            print(f"  {count:6d}  {leaf}")
+        print(f"Largest allocations: {statistics[0] if statistics else None}")
+        print(f"Stacks saved to {self.path}.stacks, allocations to {self.path}.memory")
+
+
+# Start recording spans and, for a window of seconds, sampling
+def start_profiling(path, process_name, window=None):
+    tracer.start(path, process_name)
+    if window:
+        Sampler(path, window)
+
+
+def get_stack(thread_name, frame):
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    frames.append(thread_name)
+    return ";".join(reversed(frames))
+
+
+def format_value(value):
+    if isinstance(value, tuple):
+        return ":".join(str(part) for part in value)
+    return value
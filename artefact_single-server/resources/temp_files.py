@@ -0,0 +1,21 @@
+import os
+import re
+import uuid
+
+# Helper script naming the temporary files the server writes next to the files of users (unfinished uploads,
+# rebuilt deltas, new blobs and links). The names are hidden and contain a random part, so that they never
+# collide with a file of the user, and end in the kind of temporary file.
+
+TEMPORARY_KINDS = ("part", "delta", "link", "blob", "tmp")
+TEMPORARY_NAME = re.compile(r"\..+\.[0-9a-f]{32}\.(?:" + "|".join(TEMPORARY_KINDS) + ")")
+
+
+# Unique path of a temporary file next to its target, e.g. ".notes.txt.<32 hex digits>.tmp"
+def get_temp_path(target_path, kind):
+    directory, name = os.path.split(target_path)
+    return os.path.join(directory, ".{}.{}.{}".format(name, uuid.uuid4().hex, kind))
+
+
+# Whether a file name is one of a temporary file, which is left out when comparing folders
+def is_temporary(name):
+    return TEMPORARY_NAME.fullmatch(name) is not None
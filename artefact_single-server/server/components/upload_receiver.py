@@ -0,0 +1,86 @@
+import os
+import threading
+
+import sys
+sys.path.append('../')
+from resources.temp_files import get_temp_path
+
+# Class collecting streamed uploads chunk by chunk in temporary files next to their target,
+# which are handed to the file store only once the upload is complete
+class UploadReceiver:
+    def __init__(self, max_chunk_size, window, store):
+        self.max_chunk_size = max_chunk_size
+        self.window = window
+        self.store = store
+        # (client, upload id) -> state of the upload
+        self.uploads = {}
+        self.lock = threading.Lock()
+
+    # Limits announced to clients at login
+    def get_limits(self):
+        return {
+            "max_chunk_size": self.max_chunk_size,
+            "window": self.window,
+            # Clients may send only the hash of content the store already has
+            "dedup": self.store.deduplicates
+        }
+
+    def start(self, client, upload_id, server_path):
+        self.abort(client, upload_id)
+        temp_path = get_temp_path(server_path, "part")
+        upload = {
+            "path": server_path,
+            "temp_path": temp_path,
+            "file": open(temp_path, 'wb'),
+            "chunks": 0
+        }
+        with self.lock:
+            self.uploads[(client, upload_id)] = upload
+
+    # Write a chunk at its offset, returns False for unknown uploads or oversized chunks
+    def write_chunk(self, client, upload_id, offset, data):
+        with self.lock:
+            upload = self.uploads.get((client, upload_id))
+        if upload is None or len(data) > self.max_chunk_size:
+            return False
+        upload["file"].seek(offset)
+        upload["file"].write(data)
+        upload["chunks"] += 1
+        return True
+
+    # Target path of an upload, None if it is unknown
+    def get_path(self, client, upload_id):
+        with self.lock:
+            upload = self.uploads.get((client, upload_id))
+        return upload["path"] if upload is not None else None
+
+    # Move a complete upload to its target, returns the target path and whether all chunks arrived
+    def finish(self, client, upload_id, chunks, size):
+        with self.lock:
+            upload = self.uploads.pop((client, upload_id), None)
+        if upload is None:
+            return None, False
+
+        upload["file"].truncate(size)
+        upload["file"].close()
+        if upload["chunks"] != chunks:
+            os.remove(upload["temp_path"])
+            return upload["path"], False
+
+        self.store.replace(upload["temp_path"], upload["path"])
+        return upload["path"], True
+
+    def abort(self, client, upload_id):
+        with self.lock:
+            upload = self.uploads.pop((client, upload_id), None)
+        if upload is not None:
+            upload["file"].close()
+            if os.path.exists(upload["temp_path"]):
+                os.remove(upload["temp_path"])
+
+    # Drop all unfinished uploads of a client, e.g. when it disconnects
+    def abort_all(self, client):
+        with self.lock:
+            upload_ids = [upload_id for owner, upload_id in self.uploads if owner == client]
+        for upload_id in upload_ids:
+            self.abort(client, upload_id)
@@ -0,0 +1,111 @@
+import os
+import csv
+import hmac
+import hashlib
+import tempfile
+import threading
+
+HASH_SCHEME = "pbkdf2_sha256"
+HASH_ITERATIONS = 100000
+SALT_SIZE = 16
+
+# Class holding the users "database" in memory, keyed by username. The CSV file is only parsed again
+# when it changed on disk. Passwords are stored as salted PBKDF2 hashes, plain text passwords
+# added to the file by hand are hashed (and written back) the next time it is loaded.
+# Only one process may write the file back, others sharing it (e.g. workers) only hash in memory.
+class UserStore:
+    def __init__(self, users_file, rewrite=True):
+        self.users_file = users_file
+        self.rewrite = rewrite
+        # username -> stored password hash ("" = no password required)
+        self.users = {}
+        # username -> fast digest of the last password that was verified, spares repeated PBKDF2 runs
+        self.verified = {}
+        self.file_state = None
+        self.lock = threading.Lock()
+        self.reload_if_changed()
+
+    # Parse the file again if its modification time or size changed since it was last read
+    def reload_if_changed(self):
+        stat = os.stat(self.users_file)
+        file_state = (stat.st_mtime_ns, stat.st_size)
+        if file_state == self.file_state:
+            return
+
+        with self.lock:
+            if file_state == self.file_state:
+                return
+            with open(self.users_file, newline='') as file:
+                content = file.read()
+            users = {}
+            rewrite = False
+            for row in csv.DictReader(content.splitlines()):
+                if not row.get("username"):
+                    continue
+                password = row.get("password") or ""
+                if password and not password.startswith(HASH_SCHEME + "$"):
+                    password = hash_password(password)
+                    rewrite = True
+                users[row["username"]] = password
+
+            # Keep verified passwords of users whose hash did not change
+            self.verified = {username: digest for username, digest in self.verified.items()
+                             if self.users.get(username) == users.get(username)}
+            self.users = users
+            if rewrite and self.rewrite:
+                self.write(users, "\r\n" if "\r\n" in content else "\n")
+            stat = os.stat(self.users_file)
+            self.file_state = (stat.st_mtime_ns, stat.st_size)
+
+    # Replace the file with the hashed passwords, readers see either the old or the new file
+    def write(self, users, line_terminator):
+        file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.users_file)),
+                                                      prefix=os.path.basename(self.users_file) + ".", suffix=".tmp")
+        try:
+            with os.fdopen(file_descriptor, 'w', newline='') as file:
+                writer = csv.writer(file, lineterminator=line_terminator)
+                writer.writerow(["username", "password"])
+                for username, password in users.items():
+                    writer.writerow([username, password])
+            os.replace(temp_path, self.users_file)
+        except OSError:
+            os.remove(temp_path)
+            raise
+
+    def exists(self, username):
+        self.reload_if_changed()
+        return username in self.users
+
+    # Check the password of a user, users without a stored password accept any
+    def verify(self, username, password):
+        self.reload_if_changed()
+        stored = self.users.get(username)
+        if stored is None:
+            return False
+        if stored == "":
+            return True
+
+        digest = hashlib.sha256((stored + password).encode()).digest()
+        cached = self.verified.get(username)
+        if cached is not None and hmac.compare_digest(cached, digest):
+            return True
+        if not check_password(password, stored):
+            return False
+        self.verified[username] = digest
+        return True
+
+
+def hash_password(password, salt=None, iterations=HASH_ITERATIONS):
+    if salt is None:
+        salt = os.urandom(SALT_SIZE)
+    password_hash = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+    return "{}${}${}${}".format(HASH_SCHEME, iterations, salt.hex(), password_hash.hex())
+
+
+def check_password(password, stored):
+    try:
+        _, iterations, salt, password_hash = stored.split("$")
+        expected = hash_password(password, bytes.fromhex(salt), int(iterations))
+    except ValueError:
+        return False
+    return hmac.compare_digest(expected.split("$")[3], password_hash)
@@ -1,16 +1,27 @@
 import os
 import json
 import socket
+import asyncio
 from threading import Thread
-import base64
+from concurrent.futures import ThreadPoolExecutor
 import shutil
 import signal
-import pandas as pd
 import argparse
 
 import sys
 sys.path.append('../')
-from resources.message_sending import send_message, receive_message
+from resources.message_sending import send_message, receive_message, receive_message_async, load_message, decode_data, negotiate_protocol, set_protocol, unpack_batch, set_compressions
+from resources.compression import negotiate_compressions, compression_stats
+from resources.metrics import metrics, start_metrics_server
+from resources.profiling import tracer, start_profiling
+from resources.delta_sync import SignatureCache, apply_delta
+from resources.merkle_tree import FileHashCache, build_tree
+from resources.temp_files import get_temp_path
+from components.upload_receiver import UploadReceiver
+from components.file_store import FileStore, BlobStore
+from components.user_store import UserStore
+from components.storage_executor import StorageExecutor
+from components.change_notifier import ChangeNotifier
 
 # Import server configuration
 # Load configuration from the JSON file
@@ -21,6 +32,19 @@ with open('server_config.json', 'r') as config_file:
 SERVER_HOST = config["server_host"]
 SERVER_PORT = config["server_port"]
 SERVER_DIR = config["server_dir"]
+MAX_CHUNK_SIZE = config["max_chunk_size"]
+UPLOAD_WINDOW = config["upload_window"]
+BACKLOG = config["backlog"]
+BUFFER_LIMIT = config["buffer_limit"]
+USE_ASYNCIO = False
+STORAGE = config["storage"]
+USERS_FILE = config["users_file"]
+MAX_BATCH_MESSAGES = config["max_batch_messages"]
+IO_WORKERS = config["io_workers"]
+METRICS_PORT = config["metrics_port"]
+# Trace file and seconds of stack and memory sampling, only set on the command line
+PROFILE = None
+PROFILE_WINDOW = None
 
 # Define a list to store active client sockets
 active_clients = []
@@ -28,8 +52,26 @@ active_clients = []
 # Define a list to store clients, that are logged in
 logged_clients = {}
 
+# Cache of block signatures of the stored files, used for delta syncing
+signature_cache = SignatureCache()
+
+# Hash trees of the user folders, built when a client starts reconciling after login
+hash_cache = FileHashCache()
+client_trees = {}
+
+# Storage of the files and collector of streamed uploads, created once the command line arguments are parsed
+file_store = None
+upload_receiver = None
+# File operations run on I/O threads, so that a slow one does not hold up the messages of other clients
+storage_executor = None
+# Updates applied for a user are pushed to the other devices the user is logged in from
+change_notifier = None
+
+# Users "database", loaded once the command line arguments are parsed and kept in memory
+user_store = None
+
 def parse_command_line_args():
-    global SERVER_HOST, SERVER_PORT, SERVER_DIR
+    global SERVER_HOST, SERVER_PORT, SERVER_DIR, MAX_CHUNK_SIZE, UPLOAD_WINDOW, BACKLOG, BUFFER_LIMIT, USE_ASYNCIO, STORAGE, MAX_BATCH_MESSAGES, IO_WORKERS, METRICS_PORT, USERS_FILE, PROFILE, PROFILE_WINDOW
     parser = argparse.ArgumentParser(description="Client replicating Dropbox functionality by syncing files and folders in the background")
     
     # Add command-line arguments to overwrite configuration values
@@ -37,6 +79,18 @@ def parse_command_line_args():
     parser.add_argument('--server-port', type=int, help='Server port number')
     parser.add_argument('--debug', action='store_true', help='Decide whether sent messages should be logged for debugging')
     parser.add_argument('--server-dir', help='Server directory path')
+    parser.add_argument('--max-chunk-size', type=int, help='Largest chunk in bytes accepted for streamed uploads')
+    parser.add_argument('--upload-window', type=int, help='Maximum number of streamed chunks a client may have in flight')
+    parser.add_argument('--asyncio', action='store_true', help='Serve all clients from one asyncio event loop instead of a thread per client')
+    parser.add_argument('--backlog', type=int, help='Maximum number of pending connections')
+    parser.add_argument('--buffer-limit', type=int, help='Largest message in bytes buffered per connection in asyncio mode')
+    parser.add_argument('--max-batch-messages', type=int, help='Largest number of updates a client may send in one batch')
+    parser.add_argument('--storage', choices=["files", "blobs"], help='Store files as plain files or deduplicated by content hash')
+    parser.add_argument('--io-workers', type=int, help='Number of threads writing updates to disk, updates of different paths are written in parallel')
+    parser.add_argument('--metrics-port', type=int, help='Local port serving counters and latency histograms in the Prometheus text format')
+    parser.add_argument('--users-file', help='CSV file with the usernames and passwords')
+    parser.add_argument('--profile', help='Record the time spent in each stage of every message and save it as a Chrome trace to this file on exit')
+    parser.add_argument('--profile-window', type=float, help='Seconds after the start to sample the stacks of all threads and the memory allocations (with --profile)')
 
     args = parser.parse_args()
 
@@ -50,6 +104,29 @@ def parse_command_line_args():
         SERVER_HOST = args.server_host
     if args.server_port:
         SERVER_PORT = args.server_port
+    if args.max_chunk_size:
+        MAX_CHUNK_SIZE = args.max_chunk_size
+    if args.upload_window:
+        UPLOAD_WINDOW = args.upload_window
+    if args.asyncio:
+        USE_ASYNCIO = True
+    if args.backlog:
+        BACKLOG = args.backlog
+    if args.buffer_limit:
+        BUFFER_LIMIT = args.buffer_limit
+    if args.storage:
+        STORAGE = args.storage
+    if args.max_batch_messages:
+        MAX_BATCH_MESSAGES = args.max_batch_messages
+    if args.io_workers:
+        IO_WORKERS = args.io_workers
+    if args.metrics_port:
+        METRICS_PORT = args.metrics_port
+    if args.users_file:
+        USERS_FILE = args.users_file
+    if args.profile:
+        PROFILE = args.profile
+        PROFILE_WINDOW = args.profile_window
     if args.server_dir and os.path.exists(args.server_dir):
         SERVER_DIR = args.server_dir
     elif ((args.server_dir and not os.path.exists(args.server_dir)) or
@@ -69,18 +146,13 @@ def handle_client(client_socket):
             try:
                 messages = []
                 for data_item in data:
-                    message = json.loads(data_item)
+                    message = load_message(data_item)
                     messages.append(message)
 
                 for message in messages:
-                    # Perform update handling
-                    if message["action"] == "update" and client_socket in logged_clients:
-                        handle_update(message, client_socket)
-                    # Perform login handling
-                    elif message["action"] == "login":
-                        handle_login(message, client_socket)
-            except json.JSONDecodeError:
-                print("Error decoding JSON message")
+                    handle_message(message, client_socket)
+            except ValueError:
+                print("Error decoding message")
 
     except ConnectionResetError:
         print("Client disconnected")
@@ -90,54 +162,195 @@ def handle_client(client_socket):
         active_clients.remove(client_socket)
         if client_socket in logged_clients:
             del logged_clients[client_socket]
+        change_notifier.remove_session(client_socket)
+        client_trees.pop(client_socket, None)
+        upload_receiver.abort_all(client_socket)
+
+# Dispatch a client message to its handler
+def handle_message(message, client_socket):
+    # Perform update handling
+    if message["action"] == "update" and client_socket in logged_clients:
+        with tracer.message(message.get("id")):
+            handle_update(message, client_socket)
+    # Perform handling of batched updates
+    elif message["action"] == "batch" and client_socket in logged_clients:
+        with tracer.message(message.get("id")):
+            handle_batch(message, client_socket)
+    # Perform login handling
+    elif message["action"] == "login":
+        handle_login(message, client_socket)
+    # Answer block signature requests used for delta syncing
+    elif message["action"] == "signatures" and client_socket in logged_clients:
+        handle_signatures(message, client_socket)
+    # Answer hash tree requests of clients reconciling their folder
+    elif message["action"] == "tree" and client_socket in logged_clients:
+        handle_tree(message, client_socket)
+    # Send copies of files changed by other devices to clients reconciling their folder
+    elif message["action"] == "fetch" and client_socket in logged_clients:
+        handle_fetch(message, client_socket)
+    # Perform streamed upload handling
+    elif message["action"] in ("upload_start", "upload_chunk", "upload_end") and client_socket in logged_clients:
+        handle_upload(message, client_socket)
+
+# Connection of the asyncio server, offering the socket methods the message handlers use
+class AsyncConnection:
+    def __init__(self, writer, loop):
+        self.writer = writer
+        self.loop = loop
+        self.peername = writer.get_extra_info("peername")
+
+    def getpeername(self):
+        return self.peername
+
+    # Handlers run in executor threads, so writing is handed over to the event loop
+    def sendall(self, data):
+        self.loop.call_soon_threadsafe(self.writer.write, data)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+# Coroutine dedicated to each client in asyncio mode
+async def handle_client_async(reader, writer, executor):
+    loop = asyncio.get_running_loop()
+    connection = AsyncConnection(writer, loop)
+    active_clients.append(connection)
+    print(f"Accepted connection from {connection.getpeername()}")
+    try:
+        # Listen for message from client
+        while True:
+            data = await receive_message_async(reader, BUFFER_LIMIT)
+            if not data:
+                break
+            try:
+                message = load_message(data)
+            except ValueError:
+                print("Error decoding message")
+                continue
 
-# Define what to do on specific client messages
+            # Handlers touch the disk, so they run in the executor, one message of a client after the other
+            await loop.run_in_executor(executor, handle_message, message, connection)
+            await writer.drain()
+
+    except ConnectionResetError:
+        print("Client disconnected")
+    except (asyncio.LimitOverrunError, asyncio.IncompleteReadError, ValueError) as e:
+        print(f"Closing connection to {connection.getpeername()}: {e}")
+    finally:
+        print(f"{connection.getpeername()} disconnected")
+        writer.close()
+        active_clients.remove(connection)
+        if connection in logged_clients:
+            del logged_clients[connection]
+        change_notifier.remove_session(connection)
+        client_trees.pop(connection, None)
+        upload_receiver.abort_all(connection)
+
+# Serve all clients from one event loop until Ctrl+C is pressed
+async def run_async_server():
+    executor = ThreadPoolExecutor()
+    server = await asyncio.start_server(lambda reader, writer: handle_client_async(reader, writer, executor),
+                                        SERVER_HOST, SERVER_PORT, backlog=BACKLOG, limit=BUFFER_LIMIT)
+    print(f"Server listening on {SERVER_HOST}:{SERVER_PORT}")
+
+    stop_event = asyncio.Event()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGINT, stop_event.set)
+    except NotImplementedError:
+        # Not supported on Windows, where the regular signal handler stays in place
+        pass
+
+    async with server:
+        await stop_event.wait()
+        send_shutdown_message_to_clients()
+        # Give the event loop the chance to flush the shutdown messages
+        await asyncio.sleep(0.1)
+    executor.shutdown(wait=False)
+
+# Hand the updates of a batch over to the I/O threads
+def handle_batch(message, client_socket):
+    for update in unpack_batch(message):
+        handle_update(update, client_socket)
+
+# Hand an update over to the I/O threads, updates of the same paths are applied in the order they arrived.
+# Once applied, the update is pushed to the other devices of the user.
 def handle_update(message, client_socket):
-    if os.environ["DEBUG"] == "on": 
-        print(message["event_type"])
-    if message["event_type"] == "modified":
-        # Handle file modification event with differences maybe to be added (?)
+    username = logged_clients[client_socket]
 
-        # For the moment, use the same logic as for file creation
-        # Handle file creation event
-        server_path = os.path.join(SERVER_DIR, logged_clients[client_socket], message["path"])
+    labels = {"event_type": message["event_type"]}
+    message_id = tracer.get_message_id()
+
+    def operation():
+        with metrics.timer("update_apply_seconds", labels), tracer.message(message_id), tracer.span("disk_write", path=message.get("path", message.get("dest_path"))):
+            apply_update(message, username, client_socket)
+        change_notifier.notify(username, client_socket, message)
+        metrics.inc("updates_applied_total", labels)
+        if message.get("data") is not None:
+            metrics.inc("update_bytes_applied_total", labels, len(message["data"]))
 
-        # Decode the Base64-encoded data received from the client
-        client_data_base64 = message["data"]
-        client_data_bytes = base64.b64decode(client_data_base64)
+    storage_executor.submit(get_server_paths(message, username), operation)
 
-        # Write the client data to the server file
-        with open(server_path, 'wb') as server_file:
-            server_file.write(client_data_bytes)
+# Server paths an update changes
+def get_server_paths(message, username):
+    if message["event_type"] == "moved":
+        return [os.path.join(SERVER_DIR, username, message["src_path"]), os.path.join(SERVER_DIR, username, message["dest_path"])]
+    return [os.path.join(SERVER_DIR, username, message["path"])]
+
+# Define what to do on specific client messages
+def apply_update(message, username, client_socket):
+    if os.environ["DEBUG"] == "on": 
+        print(message["event_type"])
+    if message["event_type"] == "modified":
+        # Handle file modification event
+        server_path = os.path.join(SERVER_DIR, username, message["path"])
+
+        if "data" not in message:
+            # Only the hash was sent, the content has to be stored already
+            link_content(message, server_path, client_socket)
+        elif "delta" in message:
+            # Rebuild the file from the delta, asking for the whole file if that fails
+            if not apply_delta_update(server_path, message["delta"], decode_data(message["data"])):
+                resync_message = {
+                    "type": "serverMessage",
+                    "action": "resync",
+                    "path": message["path"]
+                }
+                send_message(client_socket, resync_message)
+        else:
+            # Write the client data (Base64-encoded for JSON messages) to the server file
+            file_store.write(server_path, decode_data(message["data"]))
+            signature_cache.invalidate(server_path)
 
     elif message["event_type"] == "deleted":
         # Handle file deletion event
-        server_path = os.path.join(SERVER_DIR, logged_clients[client_socket], message["path"])
+        server_path = os.path.join(SERVER_DIR, username, message["path"])
         if os.path.exists(server_path):
             if message["structure"] == "dir":
-                shutil.rmtree(server_path)
+                file_store.remove_tree(server_path)
             else:
-                os.remove(server_path)
+                file_store.remove(server_path)
+                signature_cache.invalidate(server_path)
 
     elif message["event_type"] == "created":
         # Handle file creation event
-        server_path = os.path.join(SERVER_DIR, logged_clients[client_socket], message["path"])
+        server_path = os.path.join(SERVER_DIR, username, message["path"])
 
         if message["structure"] == "dir":
-            os.makedirs(server_path)
+            os.makedirs(server_path, exist_ok=True)
+        elif "data" not in message:
+            # Only the hash was sent, the content has to be stored already
+            link_content(message, server_path, client_socket)
         else:
-            # Decode the Base64-encoded data received from the client
-            client_data_base64 = message["data"]
-            client_data_bytes = base64.b64decode(client_data_base64)
+            # Decode the data received from the client (Base64-encoded for JSON messages)
+            client_data_bytes = decode_data(message["data"])
 
             # Write the decoded data to the file on the server
-            with open(server_path, 'wb') as server_file:
-                server_file.write(client_data_bytes)
+            file_store.write(server_path, client_data_bytes)
+            signature_cache.invalidate(server_path)
 
     elif message["event_type"] == "moved":
         # Handle file move/rename event
-        src_server_path = os.path.join(SERVER_DIR, logged_clients[client_socket], message["src_path"])
-        dest_server_path = os.path.join(SERVER_DIR, logged_clients[client_socket], message["dest_path"])
+        src_server_path = os.path.join(SERVER_DIR, username, message["src_path"])
+        dest_server_path = os.path.join(SERVER_DIR, username, message["dest_path"])
         if os.path.exists(src_server_path):
             if message["structure"] == "dir":
                 try:
@@ -150,14 +363,158 @@ def handle_update(message, client_socket):
                 except:
                     pass
 
+# Create a file from content the server already stores, asking for the whole file if it does not
+def link_content(message, server_path, client_socket):
+    if file_store.link(message["file_hash"], server_path):
+        signature_cache.invalidate(server_path)
+    else:
+        resync_message = {
+            "type": "serverMessage",
+            "action": "resync",
+            "path": message["path"]
+        }
+        send_message(client_socket, resync_message)
+
+# Handle the start, chunks and end of a streamed upload
+def handle_upload(message, client_socket):
+    user_dir = os.path.join(SERVER_DIR, logged_clients[client_socket])
+    upload_id = message["upload_id"]
+
+    if message["action"] == "upload_start":
+        server_path = os.path.join(user_dir, message["path"])
+        # The temporary file is created next to the target, after the updates sent before the upload
+        storage_executor.wait(server_path)
+        upload_receiver.start(client_socket, upload_id, server_path)
+
+    elif message["action"] == "upload_chunk":
+        # Chunks are written straight to the temporary file of the upload and acknowledged,
+        # which lets the client send the next ones
+        ack_message = {
+            "type": "serverMessage",
+            "action": "upload_ack",
+            "upload_id": upload_id,
+            "seq": message["seq"],
+            "result": "successful"
+        }
+        data = decode_data(message["data"])
+        with tracer.span("disk_write", seq=message["seq"]):
+            written = upload_receiver.write_chunk(client_socket, upload_id, message["offset"], data)
+        if not written:
+            ack_message["result"] = "failed"
+            upload_receiver.abort(client_socket, upload_id)
+        send_message(client_socket, ack_message)
+
+    elif message["action"] == "upload_end":
+        # The complete file is moved into place on an I/O thread, in order with the updates of the same path
+        server_path = upload_receiver.get_path(client_socket, upload_id)
+        if server_path is not None:
+            storage_executor.submit([server_path], lambda: finish_upload(message, client_socket, user_dir))
+
+def finish_upload(message, client_socket, user_dir):
+    server_path, complete = upload_receiver.finish(client_socket, message["upload_id"], message["chunks"], message["size"])
+    if server_path is not None:
+        signature_cache.invalidate(server_path)
+        if complete:
+            change_notifier.notify(os.path.basename(user_dir), client_socket, {
+                "event_type": "modified",
+                "structure": "file",
+                "path": os.path.relpath(server_path, user_dir)
+            })
+        else:
+            # Ask for the whole file again if chunks went missing
+            resync_message = {
+                "type": "serverMessage",
+                "action": "resync",
+                "path": os.path.relpath(server_path, user_dir)
+            }
+            send_message(client_socket, resync_message)
+
+# Apply a block-level delta to a file, returns False if the base file does not match
+def apply_delta_update(server_path, delta, delta_bytes):
+    if not os.path.isfile(server_path):
+        return False
+    if signature_cache.get(server_path)["file_hash"] != delta["base_hash"]:
+        return False
+
+    # Reconstruct next to the original and swap it in once the result is verified
+    temp_path = get_temp_path(server_path, "delta")
+    try:
+        file_hash = apply_delta(server_path, delta_bytes, delta["block_size"], temp_path)
+        if file_hash != delta["file_hash"]:
+            os.remove(temp_path)
+            return False
+        file_store.replace(temp_path, server_path, file_hash)
+    except (OSError, ValueError) as e:
+        print(f"Error applying delta to {server_path}: {e}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+
+    signature_cache.invalidate(server_path)
+    return True
+
+# Send the block signatures of a file to the client
+def handle_signatures(message, client_socket):
+    server_path = os.path.join(SERVER_DIR, logged_clients[client_socket], message["path"])
+    # Read the file only after the updates sent before were written
+    storage_executor.wait(server_path)
+
+    reply = {
+        "type": "serverMessage",
+        "action": "signatures",
+        "path": message["path"],
+        "exists": os.path.isfile(server_path)
+    }
+
+    if reply["exists"]:
+        signatures = signature_cache.get(server_path)
+        reply["block_size"] = signatures["block_size"]
+        reply["file_hash"] = signatures["file_hash"]
+        reply["data"] = signatures["signatures"]
+
+    send_message(client_socket, reply)
+
+# Send the entries of the requested directories of the user folder. Clients start at the root and only
+# ask for the directories whose digests differ from their own, the tree is built once per reconciliation.
+def handle_tree(message, client_socket):
+    if "" in message["paths"] or client_socket not in client_trees:
+        user_dir = os.path.join(SERVER_DIR, logged_clients[client_socket])
+        storage_executor.wait(user_dir)
+        client_trees[client_socket] = build_tree(user_dir, hash_cache)
+    tree = client_trees[client_socket]
+
+    reply = {
+        "type": "serverMessage",
+        "action": "tree",
+        "request_id": message["request_id"],
+        "directories": {path: tree.get(path) for path in message["paths"]}
+    }
+
+    send_message(client_socket, reply)
+
+# Send the copy of a file, once the updates of the file received before were applied
+def handle_fetch(message, client_socket):
+    if not is_safe_path(message["path"]):
+        return
+    username = logged_clients[client_socket]
+    storage_executor.wait(os.path.join(SERVER_DIR, username, message["path"]))
+
+    reply = change_notifier.build_message(username, {"event_type": "created", "structure": "file", "path": message["path"]})
+    if reply is not None:
+        reply["action"] = "fetched"
+        send_message(client_socket, reply)
+
+# Relative paths from clients must stay inside the user folder
+def is_safe_path(relative_path):
+    if not isinstance(relative_path, str) or relative_path == "" or os.path.isabs(relative_path):
+        return False
+    return not os.path.normpath(relative_path).startswith("..")
+
 # Handle client login
 def handle_login(message, client_socket):
     if os.environ["DEBUG"] == "on": 
         print(message["action"])
 
-    # Read users "database"
-    users = pd.read_csv("users.csv")
-
     # Read credentials from message
     username = message["username"]
     password = message["password"]
@@ -169,12 +526,21 @@ def handle_login(message, client_socket):
     }
 
     # Verify Credentials
-    if username in users["username"].unique():
-        saved_password = users[users["username"] == username]["password"].item()
-        if saved_password == password or pd.isnull(saved_password):
+    if user_store.exists(username):
+        if user_store.verify(username, password):
             login_message["result"] = "successful"
             login_message["text"] = "Logged in successfully"
+            # Agree on the wire protocol, clients not offering any keep using JSON
+            login_message["protocol"] = negotiate_protocol(message.get("protocols"))
+            # Algorithms both sides can decode, the sender decides per message whether to compress
+            login_message["compressions"] = negotiate_compressions(message.get("compressions"))
+            # Announce how large files may be streamed
+            login_message["upload"] = upload_receiver.get_limits()
+            login_message["batch_limit"] = MAX_BATCH_MESSAGES
             logged_clients[client_socket] = username
+            # Clients asking for it are pushed the changes made on the other devices of the user
+            if message.get("push"):
+                change_notifier.add_session(client_socket, username)
             userpath = os.path.join(SERVER_DIR, username)
             if not os.path.isdir(userpath):
                 os.makedirs(userpath)
@@ -187,6 +553,9 @@ def handle_login(message, client_socket):
         login_message["text"] = "Username does not exist"
 
     send_message(client_socket, login_message)
+    if login_message["result"] == "successful":
+        set_protocol(client_socket, login_message["protocol"])
+        set_compressions(client_socket, login_message["compressions"])
 
 # If the server is closed, notify clients
 def send_shutdown_message_to_clients():
@@ -201,6 +570,11 @@ def send_shutdown_message_to_clients():
 
 # Add function to forward the Ctrl+C event to
 def handle_server_termination(signum, frame):
+    # Finish writing the updates already received
+    storage_executor.close()
+    if compression_stats.messages:
+        print(compression_stats.summary())
+    tracer.dump()
     print("Server terminated")
     send_shutdown_message_to_clients()
     sys.exit(0)
@@ -211,12 +585,40 @@ signal.signal(signal.SIGINT, handle_server_termination)
 if __name__ == "__main__":
     # Parse cmd line args
     parse_command_line_args()
+    if PROFILE:
+        start_profiling(PROFILE, "server", PROFILE_WINDOW)
+    user_store = UserStore(USERS_FILE)
+    file_store = BlobStore(SERVER_DIR) if STORAGE == "blobs" else FileStore(SERVER_DIR)
+    upload_receiver = UploadReceiver(MAX_CHUNK_SIZE, UPLOAD_WINDOW, file_store)
+    storage_executor = StorageExecutor(IO_WORKERS)
+    change_notifier = ChangeNotifier(SERVER_DIR, lambda message, client_socket: send_message(client_socket, message))
+
+    # Queue depths, only read when the metrics are scraped
+    metrics.register_gauge("connected_clients", lambda: len(active_clients))
+    metrics.register_gauge("logged_in_clients", lambda: len(logged_clients))
+    metrics.register_gauge("storage_operations_pending", lambda: storage_executor.pending)
+    metrics.register_gauge("push_changes_queued", change_notifier.get_queued)
+    if METRICS_PORT:
+        try:
+            start_metrics_server(METRICS_PORT)
+        except OSError as e:
+            print(f"Error serving metrics on port {METRICS_PORT}: {e}")
+
+    if USE_ASYNCIO:
+        try:
+            asyncio.run(run_async_server())
+        except OSError as e:
+            print(f"Error binding to {SERVER_HOST}:{SERVER_PORT}: {e}")
+            sys.exit(1)
+        storage_executor.close()
+        print("Server terminated")
+        sys.exit(0)
 
     # Boot server
     try:
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.bind((SERVER_HOST, SERVER_PORT))
-        server_socket.listen(5)
+        server_socket.listen(BACKLOG)
         print(f"Server listening on {SERVER_HOST}:{SERVER_PORT}")
     except OSError as e:
         print(f"Error binding to {SERVER_HOST}:{SERVER_PORT}: {e}")
@@ -236,4 +638,5 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         pass
 
+    storage_executor.close()
     print("Server terminated")
\ No newline at end of file
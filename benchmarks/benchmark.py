@@ -0,0 +1,456 @@
+import os
+import sys
+import json
+import time
+import random
+import shlex
+import shutil
+import signal
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+
+from workloads import WORKLOADS, ClientFolder, DIRECTORY_STATE, MIB, get_file_state
+
+# End-to-end benchmark of both versions of the service on the loopback interface. For every version and
+# workload a fresh set of servers and headless clients is started in a temporary folder, the workload is
+# replayed in the folder of every client and the server folders are polled until each change arrived.
+# Reported are the sync throughput, the time from a change to its arrival on a server (time-to-replicate)
+# and the CPU time and peak memory of the processes. The results are saved as JSON to compare commits.
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VARIANTS = ["artefact_single-server", "active_replication"]
+HOST = "127.0.0.1"
+# Seconds between two checks of the server folders
+POLL_INTERVAL = 0.01
+# Seconds processes get to start, log in and shut down
+START_TIMEOUT = 30
+STOP_TIMEOUT = 10
+
+def parse_command_line_args():
+    parser = argparse.ArgumentParser(description="Benchmark syncing workloads against local servers and clients")
+
+    parser.add_argument('--variants', nargs='+', choices=VARIANTS, default=VARIANTS, help='Versions of the service to benchmark')
+    parser.add_argument('--workloads', nargs='+', choices=list(WORKLOADS), default=list(WORKLOADS), help='Workloads to replay')
+    parser.add_argument('--servers', type=int, default=3, help='Number of servers (the single server version always uses one)')
+    parser.add_argument('--clients', type=int, default=2, help='Number of clients, each syncing the folder of its own user')
+    parser.add_argument('--replication', choices=['active', 'primary'], default='active', help='Replication mode of the clients of the active replication version')
+    parser.add_argument('--base-port', type=int, default=23400, help='Port of the first server, the others use the following ports')
+    parser.add_argument('--server-args', default="", help='Further arguments passed to every server')
+    parser.add_argument('--client-args', default="", help='Further arguments passed to every client')
+    parser.add_argument('--seed', default="0", help='Seed of the generated file contents')
+    parser.add_argument('--timeout', type=float, default=300, help='Seconds to wait for a workload to be replicated')
+    parser.add_argument('--output', help='JSON file to save the results to, benchmarks/results/<commit>.json by default')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary folders and process logs')
+
+    parser.add_argument('--tiny-count', type=int, default=500, help='Number of files of the tiny_files workload')
+    parser.add_argument('--tiny-size', type=int, default=1024, help='Size in bytes of the tiny files')
+    parser.add_argument('--tiny-folders', type=int, default=10, help='Number of folders the tiny files are spread over')
+    parser.add_argument('--huge-count', type=int, default=2, help='Number of files of the huge_files workload')
+    parser.add_argument('--huge-size', type=int, default=16 * MIB, help='Size in bytes of the huge files')
+    parser.add_argument('--append-count', type=int, default=200, help='Number of lines appended by the append_log workload')
+    parser.add_argument('--append-size', type=int, default=128, help='Size in bytes of an appended line')
+    parser.add_argument('--append-interval', type=float, default=0.01, help='Seconds between two appended lines')
+    parser.add_argument('--move-count', type=int, default=200, help='Number of files moved by the bulk_moves workload')
+    parser.add_argument('--move-size', type=int, default=4096, help='Size in bytes of the moved files')
+    parser.add_argument('--tree-depth', type=int, default=16, help='Number of nested folders of the deep_tree workload')
+    parser.add_argument('--tree-width', type=int, default=2, help='Number of files on every level of the tree')
+    parser.add_argument('--tree-file-size', type=int, default=512, help='Size in bytes of the files in the tree')
+
+    return parser.parse_args()
+
+
+# Process of a server or client. Its output is written to a log file and watched for the lines
+# telling that it is ready.
+class BenchProcess:
+    def __init__(self, role, index, command, cwd, log_path):
+        self.role = role
+        self.index = index
+        self.lines = []
+        self.finished = False
+        self.condition = threading.Condition()
+        self.log_file = open(log_path, 'w')
+        self.rusage = None
+        env = dict(os.environ, PYTHONUNBUFFERED="1")
+        # A process group of its own, so that signals reach the worker processes of a server as well
+        self.process = subprocess.Popen(command, cwd=cwd, env=env, stdin=subprocess.DEVNULL,
+                                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+                                        start_new_session=True)
+
+        self.reader_thread = threading.Thread(target=self.read_output)
+        self.reader_thread.daemon = True
+        self.reader_thread.start()
+
+    def read_output(self):
+        for line in self.process.stdout:
+            self.log_file.write(line)
+            with self.condition:
+                self.lines.append(line)
+                self.condition.notify_all()
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+
+    # Wait until a line contains the text, fails if the process ends or the timeout passes first
+    def wait_for(self, text, timeout=START_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while not any(text in line for line in self.lines):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self.finished:
+                    raise RuntimeError(f"{self.role} {self.index} did not print '{text}', see {self.log_file.name}")
+                self.condition.wait(min(remaining, 0.5))
+
+    # Interrupt the process group like Ctrl+C and collect the resource usage, it is killed if it does not end in time.
+    # The process is only reaped here (not through Popen), wait4 reports the usage of the process and the workers it waited for.
+    def stop(self, timeout=STOP_TIMEOUT):
+        if self.rusage is None:
+            self.signal_group(signal.SIGINT)
+            deadline = time.monotonic() + timeout
+            while True:
+                pid, status, rusage = os.wait4(self.process.pid, os.WNOHANG)
+                if pid != 0:
+                    break
+                if time.monotonic() > deadline:
+                    self.signal_group(signal.SIGKILL)
+                    pid, status, rusage = os.wait4(self.process.pid, 0)
+                    break
+                time.sleep(0.05)
+            # Nothing of the group may keep the ports for the next run
+            self.signal_group(signal.SIGKILL)
+            self.process.returncode = os.waitstatus_to_exitcode(status)
+            self.rusage = rusage
+            self.reader_thread.join(timeout)
+            self.log_file.close()
+        return self.get_stats()
+
+    def signal_group(self, signum):
+        try:
+            os.killpg(self.process.pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def get_stats(self):
+        # ru_maxrss is given in kilobytes on Linux and in bytes on macOS
+        peak_rss = self.rusage.ru_maxrss if sys.platform == "darwin" else self.rusage.ru_maxrss * 1024
+        return {
+            "role": self.role,
+            "index": self.index,
+            "exit_code": self.process.returncode,
+            "cpu_user_seconds": round(self.rusage.ru_utime, 3),
+            "cpu_system_seconds": round(self.rusage.ru_stime, 3),
+            "peak_rss_bytes": peak_rss
+        }
+
+
+# Servers and clients of one version running in a temporary folder. Every client logs in as its own user.
+class Cluster:
+    def __init__(self, variant, root, args):
+        self.variant = variant
+        self.root = root
+        self.args = args
+        # The single server version only knows one server
+        self.server_count = 1 if variant == "artefact_single-server" else args.servers
+        self.ports = [args.base_port + i for i in range(self.server_count)]
+        self.server_dirs = [os.path.join(root, f"server{i}") for i in range(self.server_count)]
+        self.client_dirs = [os.path.join(root, f"client{i}") for i in range(args.clients)]
+        self.usernames = [f"bench{i}" for i in range(args.clients)]
+        self.processes = []
+
+    def start(self):
+        for path in self.server_dirs + self.client_dirs + [os.path.join(self.root, "logs")]:
+            os.makedirs(path)
+        servers = []
+        for i, (port, server_dir) in enumerate(zip(self.ports, self.server_dirs)):
+            # Plain text passwords are hashed by the servers when they load the file, so each server rewrites its own
+            users_file = os.path.join(self.root, f"users{i}.csv")
+            with open(users_file, 'w') as file:
+                file.write("username,password\n")
+                for username in self.usernames:
+                    file.write(f"{username},{username}\n")
+            command = [sys.executable, "server.py", "--server-host", HOST, "--server-port", str(port),
+                       "--server-dir", server_dir, "--users-file", users_file]
+            if self.variant == "active_replication" and self.args.replication == "primary" and len(self.ports) > 1:
+                command += ["--peers"] + [f"{HOST}:{peer}" for peer in self.ports if peer != port]
+            servers.append(self.launch("server", i, command + shlex.split(self.args.server_args)))
+        for server in servers:
+            server.wait_for("listening on")
+
+        clients = []
+        for i, (client_dir, username) in enumerate(zip(self.client_dirs, self.usernames)):
+            command = [sys.executable, "client.py", "--client-dir", client_dir, "--username", username, "--password", username]
+            if self.variant == "active_replication":
+                command += ["--server-hosts", HOST, "--server-ports"] + [str(port) for port in self.ports]
+                command += ["--replication", self.args.replication]
+            else:
+                command += ["--server-host", HOST, "--server-port", str(self.ports[0])]
+            clients.append(self.launch("client", i, command + shlex.split(self.args.client_args)))
+        for client in clients:
+            client.wait_for("Logged in successfully")
+        # The clients start watching their folders right after the login
+        time.sleep(1)
+
+    def launch(self, role, index, command):
+        cwd = os.path.join(REPO_DIR, self.variant, role)
+        process = BenchProcess(role, index, command, cwd, os.path.join(self.root, "logs", f"{role}{index}.log"))
+        self.processes.append(process)
+        return process
+
+    # Stop the clients before the servers, so that they do not report the servers as gone
+    def stop(self):
+        stats = []
+        for role in ("client", "server"):
+            for process in self.processes:
+                if process.role == role:
+                    stats.append(process.stop())
+        return stats
+
+
+# Poller of the server folders, measuring when each change registered by the clients arrived on every server
+class ReplicationTracker:
+    def __init__(self, server_dirs):
+        self.server_dirs = server_dirs
+        # Server path -> expected states in the order of the changes: (state, time of the change, measured)
+        self.pending = {}
+        self.lock = threading.Lock()
+        # Changes made while measuring are timed, the others are only waited for
+        self.measuring = False
+        self.latencies = []
+        self.last_replicated = None
+        # Server path -> ((mtime, size), state), spares hashing unchanged files on every poll
+        self.states = {}
+
+    def expect(self, username, relative_path, state):
+        changed = time.monotonic()
+        with self.lock:
+            for server_dir in self.server_dirs:
+                path = os.path.join(server_dir, username, relative_path)
+                self.pending.setdefault(path, []).append((state, changed, self.measuring))
+
+    def poll(self):
+        with self.lock:
+            pending = [(path, list(expectations)) for path, expectations in self.pending.items()]
+        for path, expectations in pending:
+            state = self.get_state(path, expectations)
+            # Reaching the state of a later change also completes the earlier changes of the path
+            matched = next((i for i in range(len(expectations) - 1, -1, -1) if expectations[i][0] == state), None)
+            if matched is None:
+                continue
+            replicated = time.monotonic()
+            with self.lock:
+                remaining = self.pending[path][matched + 1:]
+                if remaining:
+                    self.pending[path] = remaining
+                else:
+                    del self.pending[path]
+                for _, changed, measured in expectations[:matched + 1]:
+                    if measured:
+                        self.latencies.append(replicated - changed)
+                        self.last_replicated = replicated
+
+    def get_state(self, path, expectations):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if os.path.isdir(path):
+            return DIRECTORY_STATE
+        # Files are only hashed once they have the size of an expected state
+        if not any(isinstance(state, tuple) and state[0] == stat.st_size for state, _, _ in expectations):
+            return (stat.st_size, None)
+        key = (stat.st_mtime_ns, stat.st_size)
+        cached = self.states.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        try:
+            state = get_file_state(path)
+        except OSError:
+            return None
+        self.states[path] = (key, state)
+        return state
+
+    # Wait until every registered change arrived, returns the number of measured changes that did not in time
+    def wait(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            self.poll()
+            with self.lock:
+                if not self.pending:
+                    return 0
+                if time.monotonic() > deadline:
+                    missing = sum(1 for expectations in self.pending.values() for _, _, measured in expectations if measured)
+                    self.pending.clear()
+                    return missing
+            time.sleep(POLL_INTERVAL)
+
+
+# Run a step of the workload in the folders of all clients at the same time
+def run_in_parallel(function, folders):
+    errors = []
+
+    def run(folder):
+        try:
+            function(folder)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(folder,)) for folder in folders]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def run_workload(variant, workload_class, args, root):
+    workload = workload_class(vars(args))
+    cluster = Cluster(variant, root, args)
+    result = {
+        "variant": variant,
+        "workload": workload.name,
+        "servers": cluster.server_count,
+        "clients": args.clients,
+        "replication": args.replication if variant == "active_replication" else None
+    }
+    print(f"{variant} / {workload.name}: {workload.description}")
+
+    try:
+        cluster.start()
+        tracker = ReplicationTracker(cluster.server_dirs)
+        folders = [ClientFolder(client_dir, username, random.Random(f"{args.seed}-{workload.name}-{i}"), tracker)
+                   for i, (client_dir, username) in enumerate(zip(cluster.client_dirs, cluster.usernames))]
+
+        run_in_parallel(workload.prepare, folders)
+        if tracker.wait(args.timeout) or tracker.pending:
+            raise RuntimeError("The preparation of the workload was not replicated in time")
+        for folder in folders:
+            folder.operations = 0
+            folder.bytes_written = 0
+
+        tracker.measuring = True
+        start = time.monotonic()
+        run_in_parallel(workload.run, folders)
+        result["write_seconds"] = round(time.monotonic() - start, 3)
+        result["unreplicated"] = tracker.wait(args.timeout)
+
+        operations = sum(folder.operations for folder in folders)
+        bytes_written = sum(folder.bytes_written for folder in folders)
+        duration = (tracker.last_replicated or time.monotonic()) - start
+        result["operations"] = operations
+        result["bytes"] = bytes_written
+        result["duration_seconds"] = round(duration, 3)
+        result["throughput_mb_per_second"] = round(bytes_written / duration / 1e6, 3)
+        result["operations_per_second"] = round(operations / duration, 1)
+        result["time_to_replicate_seconds"] = get_latency_stats(tracker.latencies)
+    except Exception as e:
+        print(f"Error: {e}")
+        result["error"] = str(e)
+    finally:
+        processes = cluster.stop()
+
+    result["cpu_seconds"] = {
+        role: round(sum(p["cpu_user_seconds"] + p["cpu_system_seconds"] for p in processes if p["role"] == role), 3)
+        for role in ("server", "client")
+    }
+    result["peak_rss_bytes"] = {
+        role: max((p["peak_rss_bytes"] for p in processes if p["role"] == role), default=0)
+        for role in ("server", "client")
+    }
+    result["processes"] = processes
+    print(format_result(result))
+    return result
+
+
+def get_latency_stats(latencies):
+    if not latencies:
+        return None
+    latencies = sorted(latencies)
+    return {
+        "samples": len(latencies),
+        "p50": round(get_percentile(latencies, 50), 4),
+        "p99": round(get_percentile(latencies, 99), 4),
+        "max": round(latencies[-1], 4),
+        "mean": round(sum(latencies) / len(latencies), 4)
+    }
+
+
+# Nearest-rank percentile of sorted values
+def get_percentile(values, percentile):
+    index = max(0, -(-len(values) * percentile // 100) - 1)
+    return values[int(index)]
+
+
+def format_result(result):
+    if "error" in result:
+        return f"  failed: {result['error']}"
+    latency = result["time_to_replicate_seconds"] or {}
+    return (f"  {result['throughput_mb_per_second']} MB/s, {result['operations_per_second']} ops/s, "
+            f"time-to-replicate p50 {latency.get('p50')} s p99 {latency.get('p99')} s, "
+            f"CPU servers {result['cpu_seconds']['server']} s clients {result['cpu_seconds']['client']} s, "
+            f"peak RSS servers {result['peak_rss_bytes']['server'] // MIB} MiB clients {result['peak_rss_bytes']['client'] // MIB} MiB"
+            + (f", {result['unreplicated']} changes not replicated" if result["unreplicated"] else ""))
+
+
+# Print the change of the main numbers against the results of an earlier run
+def compare_results(results, previous_path):
+    with open(previous_path, 'r') as previous_file:
+        previous = json.load(previous_file)
+    print(f"Compared with {previous_path} (commit {previous['commit']}):")
+    previous_results = {(result["variant"], result["workload"]): result for result in previous["results"]}
+    for result in results:
+        old = previous_results.get((result["variant"], result["workload"]))
+        if old is None or "error" in old or "error" in result:
+            continue
+        old_p99 = (old["time_to_replicate_seconds"] or {}).get("p99")
+        new_p99 = (result["time_to_replicate_seconds"] or {}).get("p99")
+        print(f"  {result['variant']} / {result['workload']}: "
+              f"{old['throughput_mb_per_second']} -> {result['throughput_mb_per_second']} MB/s, "
+              f"p99 {old_p99} -> {new_p99} s, "
+              f"CPU {sum(old['cpu_seconds'].values()):.2f} -> {sum(result['cpu_seconds'].values()):.2f} s")
+
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+if __name__ == "__main__":
+    args = parse_command_line_args()
+    commit = get_commit()
+    root = tempfile.mkdtemp(prefix="file_hosting_benchmark_")
+
+    results = []
+    try:
+        for variant in args.variants:
+            for name in args.workloads:
+                results.append(run_workload(variant, WORKLOADS[name], args, os.path.join(root, variant, name)))
+    except KeyboardInterrupt:
+        print("Benchmark interrupted, saving the finished workloads")
+    finally:
+        if args.keep:
+            print(f"Folders and logs kept in {root}")
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    output = args.output or os.path.join(REPO_DIR, "benchmarks", "results", f"{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as output_file:
+        json.dump({
+            "commit": commit,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "settings": vars(args),
+            "results": results
+        }, output_file, indent=4)
+    print(f"Results saved to {output}")
+
+    if args.compare:
+        compare_results(results, args.compare)
@@ -0,0 +1,169 @@
+import os
+import time
+import shutil
+import hashlib
+
+# Workloads replayed in the folder of each benchmark client. A workload changes the folder through a
+# ClientFolder, which tells the tracker the state every change has to reach on the servers. What prepare
+# creates is replicated before the measurement starts, only the changes made by run are measured.
+
+MIB = 1048576
+
+
+class Workload:
+    name = None
+    description = None
+
+    def __init__(self, options):
+        self.options = options
+
+    def prepare(self, folder):
+        pass
+
+    def run(self, folder):
+        raise NotImplementedError
+
+
+class TinyFiles(Workload):
+    name = "tiny_files"
+    description = "many small files created in a few folders"
+
+    def prepare(self, folder):
+        for i in range(self.options["tiny_folders"]):
+            folder.make_dir(f"tiny/{i}")
+
+    def run(self, folder):
+        for i in range(self.options["tiny_count"]):
+            folder.write_file(f"tiny/{i % self.options['tiny_folders']}/file{i}.bin", folder.random_bytes(self.options["tiny_size"]))
+
+
+class HugeFiles(Workload):
+    name = "huge_files"
+    description = "a few large files"
+
+    def run(self, folder):
+        for i in range(self.options["huge_count"]):
+            folder.write_file(f"huge{i}.bin", folder.random_bytes(self.options["huge_size"]))
+
+
+class AppendLog(Workload):
+    name = "append_log"
+    description = "lines appended to a log file one at a time"
+
+    def prepare(self, folder):
+        folder.write_file("logs/app.log", b"")
+
+    def run(self, folder):
+        for i in range(self.options["append_count"]):
+            line = folder.random_bytes(self.options["append_size"]).hex()[:self.options["append_size"] - 1]
+            folder.append_file("logs/app.log", (line + "\n").encode())
+            time.sleep(self.options["append_interval"])
+
+
+class BulkMoves(Workload):
+    name = "bulk_moves"
+    description = "synced files moved to another folder one after the other"
+
+    def prepare(self, folder):
+        folder.make_dir("moves/src")
+        folder.make_dir("moves/dst")
+        for i in range(self.options["move_count"]):
+            folder.write_file(f"moves/src/file{i}.bin", folder.random_bytes(self.options["move_size"]))
+
+    def run(self, folder):
+        for i in range(self.options["move_count"]):
+            folder.move(f"moves/src/file{i}.bin", f"moves/dst/file{i}.bin")
+
+
+class DeepTree(Workload):
+    name = "deep_tree"
+    description = "nested folders with a few files on every level"
+
+    def run(self, folder):
+        path = "tree"
+        folder.make_dir(path)
+        for level in range(self.options["tree_depth"]):
+            path = f"{path}/level{level}"
+            folder.make_dir(path)
+            for i in range(self.options["tree_width"]):
+                folder.write_file(f"{path}/file{i}.txt", folder.random_bytes(self.options["tree_file_size"]))
+
+
+WORKLOADS = {workload.name: workload for workload in (TinyFiles, HugeFiles, AppendLog, BulkMoves, DeepTree)}
+
+
+# Folder of a benchmark client. Every change is counted and registered with the tracker right after
+# it was made, together with the state the path has to reach on every server.
+class ClientFolder:
+    def __init__(self, path, username, rng, tracker):
+        self.path = path
+        self.username = username
+        self.rng = rng
+        self.tracker = tracker
+        self.operations = 0
+        self.bytes_written = 0
+
+    def random_bytes(self, size):
+        return self.rng.randbytes(size)
+
+    def write_file(self, relative_path, data):
+        full_path = os.path.join(self.path, relative_path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'wb') as file:
+            file.write(data)
+        self.changed(relative_path, get_file_state(full_path), len(data))
+
+    def append_file(self, relative_path, data):
+        full_path = os.path.join(self.path, relative_path)
+        with open(full_path, 'ab') as file:
+            file.write(data)
+        self.changed(relative_path, get_file_state(full_path), len(data))
+
+    def make_dir(self, relative_path):
+        os.makedirs(os.path.join(self.path, relative_path), exist_ok=True)
+        self.changed(relative_path, DIRECTORY_STATE, 0)
+
+    def move(self, src_relative_path, dest_relative_path):
+        dest_path = os.path.join(self.path, dest_relative_path)
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        shutil.move(os.path.join(self.path, src_relative_path), dest_path)
+        self.changed(src_relative_path, None, 0)
+        self.changed(dest_relative_path, get_path_state(dest_path), 0)
+
+    def delete(self, relative_path):
+        full_path = os.path.join(self.path, relative_path)
+        if os.path.isdir(full_path):
+            shutil.rmtree(full_path)
+        else:
+            os.remove(full_path)
+        self.changed(relative_path, None, 0)
+
+    def changed(self, relative_path, state, size):
+        self.operations += 1
+        self.bytes_written += size
+        self.tracker.expect(self.username, relative_path, state)
+
+
+# State of a path as compared between the client and the servers: None if it does not exist,
+# DIRECTORY_STATE for folders and (size, sha256) for files
+DIRECTORY_STATE = "dir"
+
+def get_path_state(path):
+    if not os.path.lexists(path):
+        return None
+    if os.path.isdir(path):
+        return DIRECTORY_STATE
+    return get_file_state(path)
+
+
+def get_file_state(path):
+    file_hash = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as file:
+        while True:
+            block = file.read(MIB)
+            if not block:
+                break
+            file_hash.update(block)
+            size += len(block)
+    return (size, file_hash.hexdigest())
@@ -0,0 +1,182 @@
+import os
+import sys
+import time
+import random
+import hashlib
+import argparse
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+from benchmark import Cluster, ReplicationTracker, VARIANTS
+from workloads import ClientFolder, get_path_state
+
+# End-to-end tests of both versions on the loopback interface, started with the processes and folders of the
+# benchmark: the changes made in the folder of a client have to reach every server within the timeout.
+
+TIMEOUT = 30 # in seconds
+# Small chunks, so that files of a few hundred KB are streamed in more chunks than fit into the upload window
+CLIENT_ARGS = "--upload-chunk-size 16384 --upload-window 4 --settle-window 0.1"
+
+
+@pytest.fixture
+def start_cluster(tmp_path):
+    clusters = []
+
+    def start(variant, base_port, server_args="", client_args=CLIENT_ARGS):
+        args = argparse.Namespace(servers=2, clients=1, replication="active", base_port=base_port,
+                                  server_args=server_args, client_args=client_args)
+        cluster = Cluster(variant, str(tmp_path / variant), args)
+        clusters.append(cluster)
+        cluster.start()
+        tracker = ReplicationTracker(cluster.server_dirs)
+        tracker.measuring = True
+        folder = ClientFolder(cluster.client_dirs[0], cluster.usernames[0], random.Random(variant), tracker)
+        return cluster, tracker, folder
+
+    yield start
+    for cluster in clusters:
+        cluster.stop()
+
+
+def get_log(cluster, role, index=0):
+    process = next(p for p in cluster.processes if p.role == role and p.index == index)
+    with process.condition:
+        return "".join(process.lines)
+
+
+@pytest.mark.parametrize("variant", VARIANTS)
+def test_resync_of_streamed_file(start_cluster, variant):
+    # The servers only know the hash of new files, they ask for the content of the file, which is larger than a chunk
+    cluster, tracker, folder = start_cluster(variant, 24100 + 10 * VARIANTS.index(variant), "--storage blobs")
+    folder.write_file("big.bin", folder.random_bytes(512 * 1024))
+
+    assert tracker.wait(TIMEOUT) == 0
+    client_log = get_log(cluster, "client")
+    assert "did not acknowledge" not in client_log
+    assert "has been removed" not in client_log
+    for server_dir in cluster.server_dirs:
+        assert os.listdir(os.path.join(server_dir, cluster.usernames[0])) == ["big.bin"]
+
+
+@pytest.mark.parametrize("variant", VARIANTS)
+def test_blob_storage(start_cluster, variant):
+    cluster, tracker, folder = start_cluster(variant, 24200 + 10 * VARIANTS.index(variant), "--storage blobs")
+    content = folder.random_bytes(512 * 1024)
+    folder.write_file("a.bin", content)
+    assert tracker.wait(TIMEOUT) == 0
+    # Known content is only announced by its hash
+    folder.write_file("copy/b.bin", content)
+    assert tracker.wait(TIMEOUT) == 0
+    folder.write_file("a.bin", content[:256 * 1024] + folder.random_bytes(256 * 1024))
+    folder.delete("copy/b.bin")
+    # Small files are sent with their content, written by several I/O threads at once
+    small_content = folder.random_bytes(1024)
+    for i in range(8):
+        folder.write_file(f"small{i}.txt", small_content)
+    assert tracker.wait(TIMEOUT) == 0
+
+    assert "did not acknowledge" not in get_log(cluster, "client")
+    small_names = [f"small{i}.txt" for i in range(8)]
+    for server_dir in cluster.server_dirs:
+        user_dir = os.path.join(server_dir, cluster.usernames[0])
+        assert sorted(os.listdir(user_dir)) == ["a.bin", "copy"] + small_names
+        assert os.listdir(os.path.join(user_dir, "copy")) == []
+        # The files link to the two blobs left, the one of the replaced and deleted content is gone
+        blobs = [os.path.join(server_dir, ".blobs", blob) for blob in os.listdir(os.path.join(server_dir, ".blobs"))]
+        assert len(blobs) == 2
+        for name in ["a.bin"] + small_names:
+            assert any(os.path.samefile(os.path.join(user_dir, name), blob) for blob in blobs)
+
+
+@pytest.mark.parametrize("variant", VARIANTS)
+def test_files_named_like_temporary_files(start_cluster, variant):
+    cluster, tracker, folder = start_cluster(variant, 24300 + 10 * VARIANTS.index(variant))
+    names = ["notes", "notes.tmp", "notes.delta", "download.part"]
+    for name in names:
+        folder.write_file(name, folder.random_bytes(1024))
+    assert tracker.wait(TIMEOUT) == 0
+    # Writing a file must leave the files of the user next to it alone
+    folder.write_file("notes", folder.random_bytes(2048))
+    assert tracker.wait(TIMEOUT) == 0
+
+    for server_dir in cluster.server_dirs:
+        assert sorted(os.listdir(os.path.join(server_dir, cluster.usernames[0]))) == sorted(names)
+
+
+@pytest.mark.parametrize("variant", VARIANTS)
+def test_reconcile_files_named_like_temporary_files(start_cluster, variant):
+    cluster, tracker, folder = start_cluster(variant, 24400 + 10 * VARIANTS.index(variant))
+    client = cluster.processes[-1]
+    client.stop()
+    # Changed while the client was not running, found by comparing the folder with the servers after the login
+    for name in ["download.part", "notes.tmp", ".hidden"]:
+        folder.write_file(name, folder.random_bytes(1024))
+    cluster.launch("client", 1, client.process.args).wait_for("reconciled")
+
+    assert tracker.wait(TIMEOUT) == 0
+
+
+# Wait until the files in the folder of the client have the given states, None for files that must not exist
+def wait_for_folder(folder, states, timeout):
+    deadline = time.monotonic() + timeout
+    while True:
+        current = {path: get_path_state(os.path.join(folder.path, path)) for path in states}
+        if current == states or time.monotonic() > deadline:
+            return current
+        time.sleep(0.1)
+
+
+@pytest.mark.parametrize("variant", VARIANTS)
+def test_reconcile_changes_made_on_the_servers(start_cluster, variant):
+    cluster, tracker, folder = start_cluster(variant, 24500 + 10 * VARIANTS.index(variant))
+    for name in ["shared.txt", "gone.txt", "mine.txt"]:
+        folder.write_file(name, folder.random_bytes(1024))
+    assert tracker.wait(TIMEOUT) == 0
+    client = cluster.processes[-1]
+    client.stop()
+
+    # Changed by another device while the client was not running
+    shared = folder.random_bytes(2048)
+    new = folder.random_bytes(512)
+    for server_dir in cluster.server_dirs:
+        user_dir = os.path.join(server_dir, cluster.usernames[0])
+        with open(os.path.join(user_dir, "shared.txt"), 'wb') as file:
+            file.write(shared)
+        os.makedirs(os.path.join(user_dir, "new"))
+        with open(os.path.join(user_dir, "new", "file.txt"), 'wb') as file:
+            file.write(new)
+        os.remove(os.path.join(user_dir, "gone.txt"))
+    # Changed here at the same time
+    folder.write_file("mine.txt", folder.random_bytes(1024))
+    cluster.launch("client", 1, client.process.args).wait_for("reconciled")
+
+    assert tracker.wait(TIMEOUT) == 0
+    expected = {
+        "shared.txt": (len(shared), hashlib.sha256(shared).hexdigest()),
+        os.path.join("new", "file.txt"): (len(new), hashlib.sha256(new).hexdigest()),
+        "gone.txt": None
+    }
+    assert wait_for_folder(folder, expected, TIMEOUT) == expected
+    # Fetched files are written to temporary files next to them, none is left behind
+    assert sorted(os.listdir(folder.path)) == ["mine.txt", "new", "shared.txt"]
+    assert os.listdir(os.path.join(folder.path, "new")) == ["file.txt"]
+    for server_dir in cluster.server_dirs:
+        user_dir = os.path.join(server_dir, cluster.usernames[0])
+        assert get_path_state(os.path.join(user_dir, "shared.txt")) == expected["shared.txt"]
+        assert sorted(os.listdir(user_dir)) == ["mine.txt", "new", "shared.txt"]
+
+
+@pytest.mark.parametrize("variant", VARIANTS)
+def test_shutdown_sends_waiting_changes(start_cluster, variant):
+    # The change is still waiting in the coalescer when the client is closed
+    cluster, tracker, folder = start_cluster(variant, 24600 + 10 * VARIANTS.index(variant),
+                                             client_args="--settle-window 10")
+    folder.write_file("last.txt", folder.random_bytes(1024))
+    time.sleep(1)
+    client = cluster.processes[-1]
+    client.stop()
+
+    assert tracker.wait(TIMEOUT) == 0
+    assert client.process.returncode == 0
+    assert "Error" not in get_log(cluster, "client")
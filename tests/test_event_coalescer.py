@@ -0,0 +1,57 @@
+import os
+import threading
+import importlib.util
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VARIANTS = ["artefact_single-server", "active_replication"]
+
+
+def load_event_coalescer(variant):
+    path = os.path.join(REPO_DIR, variant, "client", "components", "event_coalescer.py")
+    spec = importlib.util.spec_from_file_location(f"event_coalescer_{variant.replace('-', '_')}", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.EventCoalescer
+
+
+# Event handler recording the created files, failing for the paths it is given
+class FailingEventHandler:
+    def __init__(self, failing_paths):
+        self.failing_paths = failing_paths
+        self.created = []
+        self.flushed = threading.Event()
+        self.push_receiver = self
+
+    def is_echo(self, path, event):
+        return False
+
+    def send_created(self, path, is_directory):
+        if path in self.failing_paths:
+            raise ValueError("data could not be compressed")
+        self.created.append(path)
+
+    def flush_updates(self):
+        self.flushed.set()
+
+
+@pytest.mark.parametrize("variant", VARIANTS)
+def test_failing_event_does_not_stop_syncing(tmp_path, variant):
+    paths = [str(tmp_path / name) for name in ("a", "b", "c")]
+    for path in paths:
+        open(path, 'wb').close()
+    event_handler = FailingEventHandler({paths[0]})
+    coalescer = load_event_coalescer(variant)(event_handler, 0.2)
+
+    for path in paths:
+        coalescer.on_created(path, False)
+    assert event_handler.flushed.wait(5)
+    assert event_handler.created == paths[1:]
+
+    # The flush thread is still running
+    event_handler.flushed.clear()
+    event_handler.failing_paths.clear()
+    coalescer.on_created(paths[0], False)
+    assert event_handler.flushed.wait(5)
+    assert event_handler.created == paths[1:] + paths[:1]
@@ -0,0 +1,58 @@
+import os
+import sys
+import time
+import threading
+import importlib.util
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_server_list_manager():
+    # The manager imports the resources of its version
+    sys.path.insert(0, os.path.join(REPO_DIR, "active_replication"))
+    os.environ.setdefault("DEBUG", "off")
+    path = os.path.join(REPO_DIR, "active_replication", "client", "components", "server_list_manager.py")
+    spec = importlib.util.spec_from_file_location("server_list_manager", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.ServerListManager
+
+
+# Client recording the repairs, the messages to the servers in busy are still held back by congestion control
+class RecordingClient:
+    def __init__(self):
+        self.busy = set()
+        self.repairs = []
+        self.repaired = threading.Event()
+
+    def is_sending_to(self, server):
+        return server in self.busy
+
+    def repair_server(self, server, message_id):
+        self.repairs.append((server, message_id))
+        self.repaired.set()
+
+    def probe_server(self, server):
+        pass
+
+
+def test_busy_straggler_is_waited_for():
+    fast, slow = ("127.0.0.1", 1), ("127.0.0.1", 2)
+    client = RecordingClient()
+    client.busy.add(slow)
+    manager = load_server_list_manager()([fast, slow], client, write_quorum=1)
+    manager.server_timeout = 0.2
+
+    manager.register_send_event(0)
+    manager.register_reply(0, fast)
+    assert 0 in manager.stragglers
+    # Still being sent earlier messages: neither repaired nor removed while it gets through
+    time.sleep(1)
+    assert client.repairs == []
+    assert manager.get_servers() == [fast, slow]
+    assert manager.stragglers[0]["pending_servers"] == {slow}
+
+    client.busy.clear()
+    assert client.repaired.wait(5)
+    assert client.repairs == [(slow, 0)]
+    assert manager.get_servers() == [fast, slow]
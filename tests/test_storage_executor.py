@@ -0,0 +1,33 @@
+import os
+import threading
+import importlib.util
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VARIANTS = ["artefact_single-server", "active_replication"]
+
+
+def load_storage_executor(variant):
+    path = os.path.join(REPO_DIR, variant, "server", "components", "storage_executor.py")
+    spec = importlib.util.spec_from_file_location(f"storage_executor_{variant.replace('-', '_')}", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.StorageExecutor
+
+
+@pytest.mark.parametrize("variant", VARIANTS)
+def test_failing_callbacks_keep_the_workers(variant):
+    executor = load_storage_executor(variant)(workers=1)
+
+    def fail():
+        raise OSError("reply could not be sent")
+
+    # Neither a failing operation nor a failing reply may end the only worker
+    executor.submit(["a"], fail)
+    executor.submit(["a"], lambda: None, fail)
+    applied = threading.Event()
+    executor.submit(["a"], applied.set)
+    assert applied.wait(5)
+    executor.close()
+    assert executor.pending == 0
@@ -0,0 +1,60 @@
+import os
+import hashlib
+import importlib.util
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_write_ahead_log():
+    path = os.path.join(REPO_DIR, "active_replication", "server", "components", "write_ahead_log.py")
+    spec = importlib.util.spec_from_file_location("write_ahead_log", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.WriteAheadLog
+
+
+def read(path):
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+# File tree applying the updates of a write-ahead log the way the server does, moves are checked with the log first
+class FileTree:
+    def __init__(self, root):
+        self.root = root
+        self.wal = None
+
+    def apply(self, metadata, data, client_address, on_applied):
+        if metadata["event_type"] == "moved":
+            src_path = os.path.join(self.root, metadata["src_path"])
+            file_hash = hashlib.sha256(read(src_path)).hexdigest() if os.path.exists(src_path) else None
+            if file_hash is not None and self.wal.prepare_move(metadata["seq"], file_hash):
+                os.rename(src_path, os.path.join(self.root, metadata["dest_path"]))
+        else:
+            with open(os.path.join(self.root, metadata["path"]), 'wb') as file:
+                file.write(data)
+        on_applied()
+
+    def open_log(self, wal_dir):
+        self.wal = load_write_ahead_log()(wal_dir, "server", "always", self.apply)
+        self.wal.recover()
+        return self.wal
+
+
+def test_recover_move_followed_by_create(tmp_path):
+    root = tmp_path / "user"
+    root.mkdir()
+    # Written before the last checkpoint, no longer in the log
+    (root / "a").write_bytes(b"v1")
+    tree = FileTree(str(root))
+    wal = tree.open_log(str(tmp_path / "wal"))
+
+    wal.append([({"event_type": "moved", "src_path": "a", "dest_path": "b"}, None),
+                ({"event_type": "created", "path": "a"}, b"v2")], None, lambda: None)
+    wal.wait_for_writes()
+    assert read(root / "b") == b"v1"
+
+    # Crash: the updates are still in the log and applied again on startup, the move must not take the new file
+    tree.open_log(str(tmp_path / "wal"))
+    assert read(root / "b") == b"v1"
+    assert read(root / "a") == b"v2"